@@ -2,29 +2,50 @@ import requests
 from requests.adapters import HTTPAdapter
 import logging
 import json
+import hashlib
+import time
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
 from constants import *
 import exceptions
+from cache import TTLCache
+from transport import es_session
 
 __author__ = 'jorgealegre'
 
 logger = logging.getLogger(__name__)
 
+FACEBOOK_GRAPH_URL = getattr(settings, 'FACEBOOK_GRAPH_URL', 'https://graph.facebook.com')
+FACEBOOK_GRAPH_VERSION = getattr(settings, 'FACEBOOK_GRAPH_VERSION', 'v2.5')
+FACEBOOK_APP_TOKEN_CACHE_TTL = getattr(settings, 'FACEBOOK_APP_TOKEN_CACHE_TTL', 3600)
+# max seconds we trust a validated user token, less when token expires before
+FACEBOOK_TOKEN_CACHE_TTL = getattr(settings, 'FACEBOOK_TOKEN_CACHE_TTL', 600)
+FACEBOOK_TOKEN_CACHE_SIZE = getattr(settings, 'FACEBOOK_TOKEN_CACHE_SIZE', 10000)
+
 req_session = requests.Session()
-req_session.mount('https://graph.facebook.com', HTTPAdapter(max_retries=3))
+req_session.mount(FACEBOOK_GRAPH_URL, HTTPAdapter(max_retries=3))
+
+# social_app_id -> app access token
+app_access_token_cache = TTLCache(max_size=1000, ttl=FACEBOOK_APP_TOKEN_CACHE_TTL)
+# (social_app_id, user access token hash) -> user data
+social_token_cache = TTLCache(max_size=FACEBOOK_TOKEN_CACHE_SIZE, ttl=FACEBOOK_TOKEN_CACHE_TTL)
+
+# seconds we trust base apps before checking their version
+BASE_DOCUMENT_CACHE_TTL = getattr(settings, 'BASE_DOCUMENT_CACHE_TTL', 60)
+BASE_DOCUMENT_CACHE_SIZE = getattr(settings, 'BASE_DOCUMENT_CACHE_SIZE', 1000)
 
 
 class SocialNetworkResolution(object):
 
     @classmethod
     def get_app_access_token_from_network(cls, social_app_id, social_app_secret, provider='facebook'):
-        response_raw = req_session.get('https://graph.facebook.com/oauth/access_token?'
+        response_raw = req_session.get('{graph_url}/oauth/access_token?'
                                        'client_id={social_app_id}&'
                                        'client_secret={social_app_secret}&'
                                        'grant_type=client_credentials'.format(
+                                           graph_url=FACEBOOK_GRAPH_URL,
                                            social_app_id=social_app_id,
                                            social_app_secret=social_app_secret,
                                        ))
@@ -35,20 +56,25 @@ class SocialNetworkResolution(object):
         return app_access_token
 
     @classmethod
-    def get_app_access_token(cls, social_app_id, social_app_secret, app_id='ximpia_api__base',
-                             provider='facebook', disable_update=False):
+    def _get_app_access_token(cls, app_id, social_app_id, social_app_secret, provider='facebook'):
         """
-        Get app access token
+        Get app access token from cache, app document or network, in that order. When app has no token we
+        update app with token from network.
 
+        :param app_id:
         :param social_app_id:
         :param social_app_secret:
+        :param provider:
         :return:
         """
         from document import Document, to_physical_doc
         from exceptions import DocumentNotFound
+        app_access_token = app_access_token_cache.get(social_app_id)
+        if app_access_token:
+            return app_access_token
         try:
-            app = Document.objects.get('app', id=app_id)
-            app_access_token = app['social']['facebook']['access_token']
+            app = Document.objects.get('app', id=app_id, get_logical=True)
+            app_access_token = app['social'][provider]['access_token']
             if not app_access_token:
                 app_access_token = cls.get_app_access_token_from_network(social_app_id,
                                                                          social_app_secret)
@@ -63,13 +89,55 @@ class SocialNetworkResolution(object):
                     raise exceptions.XimpiaAPIException(u'Error updating app :: {}'.format(
                         response
                     ))
-
         except DocumentNotFound:
             app_access_token = cls.get_app_access_token_from_network(social_app_id,
                                                                      social_app_secret)
+        app_access_token_cache.set(social_app_id, app_access_token)
+        return app_access_token
+
+    @classmethod
+    def get_app_access_token(cls, social_app_id, social_app_secret, app_id='ximpia_api__base',
+                             provider='facebook', disable_update=False):
+        """
+        Get app access token
+
+        :param social_app_id:
+        :param social_app_secret:
+        :return:
+        """
+        app_access_token = cls._get_app_access_token(app_id, social_app_id, social_app_secret, provider=provider)
         logger.info('SocialNetworkResolution :: app_access_token: {}'.format(app_access_token))
         return app_access_token
 
+    @classmethod
+    def _get_facebook_user_detail(cls, access_token):
+        response = req_session.get('{graph_url}/{version}/'
+                                   'me?'
+                                   'access_token={access_token}&fields=email,link,name'.format(
+                                       graph_url=FACEBOOK_GRAPH_URL,
+                                       version=FACEBOOK_GRAPH_VERSION,
+                                       access_token=access_token
+                                   ))
+        if response.status_code != 200:
+            raise exceptions.XimpiaAPIException(u'Error in validating Facebook response',
+                                                code=exceptions.SOCIAL_NETWORK_AUTH_ERROR)
+        return response.json()
+
+    @classmethod
+    def _get_facebook_profile_picture(cls, user_id, access_token):
+        # picture url is in redirect
+        response = req_session.get('{graph_url}/{version}/'
+                                   '{user_id}/picture?'
+                                   'access_token={access_token}'.format(
+                                       graph_url=FACEBOOK_GRAPH_URL,
+                                       version=FACEBOOK_GRAPH_VERSION,
+                                       user_id=user_id,
+                                       access_token=access_token
+                                   ), allow_redirects=False)
+        if response.status_code == 302:
+            return response.headers.get('location', None)
+        return None
+
     @classmethod
     def _process_facebook(cls, *args, **kwargs):
         """
@@ -79,42 +147,33 @@ class SocialNetworkResolution(object):
 
         We need to get app access token
 
+        User data for validated tokens is cached until token expires, at most FACEBOOK_TOKEN_CACHE_TTL seconds.
+        App access tokens are cached by social app id.
+
         :param args:
         :param kwargs:
         :return:
         """
-        from document import Document, to_physical_doc
-        from exceptions import DocumentNotFound
+        from document import AsyncDocumentManager
 
         provider = kwargs.get('provider', 'facebook')
         request_access_token = kwargs.get('access_token', '')
         if 'app_id' not in kwargs and not kwargs['app_id']:
             raise exceptions.XimpiaAPIException(u'App Id not informed')
+        social_app_id = kwargs.get('social_app_id', settings.XIMPIA_FACEBOOK_APP_ID)
+        token_key = (social_app_id, hashlib.sha1(request_access_token).hexdigest())
+        user_data = social_token_cache.get(token_key)
+        if user_data:
+            return dict(user_data)
 
         # this is executed in case we don't have app access token in ximpia app data
         if 'app' in kwargs:
             app_access_token = kwargs['app']['social']['facebook']['access_token']
         else:
-            try:
-                app = Document.objects.get('app', id=kwargs['app_id'], get_logical=True)
-                app_access_token = app['social']['facebook']['access_token']
-                if not app_access_token:
-                    app_access_token = cls.get_app_access_token_from_network(kwargs['social_app_id'],
-                                                                             kwargs['social_app_secret'])
-                    app['social'][provider]['access_token'] = app_access_token
-                    # update app
-                    response = Document.objects.update_partial('app',
-                                                               app['id'],
-                                                               {
-                                                                   'social__v1': to_physical_doc('app', app['social'])
-                                                               })
-                    if 'status' in response and response['status'] not in [200, 201]:
-                        raise exceptions.XimpiaAPIException(u'Error updating app :: {}'.format(
-                            response
-                        ))
-            except DocumentNotFound:
-                app_access_token = cls.get_app_access_token_from_network(kwargs['social_app_id'],
-                                                                         kwargs['social_app_secret'])
+            app_access_token = cls._get_app_access_token(kwargs['app_id'],
+                                                         social_app_id,
+                                                         kwargs['social_app_secret'],
+                                                         provider=provider)
         logger.info('SocialNetworkResolution :: app_access_token: {}'.format(app_access_token))
 
         """
@@ -133,8 +192,10 @@ class SocialNetworkResolution(object):
             }
         }
         """
-        request_url = 'https://graph.facebook.com/v2.5/debug_token?' \
+        request_url = '{graph_url}/{version}/debug_token?' \
                       'input_token={access_token}&access_token={app_token}'.format(
+                          graph_url=FACEBOOK_GRAPH_URL,
+                          version=FACEBOOK_GRAPH_VERSION,
                           access_token=request_access_token,
                           app_token=app_access_token)
         response = req_session.get(request_url)
@@ -144,7 +205,7 @@ class SocialNetworkResolution(object):
             ),
                 code=exceptions.SOCIAL_NETWORK_AUTH_ERROR)
         fb_data = response.json()
-        if fb_data['data']['app_id'] != kwargs.get('social_app_id', settings.XIMPIA_FACEBOOK_APP_ID) \
+        if fb_data['data']['app_id'] != social_app_id \
                 or not fb_data['data']['is_valid']:
             raise exceptions.XimpiaAPIException(u'Error in validating Facebook response :: token is not valid',
                                                 code=exceptions.SOCIAL_NETWORK_AUTH_ERROR)
@@ -154,38 +215,25 @@ class SocialNetworkResolution(object):
             'access_token': request_access_token,
             'expires_at': fb_data['data']['expires_at']
         }
-        # call facebook for user name and email
-        response = req_session.get('https://graph.facebook.com/v2.5/'
-                                   'me?'
-                                   'access_token={access_token}&fields=email,link,name'.format(
-                                       user_id=user_data['user_id'],
-                                       access_token=request_access_token
-                                   ))
-        if response.status_code != 200:
-            raise exceptions.XimpiaAPIException(u'Error in validating Facebook response',
-                                                code=exceptions.SOCIAL_NETWORK_AUTH_ERROR)
-        detail_user_data = response.json()
+        # call facebook for user name, email and picture at the same time
+        detail_user_data, profile_picture = AsyncDocumentManager.gather(
+            AsyncDocumentManager.submit(cls._get_facebook_user_detail, request_access_token),
+            AsyncDocumentManager.submit(cls._get_facebook_profile_picture, user_data['user_id'],
+                                        request_access_token)
+        )
         user_data.update({
             'email': detail_user_data.get('email', None),
             'name': detail_user_data.get('name', None),
             'first_name': detail_user_data.get('first_name', None),
             'last_name': detail_user_data.get('last_name', None),
             'link': detail_user_data.get('link', None),
+            'profile_picture': profile_picture,
         })
-        response = req_session.get('https://graph.facebook.com/v2.5/'
-                                   '{user_id}/picture?'
-                                   'access_token={access_token}'.format(
-                                       user_id=user_data['user_id'],
-                                       access_token=request_access_token
-                                   ))
-        if response.status_code == 302:
-            user_data.update({
-                'profile_picture': response.url,
-            })
-        else:
-            user_data.update({
-                'profile_picture': None,
-            })
+        ttl = FACEBOOK_TOKEN_CACHE_TTL
+        if user_data['expires_at']:
+            ttl = min(ttl, user_data['expires_at'] - time.time())
+        if ttl > 0:
+            social_token_cache.set(token_key, dict(user_data), ttl=ttl)
         return user_data
 
     @classmethod
@@ -210,7 +258,7 @@ def get_path_by_id(document_type, id_):
     :param id_:
     :return:
     """
-    return 'http://{host}/{index}/{document_type}/{_id}'.format(
+    return '{host}/{index}/{document_type}/{_id}'.format(
         host=settings.ELASTIC_SEARCH_HOST,
         index=settings.SITE_BASE_INDEX,
         document_type=document_type,
@@ -224,7 +272,7 @@ def get_path_site(id_):
     :param id_:
     :return:
     """
-    return 'http://{host}/{index}/{document_type}/{_id}'.format(
+    return '{host}/{index}/{document_type}/{_id}'.format(
         host=settings.ELASTIC_SEARCH_HOST,
         index='ximpia_api__base',
         document_type='site',
@@ -302,18 +350,133 @@ def get_setting_table_value(value_node):
     return table
 
 
-def get_base_app(site_slug):
+def msearch(searches):
     """
-    Get base app for site
+    Run searches in one request with _msearch
 
-    We check for base app
+    :param searches: List of (index, document_type, query_dsl)
+    :return: List of search responses, same order as searches
+    """
+    body = u''
+    for index, document_type, query_dsl in searches:
+        body += json.dumps({'index': index, 'type': document_type}) + '\n'
+        body += json.dumps(query_dsl) + '\n'
+    es_response = get_es_response(
+        es_session.get(u'{host}/_msearch'.format(host=settings.ELASTIC_SEARCH_HOST), data=body))
+    return es_response['responses']
+
+
+class BaseDocumentCache(object):
+    """
+    Process-wide cache for base apps
+
+    Base apps are read at the start of most requests and change almost never. Hits are kept by
+    (document_type, site slug) with the time we last checked them. Within ttl seconds we trust them, after that
+    we revalidate with a GET by id without source, which only returns _version, and drop the entry when version
+    changed or document is gone so callers fetch it again.
+
+    SetupSite and app updates through DocumentManager invalidate entries in this process. Other processes see
+    changes when they revalidate.
+    """
+
+    def __init__(self, ttl=BASE_DOCUMENT_CACHE_TTL, max_size=BASE_DOCUMENT_CACHE_SIZE):
+        self.ttl = ttl
+        # entries do not expire, stale ones are revalidated
+        self._cache = TTLCache(max_size=max_size, ttl=0)
+
+    @classmethod
+    def get_version(cls, hit):
+        """
+        Get current version for document in hit
+
+        :param hit: Search hit or get response, with _index, _type and _id
+        :return: Version, None when document not found
+        """
+        es_response_raw = es_session.get(
+            '{host}/{index}/{document_type}/{id_}?_source=false'.format(
+                host=settings.ELASTIC_SEARCH_HOST,
+                index=hit['_index'],
+                document_type=hit['_type'],
+                id_=hit['_id']
+            )
+        )
+        if es_response_raw.status_code == 404:
+            return None
+        es_response = get_es_response(es_response_raw)
+        if not es_response.get('found', False):
+            return None
+        return es_response['_version']
+
+    def get(self, document_type, key):
+        """
+        Get hit for document type and key, revalidating it when stale
+
+        :param document_type: app
+        :param key: Site slug
+        :return: Hit, None when not cached or changed
+        """
+        entry = self._cache.get((document_type, key))
+        if entry is None:
+            return None
+        hit, checked_on = entry
+        if time.time() - checked_on < self.ttl:
+            return hit
+        if self.get_version(hit) != hit.get('_version'):
+            self._cache.delete((document_type, key))
+            return None
+        self._cache.set((document_type, key), (hit, time.time()))
+        return hit
+
+    def set(self, document_type, key, hit):
+        """
+        Keep hit for document type and key. Hit needs _version to be revalidated
+
+        :param document_type:
+        :param key:
+        :param hit:
+        :return:
+        """
+        self._cache.set((document_type, key), (hit, time.time()))
+
+    def invalidate(self, document_type=None, key=None):
+        """
+        Invalidate entries. No key invalidates all entries for document type, no document type all entries.
+
+        :param document_type:
+        :param key:
+        :return:
+        """
+        if document_type is None:
+            self._cache.clear()
+        elif key is None:
+            self._cache.delete_many(lambda x: x[0] == document_type)
+        else:
+            self._cache.delete((document_type, key))
+
+    def evict(self, document_type, id_):
+        """
+        Evict document written by id. Base apps are cached by site slug, so app writes invalidate all base apps,
+        there are few of them.
+
+        :param document_type:
+        :param id_:
+        :return:
+        """
+        if document_type == 'app':
+            self.invalidate('app')
+
+
+base_document_cache = BaseDocumentCache()
+
+
+def get_base_app_query(site_slug):
+    """
+    Get query for base app for site
 
     :param site_slug:
     :return:
     """
-    from document import to_logical_doc
-    es_path = get_path_search('app', index=u'{}__base'.format(site_slug))
-    query_dsl = {
+    return {
         'query': {
             'filtered': {
                 'query': {
@@ -333,41 +496,64 @@ def get_base_app(site_slug):
                     }
                 }
             }
-        }
+        },
+        'size': 1,
+        'version': True,
     }
-    """query_dsl = {
-        'query': {
-            'filtered': {
-                'query': {
-                    'match_all': {}
-                }
-            }
-        }
-    }"""
-    # print es_path
-    # print query_dsl
-    es_response_raw = req_session.get(es_path, data=json.dumps(query_dsl))
-    # print es_response_raw.status_code
-    if es_response_raw.status_code != 200:
-        raise exceptions.DocumentNotFound(_(u'Error getting app "{}" :: {}'.format(
-            u'{}.base'.format(site_slug),
-            es_response_raw.content
-        )))
-    es_response = es_response_raw.json()
-    # print es_response
-    if 'status' in es_response and es_response['status'] != 200:
-        raise exceptions.DocumentNotFound(_(u'Error getting app "{}" :: {}'.format(
-            u'{}.base'.format(site_slug),
-            es_response_raw.content
-        )))
-    try:
-        app = es_response['hits']['hits'][0]['_source']
-        # logger.debug(u'get_base_app :: app: {}'.format(app))
-        app_document = to_logical_doc('app', app)
-        app_document['id'] = es_response['hits']['hits'][0]['_id']
-        return app_document
-    except IndexError:
-        raise exceptions.DocumentNotFound(_(u'Base app not found'))
+
+
+def get_base_apps(*site_slugs):
+    """
+    Get base apps for sites in one request. Apps are looked up in request identity map, then in process
+    base_document_cache, and only missing ones are searched.
+
+    app, app_ximpia_base = get_base_apps(site_slug, slugify(settings.SITE))
+
+    :param site_slugs:
+    :return: List of logical app documents
+    """
+    from document import to_logical_doc, identity_map
+    keys = map(lambda x: identity_map.get_key(u'{}__base'.format(x), 'app', 'base', x), site_slugs)
+    hits = map(identity_map.get, keys)
+    for position, site_slug in enumerate(site_slugs):
+        if hits[position] is None:
+            hits[position] = base_document_cache.get('app', site_slug)
+            if hits[position] is not None:
+                identity_map.set(keys[position], hits[position])
+    missing = filter(lambda x: hits[x] is None, range(len(site_slugs)))
+    if missing:
+        responses = msearch(map(lambda x: (u'{}__base'.format(site_slugs[x]), 'app',
+                                           get_base_app_query(site_slugs[x])), missing))
+        for position, es_response in zip(missing, responses):
+            if 'error' in es_response:
+                raise exceptions.DocumentNotFound(_(u'Error getting app "{}" :: {}'.format(
+                    u'{}.base'.format(site_slugs[position]),
+                    es_response['error']
+                )))
+            try:
+                hits[position] = es_response['hits']['hits'][0]
+            except IndexError:
+                raise exceptions.DocumentNotFound(_(u'Base app not found'))
+            identity_map.set(keys[position], hits[position])
+            base_document_cache.set('app', site_slugs[position], hits[position])
+    apps = []
+    for hit in hits:
+        app_document = to_logical_doc('app', hit['_source'])
+        app_document['id'] = hit['_id']
+        apps.append(app_document)
+    return apps
+
+
+def get_base_app(site_slug):
+    """
+    Get base app for site
+
+    We check for base app
+
+    :param site_slug:
+    :return:
+    """
+    return get_base_apps(site_slug)[0]
 
 
 def refresh_index(index):
@@ -377,7 +563,7 @@ def refresh_index(index):
     :param index:
     :return:
     """
-    req_session.post(
+    es_session.post(
         '{}/{}/_refresh'.format(settings.ELASTIC_SEARCH_HOST, index)
     )
 
@@ -481,7 +667,7 @@ def get_mappings(doc_type, index=settings.SITE_BASE_INDEX):
     :return:
     """
     logger.debug(u'get_mappings :: doc_type: {} index: {}'.format(doc_type, index))
-    response_raw = req_session.get(
+    response_raw = es_session.get(
         '{host}/{index}/_mapping/{type}'.format(
             host=settings.ELASTIC_SEARCH_HOST,
             index=index,
@@ -499,15 +685,19 @@ def get_mappings(doc_type, index=settings.SITE_BASE_INDEX):
     return response
 
 
-def create_doc_index(index_name, mappings):
+def create_doc_index(index_name, mappings=None, index_settings=None):
     """
     Create document index
 
     Index name:
     {site}__{app}__{doc_type}
 
+    With no mappings, settings and mappings come from index templates matching physical index name, see
+    base.provisioning.
+
     :param index_name:
     :param mappings:
+    :param index_settings: Index settings, read from settings file when not informed
 
     :return:
     """
@@ -518,20 +708,22 @@ def create_doc_index(index_name, mappings):
         datetime.now().strftime("%m-%d-%y.%H:%M:%S")
     )
     alias = index_name
-    with open(settings.BASE_DIR + 'settings/settings_test.json') as f:
-        settings_dict = json.loads(f.read())
-    doc_type = index_name.split('__')[-1]
-    es_response_raw = requests.post('{}/{}'.format(settings.ELASTIC_SEARCH_HOST, index_name_physical),
-                                    data=json.dumps({
-                                        'settings': settings_dict,
-                                        'mappings': {
-                                            doc_type: mappings,
-                                        },
-                                        'aliases': {
-                                            alias: {}
-                                        }
-                                    })
-                                    )
+    index_data = {
+        'aliases': {
+            alias: {}
+        }
+    }
+    if mappings is not None:
+        if index_settings is None:
+            with open(settings.BASE_DIR + 'settings/settings_test.json') as f:
+                index_settings = json.loads(f.read())
+        doc_type = index_name.split('__')[-1]
+        index_data['settings'] = index_settings
+        index_data['mappings'] = {
+            doc_type: mappings,
+        }
+    es_response_raw = es_session.post('{}/{}'.format(settings.ELASTIC_SEARCH_HOST, index_name_physical),
+                                      data=json.dumps(index_data))
     if es_response_raw.status_code not in [200, 201]:
         raise exceptions.XimpiaAPIException(_(u'Error creating index "{}" {}'.format(
             index_name,
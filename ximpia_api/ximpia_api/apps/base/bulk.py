@@ -0,0 +1,214 @@
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+
+from base import exceptions
+from base.transport import es_session
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+BULK_FLUSH_SIZE = getattr(settings, 'BULK_FLUSH_SIZE', 1000)
+BULK_FLUSH_BYTES = getattr(settings, 'BULK_FLUSH_BYTES', 5 * 1024 * 1024)
+BULK_WORKERS = getattr(settings, 'BULK_WORKERS', 4)
+SCROLL_SIZE = getattr(settings, 'SCROLL_SIZE', 500)
+SCROLL_KEEP_ALIVE = getattr(settings, 'SCROLL_KEEP_ALIVE', '1m')
+
+
+def scroll(path, query, size=SCROLL_SIZE, keep_alive=SCROLL_KEEP_ALIVE):
+    """
+    Iterate over pages of search results with scroll
+
+    for hits in scroll('{}/my-index/my-type/_search'.format(settings.ELASTIC_SEARCH_HOST), query):
+        ...
+
+    Only one page is in memory at a time. Scroll is cleared when done, also when generator is closed before end.
+
+    :param path: Search path, like "{host}/{index}/{document_type}/_search"
+    :param query: Query dsl
+    :param size: Documents in each page, for each shard
+    :param keep_alive: Time scroll is kept between pages
+    :return: Generator of lists of hits
+    """
+    query = dict(query, size=size)
+    es_response_raw = es_session.get(
+        u'{}{}scroll={}'.format(path, '&' if '?' in path else '?', keep_alive),
+        data=json.dumps(query))
+    if es_response_raw.status_code != 200:
+        raise exceptions.XimpiaAPIException(_(u'Error in scroll :: {}'.format(es_response_raw.content)))
+    es_response = es_response_raw.json()
+    scroll_id = es_response.get('_scroll_id', None)
+    try:
+        while es_response['hits']['hits']:
+            yield es_response['hits']['hits']
+            es_response_raw = es_session.get(
+                u'{host}/_search/scroll?scroll={keep_alive}'.format(
+                    host=settings.ELASTIC_SEARCH_HOST,
+                    keep_alive=keep_alive),
+                data=scroll_id)
+            if es_response_raw.status_code != 200:
+                raise exceptions.XimpiaAPIException(_(u'Error in scroll :: {}'.format(es_response_raw.content)))
+            es_response = es_response_raw.json()
+            scroll_id = es_response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            es_session.delete(u'{host}/_search/scroll'.format(host=settings.ELASTIC_SEARCH_HOST),
+                              data=scroll_id)
+
+
+class BulkWriter(object):
+    """
+    Streaming writer for bulk requests
+
+    Actions are serialized into NDJSON lines as they are added and sent every flush_size actions or flush_bytes
+    bytes by a pool of workers. At most workers bulk requests are waiting, so memory is bounded whatever number of
+    actions we write.
+
+    on_items receives result item for each action as bulk requests finish, like
+    {'index': {'_id': 'my-id', 'status': 201}}. Actions in failed bulk requests get items with status 500.
+
+    writer = BulkWriter()
+    writer.delete('my-index', 'my-type', 'my-id')
+    writer.index('my-index', 'my-type', 'my-id', document)
+    stats = writer.close()
+    """
+
+    def __init__(self, flush_size=BULK_FLUSH_SIZE, workers=BULK_WORKERS, progress=None, flush_bytes=BULK_FLUSH_BYTES,
+                 on_items=None):
+        """
+        :param flush_size: Actions in each bulk request
+        :param workers: Bulk requests sent at the same time
+        :param progress: Callable receiving stats after each bulk request
+        :param flush_bytes: Maximum bytes in each bulk request, a single action could be bigger
+        :param on_items: Callable receiving list of result items after each bulk request
+        :return:
+        """
+        self.flush_size = flush_size
+        self.flush_bytes = flush_bytes
+        self.workers = workers
+        self.progress = progress
+        self.on_items = on_items
+        self.stats = {
+            'actions': 0,
+            'requests': 0,
+            'errors': 0,
+            'elapsed': 0.0,
+        }
+        self._start = time.time()
+        self._lines = []
+        self._actions = []
+        self._bytes = 0
+        self._pool = ThreadPool(workers)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+
+    def add(self, action, document=None):
+        """
+        Add action
+
+        :param action: Action, like {'delete': {'_index': 'my-index', '_type': 'my-type', '_id': 'my-id'}}
+        :param document: Source for index, create and update actions
+        :return:
+        """
+        lines = [json.dumps(action)]
+        if document is not None:
+            lines.append(json.dumps(document))
+        size = sum(map(lambda x: len(x) + 1, lines))
+        if self._lines and self._bytes + size > self.flush_bytes:
+            self.flush()
+        self._lines.extend(lines)
+        self._actions.append(action)
+        self._bytes += size
+        if len(self._actions) >= self.flush_size or self._bytes >= self.flush_bytes:
+            self.flush()
+
+    def index(self, index, document_type, id_, document):
+        action = {'_index': index, '_type': document_type}
+        # ElasticSearch generates id when we have none
+        if id_ is not None:
+            action['_id'] = id_
+        self.add({'index': action}, document)
+
+    def delete(self, index, document_type, id_):
+        self.add({'delete': {'_index': index, '_type': document_type, '_id': id_}})
+
+    @classmethod
+    def get_error_items(cls, actions, error):
+        """
+        Get result items for actions in a failed bulk request
+
+        :param actions:
+        :param error:
+        :return:
+        """
+        return map(lambda x: {x.keys()[0]: dict(x.values()[0], status=500, error=error)}, actions)
+
+    def _write(self, body, actions):
+        size = len(actions)
+        try:
+            es_response_raw = es_session.post(u'{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
+                                              data=body)
+            errors = 0
+            if es_response_raw.status_code != 200:
+                errors = size
+                items = self.get_error_items(actions, es_response_raw.content)
+                logger.error(u'BulkWriter :: error in bulk request :: {}'.format(es_response_raw.content))
+            else:
+                es_response = es_response_raw.json()
+                items = es_response.get('items', [])
+                if es_response.get('errors', False):
+                    errors = len(filter(lambda x: x.values()[0].get('status', 200) >= 300
+                                        and x.values()[0].get('status', 200) != 404,
+                                        items))
+            with self._lock:
+                self.stats['actions'] += size
+                self.stats['requests'] += 1
+                self.stats['errors'] += errors
+                self.stats['elapsed'] = time.time() - self._start
+                stats = dict(self.stats)
+            if self.on_items:
+                self.on_items(items)
+            if self.progress:
+                self.progress(stats)
+        except Exception as e:
+            logger.exception(u'BulkWriter :: could not write {} actions'.format(size))
+            with self._lock:
+                self.stats['errors'] += size
+            if self.on_items:
+                self.on_items(self.get_error_items(actions, u'{}'.format(e)))
+        finally:
+            self._slots.release()
+
+    def flush(self):
+        """
+        Send actions added, waits when all workers are busy
+
+        :return:
+        """
+        if not self._lines:
+            return
+        body = u'\n'.join(self._lines) + u'\n'
+        actions = self._actions
+        self._lines = []
+        self._actions = []
+        self._bytes = 0
+        self._slots.acquire()
+        self._pool.apply_async(self._write, (body, actions))
+
+    def close(self):
+        """
+        Send pending actions and wait for all bulk requests
+
+        :return: Stats with number of actions, requests, errors and elapsed seconds
+        """
+        self.flush()
+        self._pool.close()
+        self._pool.join()
+        self.stats['elapsed'] = time.time() - self._start
+        return self.stats
@@ -0,0 +1,94 @@
+import time
+import threading
+from collections import OrderedDict
+
+__author__ = 'jorgealegre'
+
+
+class TTLCache(object):
+    """
+    In-process cache with LRU eviction and time to live for entries
+
+    Used to keep data we would otherwise fetch from ElasticSearch on every request, like field versions.
+    Entries expire lazily when accessed. Thread safe, since uwsgi workers could run with threads.
+    """
+
+    def __init__(self, max_size=1000, ttl=300):
+        """
+        :param max_size: Maximum number of entries, least recently used are evicted
+        :param ttl: Default time to live in seconds
+        :return:
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """
+        Get value for key
+
+        :param key:
+        :param default: Value returned when key not found or expired
+        :return:
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Set value for key
+
+        :param key:
+        :param value:
+        :param ttl: Time to live in seconds for this entry. None uses cache default, 0 never expires
+        :return:
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Delete key
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, predicate):
+        """
+        Delete all keys for which predicate is true
+
+        :param predicate: Callable receiving key
+        :return: Number of keys deleted
+        """
+        with self._lock:
+            keys = filter(predicate, self._data.keys())
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
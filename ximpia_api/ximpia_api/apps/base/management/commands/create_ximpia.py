@@ -1,5 +1,4 @@
 import logging
-import requests
 import json
 import pprint
 import string
@@ -14,9 +13,10 @@ from django.utils.text import slugify
 from django.utils.crypto import get_random_string
 from django.conf import settings
 
-from base import SocialNetworkResolution, refresh_index, create_doc_index
+from base import SocialNetworkResolution
 from base.exceptions import XimpiaAPIException
-from document import to_logical_doc, get_fields_from_mapping, save_field_versions_from_mapping
+from base.provisioning import Provisioning, XIMPIA_DOCUMENT_TYPES, put_index_templates
+from document import to_logical_doc
 
 __author__ = 'jorgealegre'
 
@@ -29,132 +29,29 @@ class Command(BaseCommand):
     help = 'Create document types for Ximpia API'
     can_import_settings = True
 
-    def _create_index(self, index_name, **options):
+    def _create_index(self, provisioning, **options):
         """
-        Create index with document types mappings
+        Register index templates with document types mappings, replacing existing ones, and create indices, at
+        the same time
 
-        :param index_name:
+        :param provisioning:
         :param options:
         :return:
         """
-        from document import get_document_definition_mapping
-        mappings_path = settings.BASE_DIR + 'apps/base/mappings'
-        user_path = settings.BASE_DIR + 'apps/xp_user/mappings'
-        document_path = settings.BASE_DIR + 'apps/document/mappings'
-
-        """with open(settings.BASE_DIR + 'settings/settings_test.json') as f:
-            settings_dict = json.loads(f.read())"""
-
-        with open('{}/site.json'.format(mappings_path)) as f:
-            site_dict = json.loads(f.read())
-
-        with open('{}/account.json'.format(mappings_path)) as f:
-            account_dict = json.loads(f.read())
-
-        with open('{}/urlconf.json'.format(mappings_path)) as f:
-            urlconf_dict = json.loads(f.read())
-
-        with open('{}/app.json'.format(mappings_path)) as f:
-            app_dict = json.loads(f.read())
-
-        with open('{}/settings.json'.format(mappings_path)) as f:
-            settings__dict = json.loads(f.read())
-
-        with open('{}/user.json'.format(user_path)) as f:
-            user_dict = json.loads(f.read())
-
-        with open('{}/group.json'.format(user_path)) as f:
-            group_dict = json.loads(f.read())
-
-        with open('{}/user-group.json'.format(user_path)) as f:
-            user_group_dict = json.loads(f.read())
-
-        with open('{}/permission.json'.format(user_path)) as f:
-            permissions_dict = json.loads(f.read())
-
-        with open('{}/invite.json'.format(user_path)) as f:
-            invite_dict = json.loads(f.read())
-
-        with open('{}/tag.json'.format(document_path)) as f:
-            tag_dict = json.loads(f.read())
-
-        with open('{}/field-version.json'.format(document_path)) as f:
-            field_version_dict = json.loads(f.read())
-
-        with open('{}/session.json'.format(settings.BASE_DIR + 'apps/xp_sessions/mappings')) as f:
-            session_dict = json.loads(f.read())
-
-        # 'document-definition': document_definition_dict,
-        # We need to complete mappings for fields
-        document_definition_dict = get_document_definition_mapping()
-        logger.debug(u'_create_index :: mappings: {}'.format(
-            pprint.PrettyPrinter(indent=4).pformat(document_definition_dict))
-        )
-        create_doc_index(u'{}__document-definition'.format(index_name), document_definition_dict)
-
-        create_doc_index(u'{}__account'.format(index_name), account_dict)
-        create_doc_index(u'{}__site'.format(index_name), site_dict)
-        create_doc_index(u'{}__urlconf'.format(index_name), urlconf_dict)
-        create_doc_index(u'{}__app'.format(index_name), app_dict)
-        create_doc_index(u'{}__settings'.format(index_name), settings__dict)
-        create_doc_index(u'{}__user'.format(index_name), user_dict)
-        create_doc_index(u'{}__group'.format(index_name), group_dict)
-        create_doc_index(u'{}__user-group'.format(index_name), user_group_dict)
-        create_doc_index(u'{}__permission'.format(index_name), permissions_dict)
-        create_doc_index(u'{}__tag'.format(index_name), tag_dict)
-        create_doc_index(u'{}__field-version'.format(index_name), field_version_dict)
-        create_doc_index(u'{}__invite'.format(index_name), invite_dict)
-        create_doc_index(u'{}__session'.format(index_name), session_dict)
-
-        """es_response_raw = requests.post('{}/{}'.format(settings.ELASTIC_SEARCH_HOST, index_name_physical),
-                                        data=json.dumps({
-                                            'settings': settings_dict,
-                                            'mappings': {
-                                                'account': account_dict,
-                                                'site': site_dict,
-                                                'urlconf': urlconf_dict,
-                                                'app': app_dict,
-                                                'settings': settings__dict,
-                                                'user': user_dict,
-                                                'group': group_dict,
-                                                'user-group': user_group_dict,
-                                                'permission': permissions_dict,
-                                                'tag': tag_dict,
-                                                'field-version': field_version_dict,
-                                                'invite': invite_dict,
-                                                'session': session_dict,
-                                            },
-                                            'aliases': {
-                                                alias: {}
-                                            }
-                                        })
-                                        )
-
-        if es_response_raw.status_code != 200:
-            raise XimpiaAPIException(_(u'Error creating index "{}" {}'.format(
-                index_name,
-                es_response_raw.content
-            )))
-        es_response = es_response_raw.json()
-        if not es_response['acknowledged']:
-            raise XimpiaAPIException(_(u'Error creating index "{}"'.format(index_name)))
-        logger.info(u'SetupSite :: created index {} response: {}'.format(
-            index_name,
-            es_response
-        ))
-
+        put_index_templates(XIMPIA_DOCUMENT_TYPES)
+        es_responses = provisioning.create_indices(XIMPIA_DOCUMENT_TYPES)
         if 'verbosity' in options and options['verbosity'] == 2:
             self.stdout.write(u'created indices {} response: {}'.format(
-                index_name,
-                es_response
-            ))"""
+                provisioning.index_name,
+                es_responses
+            ))
 
     @classmethod
-    def _create_tag(cls, index_name, now_es, version=settings.DEFAULT_VERSION):
+    def _create_tag(cls, provisioning, now_es, version=settings.DEFAULT_VERSION):
         """
-        Create tag v1
+        Create tag v1 and field versions for document types
 
-        :param index_name:
+        :param provisioning:
         :param now_es:
         :return:
         """
@@ -166,78 +63,24 @@ class Command(BaseCommand):
             u'tag__public__v1': True,
             u'tag__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
-            '{}/{}__tag'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(tag_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise XimpiaAPIException(_(u'Could not write tag v1 :: {} :: {}'.format(
-                es_response_raw.status_code,
-                es_response_raw.content)))
-        es_response = es_response_raw.json()
+        tag_data['tag__id'] = provisioning.add('tag', tag_data)
         logger.info(u'SetupSite :: created tag "v1" id: {}'.format(
-            es_response.get('_id', '')
+            tag_data['tag__id']
         ))
-        tag_data['tag__id'] = es_response.get('_id', '')
         tag_logical = to_logical_doc('tag', tag_data)
         # field-version
-        # For each mapping: call common method to fetch field data: field, field_name and version
-        # Save all fields for document type
-        mappings_path = settings.BASE_DIR + 'apps/base/mappings'
-        user_path = settings.BASE_DIR + 'apps/xp_user/mappings'
-        document_path = settings.BASE_DIR + 'apps/document/mappings'
-        with open('{}/site.json'.format(mappings_path)) as f:
-            site_dict = json.loads(f.read())
-        with open('{}/account.json'.format(mappings_path)) as f:
-            account_dict = json.loads(f.read())
-        with open('{}/urlconf.json'.format(mappings_path)) as f:
-            urlconf_dict = json.loads(f.read())
-        with open('{}/app.json'.format(mappings_path)) as f:
-            app_dict = json.loads(f.read())
-        with open('{}/settings.json'.format(mappings_path)) as f:
-            settings__dict = json.loads(f.read())
-        with open('{}/user.json'.format(user_path)) as f:
-            user_dict = json.loads(f.read())
-        with open('{}/group.json'.format(user_path)) as f:
-            group_dict = json.loads(f.read())
-        with open('{}/user-group.json'.format(user_path)) as f:
-            user_group_dict = json.loads(f.read())
-        with open('{}/permission.json'.format(user_path)) as f:
-            permissions_dict = json.loads(f.read())
-        with open('{}/invite.json'.format(user_path)) as f:
-            invite_dict = json.loads(f.read())
-        with open('{}/tag.json'.format(document_path)) as f:
-            tag_dict = json.loads(f.read())
-        with open('{}/field-version.json'.format(document_path)) as f:
-            field_version_dict = json.loads(f.read())
-        with open('{}/session.json'.format(settings.BASE_DIR + 'apps/xp_sessions/mappings')) as f:
-            session_dict = json.loads(f.read())
-        with open('{}/document-definition.json'.format(document_path)) as f:
-            document_definition_dict = json.loads(f.read())
-        save_field_versions_from_mapping(account_dict, tag=tag_data)
-        save_field_versions_from_mapping(site_dict, tag=tag_data)
-        save_field_versions_from_mapping(urlconf_dict, tag=tag_data)
-        save_field_versions_from_mapping(app_dict, tag=tag_data)
-        save_field_versions_from_mapping(settings__dict, tag=tag_data)
-        save_field_versions_from_mapping(user_dict, tag=tag_data)
-        save_field_versions_from_mapping(group_dict, tag=tag_data)
-        save_field_versions_from_mapping(user_group_dict, tag=tag_data)
-        save_field_versions_from_mapping(permissions_dict, tag=tag_data)
-        save_field_versions_from_mapping(tag_dict, tag=tag_data)
-        save_field_versions_from_mapping(field_version_dict, tag=tag_data)
-        save_field_versions_from_mapping(invite_dict, tag=tag_data)
-        save_field_versions_from_mapping(session_dict, tag=tag_data)
-        save_field_versions_from_mapping(document_definition_dict, tag=tag_data)
-        refresh_index(index_name)
+        # For each mapping: fetch field data: field, field_name and version
+        provisioning.add_field_versions(XIMPIA_DOCUMENT_TYPES, tag_data)
         return tag_logical
 
     @classmethod
-    def _create_site_app(cls, index_name, site, app, now_es, languages, location, invite_only,
+    def _create_site_app(cls, provisioning, site, app, now_es, languages, location, invite_only,
                          access_token, tag_data, organization_name, public=False, account=None,
                          domains=None):
         """
         Create site, settings and app
 
-        :param index_name:
+        :param provisioning:
         :param site:
         :param app:
         :param now_es:
@@ -254,7 +97,7 @@ class Command(BaseCommand):
         counter = 0
         api_access_key = get_random_string(32, VALID_KEY_CHARS)
         while Document.objects.filter(
-                '{}__site'.format(index_name), **{
+                '{}__site'.format(provisioning.index_name), **{
                     'site__api_access__v1.site__api_access__key__v1': api_access_key
                 }):
             api_access_key = get_random_string(32, VALID_KEY_CHARS)
@@ -285,14 +128,7 @@ class Command(BaseCommand):
                 u'site__invites__created_on__v1': now_es,
                 u'site__invites__updated_on__v1': now_es,
             }
-        es_response_raw = requests.post(
-            '{}/{}__site'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(site_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise XimpiaAPIException(_(u'Could not write site "{}" :: {}'.format(
-                site, es_response_raw.content)))
-        es_response = es_response_raw.json()
-        site_id = es_response.get('_id', '')
+        site_id = provisioning.add('site', site_data)
         logger.info(u'SetupSite :: created site {} id: {}'.format(
             site,
             site_id
@@ -317,14 +153,7 @@ class Command(BaseCommand):
             },
             u'app__created_on__v1': now_es
         }
-        es_response_raw = requests.post(
-            '{}/{}__app'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(app_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise XimpiaAPIException(_(u'Could not write app "{}" :: {}'.format(
-                app, es_response_raw.content)))
-        es_response = es_response_raw.json()
-        app_id = es_response.get('_id', '')
+        app_id = provisioning.add('app', app_data)
         app_data_logical = to_logical_doc('app', app_data)
         app_data_logical['id'] = app_id
         app_data_logical['site']['id'] = site_id
@@ -353,15 +182,8 @@ class Command(BaseCommand):
                 u'settings__setting_name__v1': setting_item[0],
                 u'settings__setting_value__v1': setting_item[1]
             })
-            es_response_raw = requests.post(
-                '{}/{}__settings'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(settings_data))
-            if es_response_raw.status_code not in [200, 201]:
-                raise XimpiaAPIException(_(u'Could not write settings for site "{}" :: {}'.format(
-                    site, es_response_raw.content)))
-            es_response = es_response_raw.json()
             logger.info(u'SetupSite :: created settings id: {}'.format(
-                es_response.get('_id', '')
+                provisioning.add('settings', settings_data)
             ))
             settings_data_logical = to_logical_doc('settings', settings_data)
             settings_output.append(settings_data_logical)
@@ -373,28 +195,22 @@ class Command(BaseCommand):
             u'account__name__v1': account,
             u'account__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
-            '{}/{}__account'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(account_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise XimpiaAPIException(_(u'Could not write account "{}" :: {}'.format(
-                site, es_response_raw.content)))
-        es_response = es_response_raw.json()
+        account_id = provisioning.add('account', account_data)
         logger.info(u'SetupSite :: created account {}'.format(
             account,
         ))
         account_data_logical = to_logical_doc('account', account_data)
-        account_data_logical['id'] = es_response.get('_id', '')
+        account_data_logical['id'] = account_id
 
         return site_data_logical, app_data_logical, settings_output, account_data_logical
 
     @classmethod
-    def _create_permissions(cls, site, app, index_name, now_es):
+    def _create_permissions(cls, provisioning, site, app, now_es):
         """
         Create permission can_admin
 
+        :param provisioning:
         :param app:
-        :param index_name:
         :param now_es:
         :return:
         """
@@ -414,29 +230,22 @@ class Command(BaseCommand):
                 u'permission__data__v1': None,
                 u'permission__created_on__v1': now_es
             }
-            es_response_raw = requests.post(
-                '{}/{}__permission'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(db_permission))
-            if es_response_raw.status_code not in [200, 201]:
-                raise XimpiaAPIException(_(u'Could not write permission "can-admin" :: {}'.format(
-                    es_response_raw.content
-                )))
-            es_response = es_response_raw.json()
+            permission_id = provisioning.add('permission', db_permission)
             logger.info(u'SetupSite :: created permission "can_admin" for app: {} id: {}'.format(
                 app,
-                es_response.get('_id', '')
+                permission_id
             ))
             permission_logical = to_logical_doc('permission', db_permission)
-            permission_logical['id'] = es_response.get('_id', '')
+            permission_logical['id'] = permission_id
             output_permissions.append(permission_logical)
         return output_permissions
 
     @classmethod
-    def _create_user_groups(cls, index_name, groups, social_data, social_network, app_data, now_es):
+    def _create_user_groups(cls, provisioning, groups, social_data, social_network, app_data, now_es):
         """
         Create Groups, User and User mappings to Groups
 
-        :param index_name:
+        :param provisioning:
         :param groups:
         :param social_data:
         :param social_network:
@@ -464,20 +273,13 @@ class Command(BaseCommand):
                         u'group__permissions__created_on__v1': now_es
                     }
                 ]
-            es_response_raw = requests.post(
-                '{}/{}__group'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(group_data))
-            if es_response_raw.status_code not in [200, 201]:
-                raise XimpiaAPIException(_(u'Could not write group "{}" :: {}'.format(
-                    group, es_response_raw.content)))
-            es_response = es_response_raw.json()
+            group_id = provisioning.add('group', group_data)
             logger.info(u'SetupSite :: created group {} id: {}'.format(
                 group,
-                es_response.get('_id', u'')
+                group_id
             ))
-            # group_ids[group] = es_response.get('_id', '')
             group_data_logical = to_logical_doc('group', group_data)
-            group_data_logical['id'] = es_response.get('_id', '')
+            group_data_logical['id'] = group_id
             groups_data_logical[group_data_logical['id']] = group_data_logical
             groups_data.append(group_data_logical)
         logger.debug(u'groups_data : {}'.format(groups_data))
@@ -528,26 +330,18 @@ class Command(BaseCommand):
             },
             u'user__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
-            '{}/{}__user'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(user_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise XimpiaAPIException(_(u'Could not write user "{}.{}" :: {}'.format(
-                social_network,
-                social_data.get('user_id', None),
-                es_response_raw.content)))
-        es_response = es_response_raw.json()
+        user_id = provisioning.add('user', user_data)
         logger.info(u'SetupSite :: created user id: {}'.format(
-            es_response.get('_id', '')
+            user_id
         ))
         user_data_logical = to_logical_doc('user', user_data)
-        user_data_logical['id'] = es_response.get('_id', '')
-        user_data['id'] = es_response.get('_id', '')
+        user_data_logical['id'] = user_id
+        user_data['id'] = user_id
         # users groups
         for group_data in groups_data:
-            es_response_raw = requests.post(
-                '{}/{}__user-group'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps({
+            user_group_id = provisioning.add(
+                'user-group',
+                {
                     u'user__v1': {
                         u'user__id': user_data_logical[u'id'],
                         u'user__username__v1': user_data_logical[u'username'],
@@ -566,15 +360,9 @@ class Command(BaseCommand):
                         u'group__created_on__v1': group_data[u'created_on']
                     },
                     u'user-group__created_on__v1': now_es,
-                }))
-            if es_response_raw.status_code not in [200, 201]:
-                raise XimpiaAPIException(_(u'Could not write user group :: {}'.format(
-                    es_response_raw.content
-                )))
-            es_response = es_response_raw.json()
-            es_response['id'] = es_response.get('_id', '')
+                })
             logger.info(u'SetupSite :: created user group id: {}'.format(
-                es_response.get('_id', '')
+                user_group_id
             ))
         return user_data_logical, groups_data
 
@@ -601,33 +389,35 @@ class Command(BaseCommand):
 
         now_es = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
-        self._create_index(index_name, **options)
+        provisioning = Provisioning(index_name)
+
+        self._create_index(provisioning, **options)
 
-        tag_data = self._create_tag(index_name, now_es)
+        tag_data = self._create_tag(provisioning, now_es)
 
-        site_tuple = self._create_site_app(index_name, site, app, now_es,
+        site_tuple = self._create_site_app(provisioning, site, app, now_es,
                                            languages, location, invite_only,
                                            access_token, tag_data, organization_name,
                                            public=public, account=account, domains=domains)
         site_data, app_data, settings_data, account_data = site_tuple
-        # print 'app_data:', app_data
-        refresh_index(index_name)
 
         # social
-        # login access token for user to use
+        # login access token for user to use. App is not written yet, app access token was cached when we
+        # created app
         social_data = SocialNetworkResolution.get_network_user_data(social_network,
                                                                     access_token=access_token,
                                                                     app_id=app_data['id'],
                                                                     social_app_id=settings.XIMPIA_FACEBOOK_APP_ID)
 
         # 2. Permissions
-        permissions_data = self._create_permissions(site, app, index_name, now_es)
+        permissions_data = self._create_permissions(provisioning, site, app, now_es)
 
         # 3. Groups, User, UserGroup
-        user_data, groups_data = self._create_user_groups(index_name, default_groups, social_data,
+        user_data, groups_data = self._create_user_groups(provisioning, default_groups, social_data,
                                                           social_network, app_data, now_es)
 
-        # refresh_index(index_name)
+        # seed documents in one bulk request and refresh
+        provisioning.write()
 
         if 'verbosity' in options and options['verbosity'] == 2:
             self.stdout.write(u'{}'.format(
@@ -1,7 +1,6 @@
+import copy
 import json
-import requests
 import logging
-from requests.adapters import HTTPAdapter
 
 from django.utils.functional import SimpleLazyObject
 from django.utils.module_loading import import_string
@@ -10,12 +9,8 @@ from django.utils.crypto import constant_time_compare
 from django.http.response import HttpResponseBadRequest
 from django.conf import settings
 
-from document import to_logical_doc
-from base import get_es_response, get_path_search
+from base.routing import route_table_manager
 
-req_session = requests.Session()
-req_session.mount('https://{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=3))
 
 SESSION_KEY = '_auth_user_id'
 BACKEND_SESSION_KEY = '_auth_user_backend'
@@ -32,51 +27,41 @@ def load_backend(path):
     return import_string(path)()
 
 
+class DocumentIdentityMapMiddleware(object):
+    """
+    Keep documents fetched while request runs in document identity map, cleared when request ends
+    """
+
+    @classmethod
+    def process_request(cls, request):
+        from document import identity_map
+        identity_map.begin()
+
+    @classmethod
+    def process_response(cls, request, response):
+        from document import identity_map
+        identity_map.clear()
+        return response
+
+    @classmethod
+    def process_exception(cls, request, exception):
+        from document import identity_map
+        identity_map.clear()
+
+
 class XimpiaUrlsMiddleware(object):
 
     @classmethod
     def process_request(cls, request):
         """
-        Process request to build urls based on stored data
+        Set urls based on stored data
+
+        Route tables are built once for each site and rebuilt only when urlconf documents change
 
         :param request:
         :return:
         """
-        from django.conf.urls import url
-        import urls
-        from document.views import DocumentViewSet
-        # get url data
-        es_response = get_es_response(
-            req_session.get(
-                get_path_search('urlconf'),
-                data=json.dumps({
-                    'query': {
-                        'match_all': {
-                        }
-                    },
-                    'from': 0,
-                    'size': 1000
-                })
-            ))
-        # build django urls
-        my_url_patterns = getattr(urls, 'urlpatterns')
-        for data_db in es_response['hits']['hits']:
-            data = to_logical_doc('urlconf', data_db)
-            for mode in ['create', 'update', 'list', 'get', 'delete']:
-                url_data = dict(map(lambda x: (x['name'], x['value']), data['data']))
-                url_data['site'] = data.get('site', {})
-                url_data['app'] = data.get('app', {})
-                url_data['tag'] = data.get('tag', {})
-                url_data['branch'] = data.get('branch', {})
-                my_url_patterns.append(
-                    url(r'{}'.format(data['url']['raw']),
-                        getattr(DocumentViewSet, mode),
-                        url_data,
-                        name='{}__{}'.format(
-                            data['document_type'],
-                            mode)),
-                )
-        setattr(urls, 'urlpatterns', my_url_patterns)
+        request.urlconf = route_table_manager.get_table(request.META.get('HTTP_HOST', None))
 
 
 class XimpiaRequestMiddleware(object):
@@ -85,26 +70,32 @@ class XimpiaRequestMiddleware(object):
     def get_user(cls, request, token):
         from django.contrib.auth.models import AnonymousUser
         from document import Document
+        from xp_user.backends import user_token_cache
         user = None
         if not token:
             return AnonymousUser()
-        try:
-            user_document = Document.objects.filter('user',
-                                                    **{
-                                                        'user__token__v1.user__token__key__v1': token,
-                                                        'get_logical': True
-                                                    })[0]
-            user = User()
-            user.id = user_document['id']
-            user.email = user_document['email']
-            user.pk = user.id
-            user.username = user.id
-            user.first_name = user_document['first_name']
-            user.last_name = user_document['last_name']
-            user.document = user_document
+        user_document = user_token_cache.get(token)
+        if user_document is None:
+            try:
+                user_document = Document.objects.filter('user',
+                                                        **{
+                                                            'user__token__v1.user__token__key__v1': token,
+                                                            'get_logical': True
+                                                        })[0]
+            except IndexError:
+                user_document = user_token_cache.NOT_FOUND
+            user_token_cache.set(token, user_document)
+        if user_document == user_token_cache.NOT_FOUND:
             return user
-        except IndexError:
-            pass
+        user = User()
+        user.id = user_document['id']
+        user.email = user_document['email']
+        user.pk = user.id
+        user.username = user.id
+        user.first_name = user_document['first_name']
+        user.last_name = user_document['last_name']
+        # cached document is shared by requests in process
+        user.document = copy.deepcopy(user_document)
         return user
 
     @classmethod
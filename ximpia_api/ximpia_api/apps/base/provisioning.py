@@ -0,0 +1,308 @@
+import copy
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+
+from base import exceptions, create_doc_index, refresh_index, get_es_response
+from base.bulk import BulkWriter
+from base.transport import es_session
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+PROVISIONING_WORKERS = getattr(settings, 'PROVISIONING_WORKERS', 8)
+INDEX_TEMPLATE_PREFIX = getattr(settings, 'INDEX_TEMPLATE_PREFIX', 'ximpia_api__base__')
+# index setting with hash of settings and mappings template was registered with
+TEMPLATE_HASH_SETTING = 'ximpia_template_hash'
+
+# (app, document type) having mappings at apps/{app}/mappings/{document type}.json
+SITE_DOCUMENT_TYPES = (
+    ('document', 'document-definition'),
+    ('base', 'urlconf'),
+    ('base', 'app'),
+    ('base', 'settings'),
+    ('xp_user', 'user'),
+    ('xp_user', 'group'),
+    ('xp_user', 'user-group'),
+    ('xp_user', 'permission'),
+    ('document', 'tag'),
+    ('document', 'field-version'),
+    ('xp_user', 'invite'),
+    ('xp_sessions', 'session'),
+)
+# ximpia api base index also keeps accounts and sites
+XIMPIA_DOCUMENT_TYPES = (
+    ('base', 'account'),
+    ('base', 'site'),
+) + SITE_DOCUMENT_TYPES
+
+_files = {}
+_files_lock = threading.Lock()
+# document types having index template up to date in cluster
+_templates = set()
+
+
+def _load(path):
+    """
+    Load json file once per process. Callers must not modify data returned
+
+    :param path:
+    :return:
+    """
+    with _files_lock:
+        if path not in _files:
+            with open(path) as f:
+                _files[path] = json.loads(f.read())
+        return _files[path]
+
+
+def get_index_settings():
+    """
+    Get settings for document indices
+
+    :return:
+    """
+    return _load(settings.BASE_DIR + 'settings/settings_test.json')
+
+
+def get_mapping(app, document_type):
+    """
+    Get mapping for document type in app
+
+    :param app:
+    :param document_type:
+    :return:
+    """
+    return _load(u'{}apps/{}/mappings/{}.json'.format(settings.BASE_DIR, app, document_type))
+
+
+def get_mappings(document_types):
+    """
+    Get mappings for document types, with fields completed for document definitions
+
+    :param document_types: List of (app, document type)
+    :return: Ordered dict document type -> mapping
+    """
+    from document import get_document_definition_mapping
+    mappings = OrderedDict(map(lambda x: (x[1], get_mapping(*x)), document_types))
+    if 'document-definition' in mappings:
+        # We need to complete mappings for fields
+        mappings['document-definition'] = get_document_definition_mapping()
+    return mappings
+
+
+def get_template_name(document_type):
+    return u'{}{}'.format(INDEX_TEMPLATE_PREFIX, document_type)
+
+
+def get_template_hash(mapping):
+    """
+    Get hash for index settings and mapping, changes when settings or mappings files change
+
+    :param mapping:
+    :return:
+    """
+    return hashlib.sha1(json.dumps([get_index_settings(), mapping], sort_keys=True)).hexdigest()
+
+
+def get_index_template(document_type, mapping):
+    """
+    Get index template for document type
+
+    Template matches physical indices for document type in all sites, like "my-site__base__app.01-20-16.10:00:00".
+    Index settings have hash of settings and mapping, so we know when template in cluster is outdated.
+
+    :param document_type:
+    :param mapping:
+    :return:
+    """
+    index_settings = get_index_settings()
+    return {
+        'template': u'*__base__{}.*'.format(document_type),
+        'order': 0,
+        'settings': dict(index_settings,
+                         index=dict(index_settings.get('index', {}),
+                                    **{TEMPLATE_HASH_SETTING: get_template_hash(mapping)})),
+        'mappings': {
+            document_type: mapping,
+        },
+    }
+
+
+def _map(func, items, workers):
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def put_index_templates(document_types, workers=PROVISIONING_WORKERS):
+    """
+    Register index templates for document types, replacing existing ones
+
+    :param document_types: List of (app, document type)
+    :param workers: Templates registered at the same time
+    :return: List of ElasticSearch responses
+    """
+    def put(item):
+        document_type, mapping = item
+        es_response_raw = es_session.put(
+            u'{host}/_template/{name}'.format(
+                host=settings.ELASTIC_SEARCH_HOST,
+                name=get_template_name(document_type)),
+            data=json.dumps(get_index_template(document_type, mapping)))
+        if es_response_raw.status_code not in [200, 201]:
+            raise exceptions.XimpiaAPIException(_(u'Error creating index template "{}" {}'.format(
+                document_type,
+                es_response_raw.content
+            )))
+        _templates.add(document_type)
+        return es_response_raw.json()
+    return _map(put, get_mappings(document_types).items(), workers)
+
+
+def ensure_index_templates(document_types, workers=PROVISIONING_WORKERS):
+    """
+    Register index templates missing in cluster or registered with other settings or mappings, like after a
+    deploy changing mappings. Templates up to date are remembered, so cluster is checked once per process
+
+    :param document_types: List of (app, document type)
+    :param workers:
+    :return:
+    """
+    missing = filter(lambda x: x[1] not in _templates, document_types)
+    if not missing:
+        return
+    es_response = get_es_response(es_session.get(u'{host}/_template/{prefix}*?flat_settings=true'.format(
+        host=settings.ELASTIC_SEARCH_HOST,
+        prefix=INDEX_TEMPLATE_PREFIX)), skip_exception=True)
+    mappings = get_mappings(missing)
+    outdated = []
+    for app, document_type in missing:
+        template = es_response.get(get_template_name(document_type), {})
+        if template.get('settings', {}).get(u'index.{}'.format(TEMPLATE_HASH_SETTING), None) == \
+                get_template_hash(mappings[document_type]):
+            _templates.add(document_type)
+        else:
+            outdated.append((app, document_type))
+    if outdated:
+        put_index_templates(outdated, workers=workers)
+
+
+def get_document_id():
+    """
+    Generate document id, so seed documents can reference each other before being written
+
+    :return:
+    """
+    return uuid.uuid4().hex
+
+
+class Provisioning(object):
+    """
+    Create indices and seed documents for a site
+
+    Mappings and index settings are read from disk once per process and registered as index templates, so indices
+    are created with aliases only, concurrently by a pool of workers. Seed documents get ids when added, so
+    documents can reference each other, and are written in one bulk request followed by a single refresh of
+    indices written.
+
+    provisioning = Provisioning('my-site__base')
+    provisioning.create_indices(SITE_DOCUMENT_TYPES)
+    tag_data['tag__id'] = provisioning.add('tag', tag_data)
+    provisioning.add_field_versions(SITE_DOCUMENT_TYPES, tag_data)
+    provisioning.write()
+    """
+
+    def __init__(self, index_name, workers=PROVISIONING_WORKERS):
+        """
+        :param index_name: Base index for site, like "my-site__base"
+        :param workers: Indices created at the same time
+        :return:
+        """
+        self.index_name = index_name
+        self.workers = workers
+        self._documents = []
+        self._field_versions = set()
+
+    def create_indices(self, document_types):
+        """
+        Create index with alias for each document type, settings and mappings come from index templates
+
+        :param document_types: List of (app, document type)
+        :return: List of ElasticSearch responses
+        """
+        ensure_index_templates(document_types, workers=self.workers)
+        return _map(lambda x: create_doc_index(u'{}__{}'.format(self.index_name, x[1])),
+                    document_types,
+                    self.workers)
+
+    def add(self, document_type, document, index=None):
+        """
+        Add seed document, written with write()
+
+        :param document_type:
+        :param document: Physical document, copied so caller can keep changing it
+        :param index: Base index, default is index for provisioning
+        :return: Document id
+        """
+        id_ = get_document_id()
+        self._documents.append((u'{}__{}'.format(index or self.index_name, document_type),
+                                document_type,
+                                id_,
+                                copy.deepcopy(document)))
+        return id_
+
+    def add_field_versions(self, document_types, tag, index=None):
+        """
+        Add field versions for all fields in mappings of document types
+
+        :param document_types: List of (app, document type)
+        :param tag: Physical tag document
+        :param index: Base index, default is index for provisioning
+        :return:
+        """
+        from document import get_field_version_documents
+        index = index or self.index_name
+        for app, document_type in document_types:
+            for document in get_field_version_documents(get_mapping(app, document_type), tag=tag):
+                self.add('field-version', document, index=index)
+            self._field_versions.add((document_type, index))
+
+    def write(self):
+        """
+        Write seed documents in one bulk request and refresh indices written
+
+        :return: Bulk stats
+        """
+        from document import field_version_registry
+        if not self._documents:
+            return None
+        errors = []
+        writer = BulkWriter(flush_size=len(self._documents), workers=1,
+                            on_items=lambda items: errors.extend(
+                                filter(lambda x: x.values()[0].get('status', 200) >= 300, items)))
+        for index, document_type, id_, document in self._documents:
+            writer.index(index, document_type, id_, document)
+        stats = writer.close()
+        if errors:
+            raise exceptions.XimpiaAPIException(_(u'Could not write seed documents for "{}" :: {}'.format(
+                self.index_name, errors[:10])))
+        refresh_index(u','.join(sorted(set(map(lambda x: x[0], self._documents)))))
+        for document_type, index in self._field_versions:
+            field_version_registry.invalidate(doc_type=document_type, index=index)
+        logger.info(u'Provisioning :: wrote {} documents for {} in {:.2f}s'.format(
+            stats['actions'], self.index_name, stats['elapsed']))
+        self._documents = []
+        self._field_versions = set()
+        return stats
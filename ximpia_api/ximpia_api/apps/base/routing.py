@@ -0,0 +1,329 @@
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import clear_url_caches, RegexURLResolver, Resolver404, ResolverMatch
+from django.utils.encoding import force_text
+
+from base import get_es_response, get_path_search
+from base.transport import es_session
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for changes in urlconf documents
+ROUTES_CHECK_INTERVAL = getattr(settings, 'ROUTES_CHECK_INTERVAL', 5)
+ROUTES_MAX_SIZE = getattr(settings, 'ROUTES_MAX_SIZE', 10000)
+# (url suffix, http method -> DocumentViewSet action, name) routed for each urlconf document. Suffixes
+# for collection actions go before detail, since detail would match them as document id
+ROUTE_MODES = (
+    ('', {'get': 'list', 'post': 'create'}, 'list'),
+    ('/export', {'get': 'export'}, 'export'),
+    ('/_bulk', {'post': 'ingest'}, 'ingest'),
+    ('/([^/]+)', {'get': 'retrieve', 'put': 'update', 'delete': 'destroy'}, 'detail'),
+)
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]|()'
+REGEX_QUANTIFIERS = '*+?{'
+
+
+def get_route_regex(regex, suffix):
+    """
+    Get regex for route with suffix appended to url regex
+
+    get_route_regex(r'^v1/books/$', '/export') -> r'^v1/books/export/?$'
+
+    :param regex: Url regex for collection
+    :param suffix:
+    :return:
+    """
+    return u'{}{}/?$'.format(regex.rstrip('$').rstrip('/'), suffix)
+
+
+def get_literal_segments(regex):
+    """
+    Get complete path segments regex always starts with
+
+    r'^v1/books/(?P<id>\w+)$' -> ['v1', 'books']
+    r'^v1/books$' -> ['v1']
+
+    :param regex: Url regex
+    :return: List of segments
+    """
+    if '|' in regex or not regex.startswith('^'):
+        return []
+    literal = []
+    i = 1
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            if i + 1 >= len(regex) or regex[i + 1].isalnum():
+                break
+            char = regex[i + 1]
+            i += 1
+        elif char in REGEX_SPECIAL_CHARS:
+            break
+        if i + 1 < len(regex) and regex[i + 1] in REGEX_QUANTIFIERS:
+            break
+        literal.append(char)
+        i += 1
+    return ''.join(literal).split('/')[:-1]
+
+
+class TrieURLResolver(RegexURLResolver):
+    """
+    Resolver with a trie of literal path segments in front of url regexes
+
+    Url patterns are placed in trie by complete segments their regex starts with, so resolving "v1/books/12"
+    only tries patterns starting with "", "v1/" and "v1/books/" instead of all patterns. Candidates are tried in
+    same order they were declared, so resolution is same as for a flat url list.
+    """
+
+    def __init__(self, url_patterns, default_kwargs=None):
+        """
+        :param url_patterns: List of url patterns
+        :param default_kwargs:
+        :return:
+        """
+        super(TrieURLResolver, self).__init__(r'^', url_patterns, default_kwargs=default_kwargs)
+        self._trie = {}
+        for index, pattern in enumerate(url_patterns):
+            node = self._trie
+            for segment in get_literal_segments(pattern.regex.pattern):
+                node = node.setdefault(segment, {})
+            node.setdefault(None, []).append((index, pattern))
+
+    def get_candidates(self, path):
+        """
+        Get url patterns that could match path
+
+        :param path:
+        :return: List of url patterns
+        """
+        node = self._trie
+        candidates = list(node.get(None, []))
+        for segment in path.split('/')[:-1]:
+            node = node.get(segment)
+            if node is None:
+                break
+            candidates.extend(node.get(None, []))
+        return map(lambda x: x[1], sorted(candidates, key=lambda x: x[0]))
+
+    def resolve(self, path):
+        path = force_text(path)
+        tried = []
+        match = self.regex.search(path)
+        if match:
+            new_path = path[match.end():]
+            for pattern in self.get_candidates(new_path):
+                try:
+                    sub_match = pattern.resolve(new_path)
+                except Resolver404:
+                    tried.append([pattern])
+                else:
+                    if sub_match:
+                        sub_match_dict = dict(match.groupdict(), **self.default_kwargs)
+                        sub_match_dict.update(sub_match.kwargs)
+                        return ResolverMatch(
+                            sub_match.func,
+                            sub_match.args,
+                            sub_match_dict,
+                            sub_match.url_name,
+                            self.app_name or sub_match.app_name,
+                            [self.namespace] + sub_match.namespaces
+                        )
+                    tried.append([pattern])
+            raise Resolver404({'tried': tried, 'path': new_path})
+        raise Resolver404({'path': path})
+
+
+class RouteTable(object):
+    """
+    Compiled urlconf, used as request.urlconf
+
+    Has static urls from urls module and a TrieURLResolver with dynamic urls from urlconf documents for a site.
+    Tables are never modified, new tables are built when urlconf documents change.
+    """
+
+    def __init__(self, urlpatterns, signature=None, site=None):
+        """
+        :param urlpatterns: List of url patterns
+        :param signature: Signature of urlconf documents used to build table
+        :param site: Site slug, None for urls common to all sites
+        :return:
+        """
+        self.urlpatterns = urlpatterns
+        self.signature = signature
+        self.site = site
+
+
+class RouteTableManager(object):
+    """
+    Keeps route tables for process, one for each site host
+
+    Tables are built on first request and rebuilt only when urlconf documents change. We check for changes at most
+    every ROUTES_CHECK_INTERVAL seconds with a search of size 0, comparing number of documents and last
+    _timestamp. Requests keep using current tables while new ones are built and tables are swapped in one
+    assignment.
+    """
+
+    def __init__(self, check_interval=ROUTES_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._tables = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_signature(cls):
+        """
+        Get signature for urlconf documents: number of documents and last time any was written
+
+        :return: (total, timestamp)
+        """
+        es_response = get_es_response(
+            es_session.get(
+                get_path_search('urlconf', query_cache=False),
+                data=json.dumps({
+                    'size': 0,
+                    'aggs': {
+                        'updated': {
+                            'max': {
+                                'field': '_timestamp'
+                            }
+                        }
+                    }
+                })
+            ))
+        return es_response['hits']['total'], es_response['aggregations']['updated']['value']
+
+    @classmethod
+    def get_document_url_patterns(cls, data):
+        """
+        Get url patterns for urlconf document, one for each route mode
+
+        :param data: Logical urlconf document
+        :return: List of url patterns
+        """
+        from django.conf.urls import url
+        from document.views import DocumentViewSet
+        url_data = dict(map(lambda x: (x['name'], x['value']), data['data']))
+        url_data['site'] = data.get('site', {})
+        url_data['app'] = data.get('app', {})
+        url_data['tag'] = data.get('tag', {})
+        url_data['branch'] = data.get('branch', {})
+        return map(lambda x: url(get_route_regex(data['url']['raw'], x[0]),
+                                 DocumentViewSet.as_view(x[1], document_type=data['document_type']),
+                                 dict(url_data),
+                                 name='{}__{}'.format(
+                                     data['document_type'],
+                                     x[2])),
+                   ROUTE_MODES)
+
+    @classmethod
+    def get_url_patterns(cls):
+        """
+        Get url patterns from urlconf documents, grouped by site
+
+        :return: Dictionary site slug -> list of url patterns. Urls without site have None key.
+        """
+        from document import to_logical_docs
+        es_response = get_es_response(
+            es_session.get(
+                get_path_search('urlconf'),
+                data=json.dumps({
+                    'query': {
+                        'match_all': {
+                        }
+                    },
+                    'from': 0,
+                    'size': ROUTES_MAX_SIZE
+                })
+            ))
+        url_patterns = {}
+        for data in to_logical_docs('urlconf', es_response['hits']['hits']):
+            url_patterns.setdefault(data.get('site', {}).get('slug', None), []).extend(
+                cls.get_document_url_patterns(data))
+        return url_patterns
+
+    @classmethod
+    def build(cls, signature=None):
+        """
+        Build route tables
+
+        :param signature:
+        :return: Dictionary site slug -> RouteTable. Table for None key is used for other hosts.
+        """
+        import urls
+        url_patterns = cls.get_url_patterns()
+        common_patterns = url_patterns.pop(None, [])
+        tables = {
+            None: RouteTable(list(urls.urlpatterns) + [TrieURLResolver(common_patterns)], signature=signature)
+        }
+        for site, site_patterns in url_patterns.iteritems():
+            tables[site] = RouteTable(list(urls.urlpatterns) + [TrieURLResolver(site_patterns + common_patterns)],
+                                      signature=signature,
+                                      site=site)
+        logger.info(u'RouteTableManager :: built {} route tables signature: {}'.format(
+            len(tables), signature
+        ))
+        return tables
+
+    @classmethod
+    def get_host_site(cls, host):
+        """
+        Get site slug from host, like "my-site" for "my-site.ximpia.io"
+
+        :param host:
+        :return:
+        """
+        if not host:
+            return None
+        return host.split(':')[0].split('.' + settings.XIMPIA_DOMAIN)[0]
+
+    def get_tables(self):
+        """
+        Get route tables, building them when urlconf documents changed
+
+        Only one thread checks for changes, other threads keep using current tables meanwhile. Threads wait only
+        when there are no tables yet.
+
+        :return: Dictionary site slug -> RouteTable
+        """
+        if self._tables is not None and time.time() - self._checked_at < self.check_interval:
+            return self._tables
+        if self._tables is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(False):
+            return self._tables
+        try:
+            if self._tables is not None and time.time() - self._checked_at < self.check_interval:
+                return self._tables
+            try:
+                signature = self.get_signature()
+                if self._tables is None or signature != self._tables[None].signature:
+                    self._tables = self.build(signature)
+                    # resolvers for old tables are not used anymore
+                    clear_url_caches()
+            except Exception:
+                if self._tables is None:
+                    raise
+                logger.exception(u'RouteTableManager :: could not check routes, using current tables')
+            self._checked_at = time.time()
+        finally:
+            self._lock.release()
+        return self._tables
+
+    def get_table(self, host=None):
+        """
+        Get route table for host
+
+        :param host: Request host, like "my-site.ximpia.io"
+        :return: RouteTable
+        """
+        tables = self.get_tables()
+        return tables.get(self.get_host_site(host), tables[None])
+
+
+route_table_manager = RouteTableManager()
@@ -0,0 +1,178 @@
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from base import get_es_response, get_path_search, get_setting_table_value, get_setting_value
+from base.cache import TTLCache
+from base.transport import es_session
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for changes in settings documents
+SETTINGS_CHECK_INTERVAL = getattr(settings, 'SETTINGS_CHECK_INTERVAL', 5)
+SETTINGS_CACHE_SIZE = getattr(settings, 'SETTINGS_CACHE_SIZE', 1000)
+SETTINGS_DOCUMENT_TYPE = '_settings'
+
+
+class SettingsSnapshot(object):
+    """
+    Immutable settings for site and app
+
+    Settings from settings documents are read as attributes or items, other attributes are read from django
+    settings:
+
+    request.site_settings.MY_SETTING
+    request.site_settings.ELASTIC_SEARCH_HOST
+    """
+
+    __slots__ = ('site_slug', 'app_id', '_values')
+
+    def __init__(self, site_slug, app_id, values):
+        """
+        :param site_slug:
+        :param app_id:
+        :param values: Dictionary setting name -> value
+        :return:
+        """
+        object.__setattr__(self, 'site_slug', site_slug)
+        object.__setattr__(self, 'app_id', app_id)
+        object.__setattr__(self, '_values', dict(values))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            return getattr(settings, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(u'Settings snapshot is read only')
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    def items(self):
+        return self._values.items()
+
+
+class SiteSettingsManager(object):
+    """
+    Process-wide cache of settings snapshots for (site, app)
+
+    Every check_interval seconds we check signature for settings documents, number of documents and last time any
+    was written, in one request. Snapshots are only loaded again when signature changes or they are invalidated.
+    """
+
+    def __init__(self, check_interval=SETTINGS_CHECK_INTERVAL, max_size=SETTINGS_CACHE_SIZE):
+        self.check_interval = check_interval
+        self._snapshots = TTLCache(max_size=max_size, ttl=0)
+        self._signature = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_signature(cls):
+        """
+        Get signature for settings documents: number of documents and last time any was written
+
+        :return: (total, timestamp)
+        """
+        es_response = get_es_response(
+            es_session.get(
+                get_path_search(SETTINGS_DOCUMENT_TYPE, index=SETTINGS_DOCUMENT_TYPE, query_cache=False),
+                data=json.dumps({
+                    'size': 0,
+                    'aggs': {
+                        'updated': {
+                            'max': {
+                                'field': '_timestamp'
+                            }
+                        }
+                    }
+                })
+            ))
+        return es_response['hits']['total'], es_response['aggregations']['updated']['value']
+
+    @classmethod
+    def load(cls, site_slug, app_id):
+        """
+        Load settings snapshot from settings documents
+
+        :param site_slug:
+        :param app_id:
+        :return: SettingsSnapshot
+        """
+        from document import Document
+        values = {}
+        for setting_doc in Document.objects.filter(SETTINGS_DOCUMENT_TYPE,
+                                                   site__slug__raw=site_slug,
+                                                   app__id=app_id,
+                                                   get_logical=True):
+            if setting_doc.get('fields', None):
+                values[setting_doc['name']] = get_setting_table_value(setting_doc['fields'])
+            else:
+                values[setting_doc['name']] = get_setting_value(setting_doc['value'])
+        logger.debug(u'SiteSettingsManager :: loaded {} settings site: {} app: {}'.format(
+            len(values), site_slug, app_id
+        ))
+        return SettingsSnapshot(site_slug, app_id, values)
+
+    def check(self):
+        """
+        Drop snapshots when settings documents changed
+
+        :return:
+        """
+        if time.time() - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if time.time() - self._checked_at < self.check_interval:
+                return
+            try:
+                signature = self.get_signature()
+                if signature != self._signature:
+                    self._snapshots.clear()
+                    self._signature = signature
+            except Exception:
+                logger.exception(u'SiteSettingsManager :: could not check settings, using current snapshots')
+            self._checked_at = time.time()
+
+    def get(self, site_slug, app_id):
+        """
+        Get settings snapshot for site and app
+
+        :param site_slug:
+        :param app_id:
+        :return: SettingsSnapshot
+        """
+        self.check()
+        key = (site_slug, app_id)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = self.load(site_slug, app_id)
+            self._snapshots.set(key, snapshot)
+        return snapshot
+
+    def invalidate(self, site_slug=None, app_id=None):
+        """
+        Load snapshots again on next request, like after writing settings documents. No site or app invalidates all
+
+        :param site_slug:
+        :param app_id:
+        :return:
+        """
+        self._snapshots.delete_many(lambda key: (site_slug is None or key[0] == site_slug)
+                                    and (app_id is None or key[1] == app_id))
+
+
+site_settings_manager = SiteSettingsManager()
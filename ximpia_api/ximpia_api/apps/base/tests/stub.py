@@ -0,0 +1,143 @@
+import json
+import re
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from base.tests import XimpiaTestCase
+
+__author__ = 'jorgealegre'
+
+
+class StubRequest(object):
+    """
+    Request received by stub server
+    """
+
+    def __init__(self, method, path, body):
+        self.method = method
+        self.path = path
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests with first route of server matching method and path, records requests in server
+    """
+
+    def _handle(self):
+        request = StubRequest(self.command, self.path,
+                              self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        self.server.requests.append(request)
+        status, data = 404, {'error': u'No route for {} {}'.format(request.method, request.path)}
+        for method, pattern, response in self.server.routes:
+            if method in (None, request.method) and re.search(pattern, request.path):
+                status, data = 200, response(request) if callable(response) else response
+                if isinstance(data, tuple):
+                    status, data = data
+                break
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data))
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(HTTPServer):
+    """
+    HTTP server answering each request in a thread, so concurrent requests overlap
+    """
+
+    # requests from pools connect at the same time
+    request_queue_size = 32
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.finish_and_close, args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def finish_and_close(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class ElasticSearchStub(object):
+    """
+    Local stand-in for ElasticSearch answering canned responses
+
+    Routes are (method, path regex, response) and first route matching answers. Method None matches any method.
+    Response is data sent as json, or a callable receiving StubRequest and returning data or (status, data).
+    Requests not matching any route get 404.
+
+    stub = ElasticSearchStub([
+        ('GET', r'^/_mget', lambda request: {'docs': []}),
+    ])
+    with self.settings(ELASTIC_SEARCH_HOST=stub.start()):
+        ...
+    stub.stop()
+    """
+
+    def __init__(self, routes):
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.routes = routes
+        self.server.requests = []
+        self.thread = None
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def get_requests(self, method=None, pattern=None):
+        """
+        Get requests received, in order
+
+        :param method: Method, None for all
+        :param pattern: Path regex, None for all
+        :return: List of StubRequest
+        """
+        return filter(lambda x: method in (None, x.method) and (pattern is None or re.search(pattern, x.path)),
+                      self.server.requests)
+
+    def start(self):
+        """
+        Start server in a daemon thread
+
+        :return: Host, like "http://127.0.0.1:51234"
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ElasticSearchStubTestCase(XimpiaTestCase):
+    """
+    Test case with ElasticSearch stub started for each test at self.host, answering routes from get_routes()
+    """
+
+    def get_routes(self):
+        return []
+
+    def setUp(self):
+        super(ElasticSearchStubTestCase, self).setUp()
+        self.stub = ElasticSearchStub(self.get_routes())
+        self.host = self.stub.start()
+
+    def tearDown(self):
+        self.stub.stop()
+        super(ElasticSearchStubTestCase, self).tearDown()
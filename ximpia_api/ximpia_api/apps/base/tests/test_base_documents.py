@@ -0,0 +1,85 @@
+import json
+
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+class BaseDocumentCacheTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers _msearch for base apps and version gets, with documents at self.version
+    """
+
+    version = 1
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_msearch', self._msearch),
+            ('GET', r'', lambda request: {'_id': request.path.split('/')[3].split('?')[0], 'found': True,
+                                          '_version': self.version}),
+            ('POST', r'', lambda request: {'_id': 'app-my-site', '_version': self.version + 1}),
+        ]
+
+    def _get_hit(self, site_slug):
+        return {
+            '_index': '{}__base'.format(site_slug),
+            '_type': 'app',
+            '_id': 'app-{}'.format(site_slug),
+            '_version': self.version,
+            '_source': {'app__slug__v1': 'base'}
+        }
+
+    def _msearch(self, request):
+        responses = []
+        for line in request.body.splitlines()[::2]:
+            site_slug = json.loads(line)['index'].split('__')[0]
+            responses.append({'hits': {'hits': [self._get_hit(site_slug)]}})
+        return {'responses': responses}
+
+    def setUp(self):
+        from base import base_document_cache
+        base_document_cache.invalidate()
+        super(BaseDocumentCacheTest, self).setUp()
+
+    def tearDown(self):
+        from base import base_document_cache
+        base_document_cache.invalidate()
+        base_document_cache.ttl = 60
+        super(BaseDocumentCacheTest, self).tearDown()
+
+    def _get_requests(self, pattern):
+        return map(lambda x: x.path, self.stub.get_requests(pattern=pattern))
+
+    def test_cached(self):
+        from base import get_base_app, get_base_apps
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            app = get_base_app('my-site')
+            self.assertTrue(app['id'] == 'app-my-site')
+            get_base_app('my-site')
+            # only missing site is searched
+            apps = get_base_apps('my-site', 'other-site')
+            self.assertTrue(map(lambda x: x['id'], apps) == ['app-my-site', 'app-other-site'])
+        self.assertTrue(len(self.stub.requests) == 2)
+
+    def test_revalidate(self):
+        from base import get_base_app, base_document_cache
+        base_document_cache.ttl = 0
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            get_base_app('my-site')
+            get_base_app('my-site')
+            self.assertTrue(len(self._get_requests('_msearch')) == 1)
+            self.assertTrue(self._get_requests(r'\?_source=false') == ['/my-site__base/app/app-my-site?_source=false'])
+            # version changed, we search again
+            self.version = 2
+            get_base_app('my-site')
+            self.assertTrue(len(self._get_requests('_msearch')) == 2)
+
+    def test_invalidate_on_update(self):
+        from base import get_base_app
+        from document import Document
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            get_base_app('my-site')
+            Document.objects.update_partial('app', 'app-my-site', {'app__name__v1': 'Other name'},
+                                            index='my-site__base')
+            get_base_app('my-site')
+        self.assertTrue(len(self._get_requests('_msearch')) == 2)
@@ -0,0 +1,84 @@
+import json
+
+from base.tests.stub import ElasticSearchStubTestCase
+from base.bulk import scroll, BulkWriter
+
+__author__ = 'jorgealegre'
+
+
+def get_page(number, pages=3):
+    hits = []
+    if number < pages:
+        hits = [{'_index': 'my-index', '_type': 'session', '_id': '{}-{}'.format(number, x)} for x in range(2)]
+    return {'_scroll_id': str(number + 1), 'hits': {'hits': hits}}
+
+
+def get_bulk_items(request):
+    items = []
+    for line in request.body.splitlines():
+        action = json.loads(line)
+        if 'index' in action or 'delete' in action:
+            op, meta = action.items()[0]
+            items.append({op: {'_id': meta.get('_id', 'generated'), 'status': 201 if op == 'index' else 200}})
+    return {'errors': False, 'items': items}
+
+
+class BulkTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers scroll with 3 pages of 2 hits and bulk requests
+    """
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_search/scroll', lambda request: get_page(int(request.body))),
+            ('GET', r'/_search', get_page(0)),
+            ('POST', r'^/_bulk', get_bulk_items),
+            ('DELETE', r'^/_search/scroll', {'succeeded': True}),
+        ]
+
+    def _get_bulk_bodies(self):
+        return map(lambda x: x.body, self.stub.get_requests('POST', r'^/_bulk'))
+
+    def test_scroll(self):
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            pages = list(scroll('{}/my-index/session/_search'.format(self.host), {'query': {'match_all': {}}}))
+        self.assertTrue(len(pages) == 3)
+        self.assertTrue(pages[2][1]['_id'] == '2-1')
+        # last scroll id is cleared
+        self.assertTrue(map(lambda x: x.body, self.stub.get_requests('DELETE')) == ['4'])
+
+    def test_bulk_writer(self):
+        progress = []
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            writer = BulkWriter(flush_size=2, workers=2, progress=progress.append)
+            for x in range(5):
+                writer.delete('my-index', 'session', str(x))
+            stats = writer.close()
+        self.assertTrue(stats['actions'] == 5 and stats['requests'] == 3 and stats['errors'] == 0)
+        self.assertTrue(len(progress) == 3)
+        lines = ''.join(self._get_bulk_bodies()).splitlines()
+        self.assertTrue(len(lines) == 5)
+        self.assertTrue(sorted(map(lambda x: json.loads(x)['delete']['_id'], lines)) == map(str, range(5)))
+
+    def test_flush_bytes(self):
+        items = []
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            writer = BulkWriter(flush_size=100, workers=1, flush_bytes=200, on_items=items.extend)
+            for x in range(4):
+                writer.index('my-index', 'book', str(x), {'book__title__v1': 'x' * 50})
+            writer.index('my-index', 'book', None, {'book__title__v1': 'no id'})
+            stats = writer.close()
+        # each action with document is about 130 bytes
+        self.assertTrue(stats['actions'] == 5 and stats['requests'] == 5)
+        self.assertTrue(sorted(map(lambda x: x['index']['_id'], items)) == ['0', '1', '2', '3', 'generated'])
+        self.assertTrue(all(map(lambda x: len(x) <= 200 or len(x.splitlines()) == 2,
+                                self._get_bulk_bodies())))
+
+    def test_error_items(self):
+        items = []
+        with self.settings(ELASTIC_SEARCH_HOST='http://127.0.0.1:1'):
+            writer = BulkWriter(flush_size=2, workers=1, on_items=items.extend)
+            writer.delete('my-index', 'session', 'my-id')
+            stats = writer.close()
+        self.assertTrue(stats['errors'] == 1)
+        self.assertTrue(items[0]['delete']['_id'] == 'my-id' and items[0]['delete']['status'] == 500)
@@ -0,0 +1,46 @@
+import time
+
+from base.tests import XimpiaTestCase
+from base.cache import TTLCache
+
+__author__ = 'jorgealegre'
+
+
+class TTLCacheTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_set(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set('key', 'value')
+        self.assertTrue(cache.get('key') == 'value')
+        self.assertTrue(cache.get('other') is None)
+        self.assertTrue('key' in cache)
+
+    def test_expire(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set('key', 'value', ttl=0.01)
+        time.sleep(0.02)
+        self.assertTrue(cache.get('key') is None)
+
+    def test_lru(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue(cache.get('a') == 1)
+        self.assertTrue(cache.get('b') is None)
+        self.assertTrue(len(cache) == 2)
+
+    def test_delete_many(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set(('ximpia-api__base', 'user', 'v1', None), [])
+        cache.set(('ximpia-api__base', 'app', 'v1', None), [])
+        cache.set(('my-site__base', 'user', 'v1', None), [])
+        self.assertTrue(cache.delete_many(lambda key: key[1] == 'user') == 2)
+        self.assertTrue(len(cache) == 1)
@@ -0,0 +1,150 @@
+import json
+import time
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+import base
+from base import SocialNetworkResolution
+from base.tests import XimpiaTestCase
+from base.tests.stub import ThreadedHTTPServer, ElasticSearchStub
+
+__author__ = 'jorgealegre'
+
+
+class GraphAPIStubHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for Facebook Graph API, answers oauth, debug_token, me and picture and records paths called
+
+    With overlap_timeout, me and picture wait up to that many seconds for each other, so max_in_flight is 2 only
+    when they were requested at the same time
+    """
+
+    calls = []
+    expires_at = 0
+    overlap_timeout = 0.0
+    in_flight = 0
+    max_in_flight = 0
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def _wait_overlap(self):
+        cls = GraphAPIStubHandler
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            if cls.in_flight == 2:
+                cls.overlapped.set()
+        cls.overlapped.wait(self.overlap_timeout)
+        with cls.lock:
+            cls.in_flight -= 1
+
+    def _send(self, data, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(data) if data is not None else '')
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        self.calls.append(path)
+        if path == '/oauth/access_token':
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write('access_token=app-token')
+        elif path.endswith('/debug_token'):
+            self._send({
+                'data': {
+                    'app_id': 'social-app-id',
+                    'is_valid': True,
+                    'expires_at': self.expires_at,
+                    'scopes': ['email'],
+                    'user_id': '1207059',
+                }
+            })
+        elif path.endswith('/me'):
+            self._wait_overlap()
+            self._send({'email': 'john@ximpia.io', 'name': 'John Smith', 'link': 'https://facebook.com/john'})
+        elif path.endswith('/picture'):
+            self._wait_overlap()
+            self._send(None, status=302, headers={'Location': 'https://cdn.facebook.com/john.jpg'})
+        else:
+            self._send({}, status=404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FacebookTest(XimpiaTestCase):
+
+    def setUp(self):
+        GraphAPIStubHandler.calls = []
+        GraphAPIStubHandler.expires_at = 0
+        GraphAPIStubHandler.overlap_timeout = 0.0
+        GraphAPIStubHandler.in_flight = 0
+        GraphAPIStubHandler.max_in_flight = 0
+        GraphAPIStubHandler.overlapped = threading.Event()
+        base.app_access_token_cache.clear()
+        base.social_token_cache.clear()
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), GraphAPIStubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.graph_url = base.FACEBOOK_GRAPH_URL
+        base.FACEBOOK_GRAPH_URL = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        base.FACEBOOK_GRAPH_URL = self.graph_url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _process(self, access_token='user-token'):
+        return SocialNetworkResolution._process_facebook(
+            app={'social': {'facebook': {'access_token': 'app-token'}}},
+            app_id='my-app',
+            social_app_id='social-app-id',
+            access_token=access_token)
+
+    def test_user_data(self):
+        user_data = self._process()
+        self.assertTrue(user_data['user_id'] == '1207059')
+        self.assertTrue(user_data['email'] == 'john@ximpia.io')
+        self.assertTrue(user_data['profile_picture'] == 'https://cdn.facebook.com/john.jpg')
+
+    def test_user_token_cache(self):
+        self._process()
+        self.assertTrue(len(GraphAPIStubHandler.calls) == 3)
+        user_data = self._process()
+        self.assertTrue(len(GraphAPIStubHandler.calls) == 3)
+        self.assertTrue(user_data['email'] == 'john@ximpia.io')
+        self._process(access_token='other-user-token')
+        self.assertTrue(len(GraphAPIStubHandler.calls) == 6)
+
+    def test_user_token_expired(self):
+        GraphAPIStubHandler.expires_at = int(time.time()) - 10
+        self._process()
+        self._process()
+        self.assertTrue(len(filter(lambda x: x.endswith('/debug_token'), GraphAPIStubHandler.calls)) == 2)
+
+    def test_concurrent_calls(self):
+        GraphAPIStubHandler.overlap_timeout = 2.0
+        self._process()
+        # me and picture were in flight at the same time
+        self.assertTrue(GraphAPIStubHandler.max_in_flight == 2)
+
+    def test_app_access_token_cache(self):
+        stub = ElasticSearchStub([
+            ('GET', r'', (404, {'_id': 'not-existing-app', 'found': False})),
+        ])
+        try:
+            with self.settings(ELASTIC_SEARCH_HOST=stub.start()):
+                for x in range(2):
+                    self.assertTrue(SocialNetworkResolution._get_app_access_token(
+                        'not-existing-app', 'social-app-id', 'social-app-secret') == 'app-token')
+        finally:
+            stub.stop()
+        self.assertTrue(GraphAPIStubHandler.calls.count('/oauth/access_token') == 1)
+        # app not found is read once, then token is cached
+        self.assertTrue(len(stub.requests) == 1)
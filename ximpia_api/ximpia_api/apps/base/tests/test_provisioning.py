@@ -0,0 +1,144 @@
+import json
+import time
+
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+def flatten(settings, prefix=''):
+    flat = {}
+    for key, value in settings.iteritems():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix=u'{}{}.'.format(prefix, key)))
+        else:
+            flat[u'{}{}'.format(prefix, key)] = value
+    return flat
+
+
+def get_bulk_items(request):
+    items = map(lambda x: {'index': {'_id': json.loads(x)['index']['_id'], 'status': 201}},
+                request.body.splitlines()[::2])
+    return {'errors': False, 'items': items}
+
+
+class ProvisioningTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers index templates, index creation taking self.delay, bulk and refresh requests
+    """
+
+    delay = 0.0
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_template/', lambda request: self.templates),
+            ('PUT', r'^/_template/', self._put_template),
+            ('POST', r'^/_bulk', get_bulk_items),
+            ('POST', r'/_refresh$', {'_shards': {}}),
+            ('POST', r'', self._create_index),
+        ]
+
+    def _put_template(self, request):
+        template = request.json()
+        # templates are returned with flat settings
+        template['settings'] = flatten(template['settings'])
+        self.templates[request.path.split('/')[-1]] = template
+        return {'acknowledged': True}
+
+    def _create_index(self, request):
+        time.sleep(self.delay)
+        return {'acknowledged': True}
+
+    def setUp(self):
+        from base import provisioning
+        provisioning._templates.clear()
+        self.templates = {}
+        super(ProvisioningTest, self).setUp()
+
+    def _get_requests(self, path):
+        return filter(lambda x: x.path == path, self.stub.requests)
+
+    def test_mappings_loaded_once(self):
+        from base.provisioning import get_mapping, get_index_settings
+        self.assertTrue(get_mapping('base', 'app') is get_mapping('base', 'app'))
+        self.assertTrue(get_mapping('base', 'app').keys() == ['app'])
+        self.assertTrue(get_index_settings() is get_index_settings())
+
+    def test_templates(self):
+        from base.provisioning import ensure_index_templates, put_index_templates, XIMPIA_DOCUMENT_TYPES, \
+            SITE_DOCUMENT_TYPES
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            put_index_templates(XIMPIA_DOCUMENT_TYPES)
+            template = self.templates['ximpia_api__base__app']
+            self.assertTrue(template['template'] == '*__base__app.*')
+            self.assertTrue(template['mappings'].keys() == ['app'])
+            self.assertTrue('fields__v1' in
+                            self.templates['ximpia_api__base__document-definition']['mappings']
+                            ['document-definition']['document-definition']['properties'])
+            del self.stub.requests[:]
+            # registered in this process
+            ensure_index_templates(SITE_DOCUMENT_TYPES)
+            self.assertTrue(self.stub.requests == [])
+            # registered in cluster by other process
+            from base import provisioning
+            provisioning._templates.clear()
+            ensure_index_templates(SITE_DOCUMENT_TYPES)
+            self.assertTrue(map(lambda x: x.path, self.stub.requests) ==
+                            ['/_template/ximpia_api__base__*?flat_settings=true'])
+            # registered with other mappings, like before deploy
+            self.templates['ximpia_api__base__app']['settings']['index.ximpia_template_hash'] = 'old-hash'
+            del self.stub.requests[:]
+            provisioning._templates.clear()
+            ensure_index_templates(SITE_DOCUMENT_TYPES)
+            self.assertTrue(map(lambda x: (x.method, x.path), self.stub.requests) == [
+                ('GET', '/_template/ximpia_api__base__*?flat_settings=true'),
+                ('PUT', '/_template/ximpia_api__base__app'),
+            ])
+            self.assertTrue(self.templates['ximpia_api__base__app']['settings']['index.ximpia_template_hash'] !=
+                            'old-hash')
+
+    def test_create_indices(self):
+        from base.provisioning import Provisioning, SITE_DOCUMENT_TYPES
+        self.delay = 0.2
+        provisioning = Provisioning('my-site__base', workers=len(SITE_DOCUMENT_TYPES))
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            start = time.time()
+            provisioning.create_indices(SITE_DOCUMENT_TYPES)
+            elapsed = time.time() - start
+        self.assertTrue(len(self.templates) == len(SITE_DOCUMENT_TYPES))
+        indices = filter(lambda x: x.path.startswith('/my-site__base__'), self.stub.requests)
+        self.assertTrue(len(indices) == len(SITE_DOCUMENT_TYPES))
+        # indices created at the same time
+        self.assertTrue(elapsed < 0.2 * len(SITE_DOCUMENT_TYPES) / 2)
+        # settings and mappings come from templates
+        self.assertTrue(all(map(lambda x: x.json().keys() == ['aliases'], indices)))
+        aliases = map(lambda x: x.json()['aliases'].keys()[0], indices)
+        self.assertTrue(sorted(aliases) == sorted(map(lambda x: u'my-site__base__{}'.format(x[1]),
+                                                      SITE_DOCUMENT_TYPES)))
+
+    def test_write(self):
+        from base.provisioning import Provisioning
+        provisioning = Provisioning('my-site__base')
+        tag_data = {u'tag__name__v1': u'v1'}
+        tag_data['tag__id'] = provisioning.add('tag', tag_data)
+        site_id = provisioning.add('site', {u'site__name__v1': u'My Site'}, index='ximpia-api__base')
+        app_id = provisioning.add('app', {u'site__v1': {u'site__id': site_id}})
+        provisioning.add_field_versions([('base', 'app')], tag_data)
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            stats = provisioning.write()
+        bulk_requests = self._get_requests('/_bulk')
+        self.assertTrue(len(bulk_requests) == 1)
+        self.assertTrue(stats['errors'] == 0)
+        lines = map(json.loads, bulk_requests[0].body.splitlines())
+        self.assertTrue(lines[0] == {'index': {'_index': 'my-site__base__tag', '_type': 'tag',
+                                               '_id': tag_data['tag__id']}})
+        # documents copied when added
+        self.assertTrue(lines[1] == {u'tag__name__v1': u'v1'})
+        self.assertTrue(lines[2]['index']['_index'] == 'ximpia-api__base__site')
+        self.assertTrue(lines[4]['index']['_id'] == app_id)
+        self.assertTrue(lines[5] == {u'site__v1': {u'site__id': site_id}})
+        field_versions = filter(lambda x: x.get('index', {}).get('_type', None) == 'field-version', lines)
+        self.assertTrue(len(field_versions) > 0)
+        self.assertTrue(lines[7]['tag__v1']['tag__id'] == tag_data['tag__id'])
+        self.assertTrue(self._get_requests('/my-site__base__app,my-site__base__field-version,my-site__base__tag,'
+                                           'ximpia-api__base__site/_refresh'))
@@ -0,0 +1,136 @@
+from django.conf.urls import url
+from django.core.urlresolvers import Resolver404
+
+from base.tests import XimpiaTestCase
+from base.routing import RouteTableManager, TrieURLResolver, get_literal_segments
+from base import exceptions
+from document.views import DocumentViewSet
+
+__author__ = 'jorgealegre'
+
+
+class FakeRouteTableManager(RouteTableManager):
+
+    signature = (1, 1000)
+    builds = 0
+
+    def get_signature(self):
+        if self.signature is None:
+            raise exceptions.XimpiaAPIException(u'Error networking with database')
+        return self.signature
+
+    def build(self, signature=None):
+        from base.routing import RouteTable
+        self.builds += 1
+        return {
+            None: RouteTable([], signature=signature),
+            'my-site': RouteTable([], signature=signature, site='my-site'),
+        }
+
+
+def book_view(request, **kwargs):
+    pass
+
+
+def site_view(request, **kwargs):
+    pass
+
+
+class RouteTableManagerTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_table(self):
+        manager = FakeRouteTableManager(check_interval=0)
+        table = manager.get_table()
+        self.assertTrue(manager.get_table() is table)
+        self.assertTrue(manager.builds == 1)
+        manager.signature = (2, 2000)
+        self.assertTrue(manager.get_table() is not table)
+        self.assertTrue(manager.builds == 2)
+
+    def test_check_interval(self):
+        manager = FakeRouteTableManager(check_interval=60)
+        table = manager.get_table()
+        manager.signature = (2, 2000)
+        self.assertTrue(manager.get_table() is table)
+        manager._checked_at = 0
+        self.assertTrue(manager.get_table() is not table)
+
+    def test_check_not_blocking(self):
+        manager = FakeRouteTableManager(check_interval=0)
+        table = manager.get_table()
+        manager.signature = (2, 2000)
+        # other thread is checking, we keep current table
+        manager._lock.acquire()
+        try:
+            self.assertTrue(manager.get_table() is table)
+        finally:
+            manager._lock.release()
+        self.assertTrue(manager.get_table() is not table)
+
+    def test_error_keeps_table(self):
+        manager = FakeRouteTableManager(check_interval=0)
+        table = manager.get_table()
+        manager.signature = None
+        self.assertTrue(manager.get_table() is table)
+
+    def test_document_routes(self):
+        resolver = TrieURLResolver(RouteTableManager.get_document_url_patterns({
+            'url': {'raw': r'^v1/books$'},
+            'document_type': 'book',
+            'data': [{'name': 'app_id', 'value': 'my-app'}],
+        }))
+        routes = [
+            ('v1/books', 'book__list', ()),
+            ('v1/books/export', 'book__export', ()),
+            ('v1/books/_bulk', 'book__ingest', ()),
+            ('v1/books/12', 'book__detail', ('12',)),
+        ]
+        for path, name, args in routes:
+            match = resolver.resolve(path)
+            self.assertTrue(match.url_name == name)
+            self.assertTrue(match.func.cls is DocumentViewSet)
+            self.assertTrue(match.args == args)
+            self.assertTrue(match.kwargs['app_id'] == 'my-app')
+
+    def test_get_table_host(self):
+        manager = FakeRouteTableManager(check_interval=0)
+        self.assertTrue(manager.get_table('my-site.ximpia.io').site == 'my-site')
+        self.assertTrue(manager.get_table('my-site.ximpia.io:8000').site == 'my-site')
+        self.assertTrue(manager.get_table('other.ximpia.io').site is None)
+        self.assertTrue(manager.get_table().site is None)
+
+
+class TrieURLResolverTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_literal_segments(self):
+        self.assertTrue(get_literal_segments(r'^v1/books/(?P<id>\w+)$') == ['v1', 'books'])
+        self.assertTrue(get_literal_segments(r'^v1/books$') == ['v1'])
+        self.assertTrue(get_literal_segments(r'^v1/my\-books/list$') == ['v1', 'my-books'])
+        self.assertTrue(get_literal_segments(r'^v1/books?/list$') == ['v1'])
+        self.assertTrue(get_literal_segments(r'^v1/a/|^v2/b/') == [])
+        self.assertTrue(get_literal_segments(r'v1/books/') == [])
+
+    def test_resolve(self):
+        url_patterns = [url(r'^v1/type-{}/(?P<id>\w+)$'.format(x), book_view, name='type-{}__get'.format(x))
+                        for x in range(1000)]
+        url_patterns.append(url(r'^(?P<site>[-\w]+)/info$', site_view, name='site__get'))
+        resolver = TrieURLResolver(url_patterns)
+        self.assertTrue(len(resolver.get_candidates('v1/type-500/12')) == 2)
+        match = resolver.resolve('v1/type-500/12')
+        self.assertTrue(match.url_name == 'type-500__get')
+        self.assertTrue(match.kwargs == {'id': '12'})
+        self.assertTrue(resolver.resolve('my-site/info').func == site_view)
+        self.assertRaises(Resolver404, resolver.resolve, 'v1/type-1000/12')
+        self.assertTrue(resolver.reverse('type-7__get', id='12') == 'v1/type-7/12')
@@ -0,0 +1,62 @@
+from base.tests.stub import ElasticSearchStubTestCase
+from base.site_settings import SiteSettingsManager, SettingsSnapshot
+
+__author__ = 'jorgealegre'
+
+
+class SiteSettingsTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers settings searches and signature, with settings written at self.timestamp
+    """
+
+    timestamp = 1
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_settings/', self._search),
+            ('GET', r'', {'hits': {'total': 0, 'hits': []}}),
+        ]
+
+    def _search(self, request):
+        if 'aggs' in request.json():
+            return {'hits': {'total': 1, 'hits': []},
+                    'aggregations': {'updated': {'value': self.timestamp}}}
+        return {'hits': {'total': 1, 'hits': [
+            {
+                '_id': 'setting-id',
+                '_source': {
+                    '_settings__name__v1': 'PAGE_SIZE',
+                    '_settings__value__v1': {
+                        '_settings__value__int__v1': 20 + self.timestamp,
+                        '_settings__value__date__v1': None,
+                        '_settings__value__value__v1': None,
+                    },
+                    '_settings__fields__v1': None,
+                }
+            }
+        ]}}
+
+    def _get_searches(self):
+        return filter(lambda x: 'aggs' not in x.json(), self.stub.get_requests('GET', r'^/_settings/'))
+
+    def test_snapshot(self):
+        snapshot = SettingsSnapshot('my-site', 'my-app', {'PAGE_SIZE': 20})
+        self.assertTrue(snapshot.PAGE_SIZE == 20 and snapshot['PAGE_SIZE'] == 20)
+        self.assertTrue(snapshot.SITE_BASE_INDEX is not None)
+        with self.assertRaises(AttributeError):
+            snapshot.PAGE_SIZE = 30
+
+    def test_get(self):
+        manager = SiteSettingsManager(check_interval=0)
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            snapshot = manager.get('my-site', 'my-app')
+            self.assertTrue(snapshot.PAGE_SIZE == 21)
+            manager.get('my-site', 'my-app')
+            self.assertTrue(len(self._get_searches()) == 1)
+            # settings document written
+            self.timestamp = 2
+            self.assertTrue(manager.get('my-site', 'my-app').PAGE_SIZE == 22)
+            self.assertTrue(len(self._get_searches()) == 2)
+            manager.invalidate(site_slug='my-site')
+            manager.get('my-site', 'my-app')
+            self.assertTrue(len(self._get_searches()) == 3)
@@ -0,0 +1,114 @@
+import socket
+import threading
+
+import requests
+from django.conf import settings
+
+from base.tests.stub import ElasticSearchStubTestCase
+from base.transport import ElasticSearchTransport, is_connect_error
+
+__author__ = 'jorgealegre'
+
+
+class ResetServer(object):
+    """
+    Node reading requests and closing connections without response, like node failing after receiving writes
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.host = '127.0.0.1:{}'.format(self.socket.getsockname()[1])
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            connection.recv(65536)
+            connection.close()
+
+    def close(self):
+        self.socket.close()
+
+
+class ElasticSearchTransportTest(ElasticSearchStubTestCase):
+
+    def get_routes(self):
+        return [
+            (None, r'^/_unavailable', (503, {})),
+            (None, r'', lambda request: {'path': request.path}),
+        ]
+
+    def setUp(self):
+        super(ElasticSearchTransportTest, self).setUp()
+        self.host = self.host.split('://')[1]
+
+    def test_get_path(self):
+        transport = ElasticSearchTransport(['es1:9200', 'http://es2:9200/'])
+        self.assertTrue(transport.get_path('es1:9200/my-index/_search') == '/my-index/_search')
+        self.assertTrue(transport.get_path('http://es1:9200/my-index/_search') == '/my-index/_search')
+        self.assertTrue(transport.get_path('http://es2:9200/_bulk') == '/_bulk')
+        self.assertTrue(transport.get_path('{}/_bulk'.format(settings.ELASTIC_SEARCH_HOST)) == '/_bulk')
+        self.assertTrue(transport.get_path('es1:92000/_bulk') is None)
+        self.assertTrue(transport.get_path('https://graph.facebook.com/me') is None)
+
+    def test_round_robin(self):
+        transport = ElasticSearchTransport(['es1:9200', 'es2:9200'])
+        self.assertTrue(transport.get_hosts()[0] == 'http://es1:9200')
+        self.assertTrue(transport.get_hosts()[0] == 'http://es2:9200')
+        transport.mark_dead('http://es1:9200')
+        self.assertTrue(transport.get_hosts() == ['http://es2:9200', 'http://es1:9200'])
+
+    def test_failover(self):
+        # nothing listens on port 1, request fails over to live node
+        transport = ElasticSearchTransport(['127.0.0.1:1', self.host], max_retries=0)
+        response = transport.get('127.0.0.1:1/my-index/_search')
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.json()['path'] == '/my-index/_search')
+        self.assertTrue(transport.get_hosts()[0] == 'http://{}'.format(self.host))
+
+    def test_failover_writes(self):
+        # writes fail over when node refuses connection
+        transport = ElasticSearchTransport(['127.0.0.1:1', self.host], max_retries=0)
+        response = transport.post('127.0.0.1:1/my-index/my-type', data='{}')
+        self.assertTrue(response.json()['path'] == '/my-index/my-type')
+        # node could have received write, so we don't send it again
+        server = ResetServer()
+        try:
+            transport = ElasticSearchTransport([server.host, self.host], max_retries=0)
+            self.assertRaises(requests.exceptions.ConnectionError, transport.post,
+                              '{}/my-index/my-type'.format(server.host), data='{}')
+            self.assertTrue(server.connections == 1)
+            self.assertTrue(len(self.stub.requests) == 1)
+            # reads are sent to next node
+            response = transport.get('{}/my-index/_search'.format(server.host))
+            self.assertTrue(response.status_code == 200)
+        finally:
+            server.close()
+
+    def test_is_connect_error(self):
+        self.assertTrue(is_connect_error(requests.exceptions.ConnectTimeout()))
+        self.assertTrue(is_connect_error(requests.exceptions.ConnectionError(
+            Exception('Connection aborted.', socket.error(111, 'Connection refused')))))
+        self.assertFalse(is_connect_error(requests.exceptions.ConnectionError(
+            Exception('Connection aborted.', socket.error(104, 'Connection reset by peer')))))
+        self.assertFalse(is_connect_error(requests.exceptions.ReadTimeout()))
+
+    def test_retry_status(self):
+        transport = ElasticSearchTransport([self.host], max_retries=2)
+        # last response is returned when retries are used up
+        response = transport.get('{}/_unavailable'.format(self.host))
+        self.assertTrue(response.status_code == 503)
+        self.assertTrue(len(self.stub.requests) == 3)
+        # writes are not retried
+        response = transport.post('{}/_unavailable'.format(self.host), data='{}')
+        self.assertTrue(response.status_code == 503)
+        self.assertTrue(len(self.stub.requests) == 4)
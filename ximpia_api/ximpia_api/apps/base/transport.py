@@ -0,0 +1,219 @@
+import errno
+import itertools
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = getattr(settings, 'ELASTIC_SEARCH_MAX_RETRIES', 3)
+POOL_CONNECTIONS = getattr(settings, 'ELASTIC_SEARCH_POOL_CONNECTIONS', 10)
+POOL_MAXSIZE = getattr(settings, 'ELASTIC_SEARCH_POOL_MAXSIZE', 50)
+# (connect, read) timeouts in seconds
+TIMEOUT = getattr(settings, 'ELASTIC_SEARCH_TIMEOUT', (3.05, 30))
+# seconds a node that failed to connect is kept out of rotation
+DEAD_TIMEOUT = getattr(settings, 'ELASTIC_SEARCH_DEAD_TIMEOUT', 30)
+RETRY_STATUS = [502, 503, 504]
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+BACKOFF_FACTOR = 0.1
+# socket errors raised while connecting, request never reached node
+CONNECT_ERRNOS = [errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH]
+
+
+def normalize_host(host):
+    """
+    Normalize host into scheme://host:port, without ending slash
+
+    :param host: Like "elasticsearch:9200" or "http://elasticsearch:9200/"
+    :return:
+    """
+    host = host.rstrip('/')
+    if '://' not in host:
+        host = u'http://{}'.format(host)
+    return host
+
+
+def is_connect_error(error):
+    """
+    Check error was raised connecting to node, so request was never sent
+
+    requests and urllib3 wrap socket errors, we follow reasons and arguments down to socket error
+
+    :param error: requests exception
+    :return:
+    """
+    seen = set()
+    while isinstance(error, Exception) and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(error, socket.gaierror):
+            return True
+        if isinstance(error, socket.error) and error.errno in CONNECT_ERRNOS:
+            return True
+        if getattr(error, 'reason', None) is not None:
+            error = error.reason
+        else:
+            error = error.args[-1] if error.args else None
+    return False
+
+
+class ElasticSearchTransport(object):
+    """
+    ElasticSearch transport shared by all modules
+
+    Keeps a pool of keep alive connections for each node, retries connection errors and gateway errors for
+    idempotent requests, applies timeouts and balances requests round robin between nodes. Nodes that fail to
+    connect are kept out of rotation DEAD_TIMEOUT seconds and requests fail over to next node. Writes not
+    idempotent only fail over when node could not be connected, since node could have received them.
+
+    Interface is same as requests sessions, receiving urls built with settings.ELASTIC_SEARCH_HOST:
+
+    es_session.get(u'{}/{}/_search'.format(settings.ELASTIC_SEARCH_HOST, index), data=json.dumps(query))
+
+    Host in urls is replaced by node chosen. Urls not for ElasticSearch are requested as they are.
+    """
+
+    def __init__(self, hosts, max_retries=MAX_RETRIES, pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE, timeout=TIMEOUT, dead_timeout=DEAD_TIMEOUT):
+        """
+        :param hosts: List of nodes, like ['es1:9200', 'http://es2:9200']
+        :param max_retries:
+        :param pool_connections: Number of connection pools to cache
+        :param pool_maxsize: Maximum connections kept alive for each node
+        :param timeout: Default timeout, seconds or (connect, read) tuple
+        :param dead_timeout: Seconds a failed node is not used
+        :return:
+        """
+        self.hosts = map(normalize_host, hosts)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.dead_timeout = dead_timeout
+        self._dead = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        # prefixes we find in urls built by modules, with and without scheme
+        self._prefixes = set()
+        for host in list(hosts) + [settings.ELASTIC_SEARCH_HOST]:
+            self._prefixes.add(host.rstrip('/'))
+            self._prefixes.add(normalize_host(host))
+            self._prefixes.add(u'http://{}'.format(host.rstrip('/')))
+        self._prefixes = sorted(self._prefixes, key=len, reverse=True)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=max_retries,
+                read=0,
+                backoff_factor=BACKOFF_FACTOR,
+            ))
+        for host in self.hosts:
+            self.session.mount(host, adapter)
+
+    def get_path(self, url):
+        """
+        Get path for ElasticSearch url
+
+        :param url:
+        :return: Path like "/my-index/_search" or None when url is not for ElasticSearch
+        """
+        if url.startswith('/'):
+            return url
+        for prefix in self._prefixes:
+            if url.startswith(prefix) and url[len(prefix):len(prefix) + 1] in ('', '/', '?'):
+                return url[len(prefix):]
+        return None
+
+    def get_hosts(self):
+        """
+        Get nodes in order to be tried: next node in round robin first, dead nodes last
+
+        :return:
+        """
+        start = next(self._counter) % len(self.hosts)
+        hosts = self.hosts[start:] + self.hosts[:start]
+        now = time.time()
+        alive = filter(lambda x: self._dead.get(x, 0) <= now, hosts)
+        return alive + filter(lambda x: x not in alive, hosts)
+
+    def mark_dead(self, host):
+        with self._lock:
+            self._dead[host] = time.time() + self.dead_timeout
+        logger.warning(u'ElasticSearchTransport :: node {} marked dead for {} seconds'.format(
+            host, self.dead_timeout
+        ))
+
+    def mark_alive(self, host):
+        if host in self._dead:
+            with self._lock:
+                self._dead.pop(host, None)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Make request to node, retrying gateway errors for idempotent requests. Last response is returned when
+        retries are used up, so callers check status code
+
+        :param method:
+        :param url:
+        :param kwargs:
+        :return: requests response
+        """
+        retries = self.max_retries if method.upper() in IDEMPOTENT_METHODS else 0
+        for retry in xrange(retries + 1):
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS or retry == retries:
+                return response
+            time.sleep(BACKOFF_FACTOR * (2 ** retry))
+
+    def request(self, method, url, **kwargs):
+        """
+        Make request to ElasticSearch
+
+        :param method:
+        :param url:
+        :param kwargs: Same as requests
+        :return: requests response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        path = self.get_path(url)
+        if path is None:
+            return self.session.request(method, url, **kwargs)
+        error = None
+        for host in self.get_hosts():
+            try:
+                response = self._request(method, host + path, **kwargs)
+                self.mark_alive(host)
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # writes could have been processed by node unless we failed to connect
+                if method.upper() not in IDEMPOTENT_METHODS and not is_connect_error(e):
+                    raise
+                error = e
+            self.mark_dead(host)
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+es_session = ElasticSearchTransport(getattr(settings, 'ELASTIC_SEARCH_HOSTS', [settings.ELASTIC_SEARCH_HOST]))
@@ -1,5 +1,3 @@
-import requests
-from requests.adapters import HTTPAdapter
 import json
 import logging
 import string
@@ -18,8 +16,9 @@ from django.core.urlresolvers import reverse
 from . import SocialNetworkResolution
 import exceptions
 
-from document import to_physical_doc, to_logical_doc, Document, save_field_versions_from_mapping
-from base import refresh_index, get_resource, create_doc_index
+from document import to_physical_doc, to_logical_doc, Document
+from base import get_resource, base_document_cache
+from base.provisioning import Provisioning, SITE_DOCUMENT_TYPES
 
 __author__ = 'jorgealegre'
 
@@ -27,12 +26,6 @@ logger = logging.getLogger(__name__)
 
 VALID_KEY_CHARS = string.ascii_lowercase + string.digits
 
-req_session = requests.Session()
-req_session.mount('https://{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=3))
-req_session.mount('{}'.format(settings.XIMPIA_IO_HOST),
-                  HTTPAdapter(max_retries=3))
-
 
 class SetupSite(generics.CreateAPIView):
 
@@ -41,127 +34,22 @@ class SetupSite(generics.CreateAPIView):
     }
 
     @classmethod
-    def _create_site_index(cls, index_name):
+    def _create_site_index(cls, provisioning):
         """
-        Create index
+        Create indices for site document types, at the same time
 
-        :param index_name:
+        :param provisioning:
         :return:
         """
-        from document import get_document_definition_mapping
-        # base_mappings_path = settings.BASE_DIR + 'apps/base/mappings'
-        mappings_path = settings.BASE_DIR + 'apps/base/mappings'
-        user_path = settings.BASE_DIR + 'apps/xp_user/mappings'
-        document_path = settings.BASE_DIR + 'apps/document/mappings'
-
-        # my-index.mm-dd-yyyyTHH:MM:SS with alias my-index
-        index_name_physical = u'{}.{}'.format(
-            index_name,
-            datetime.now().strftime("%m-%d-%y.%H:%M:%S")
-        )
-        alias = index_name
-
-        with open(settings.BASE_DIR + 'settings/settings_test.json') as f:
-            settings_dict = json.loads(f.read())
-
-        with open('{}/urlconf.json'.format(mappings_path)) as f:
-            urlconf_dict = json.loads(f.read())
-
-        with open('{}/app.json'.format(mappings_path)) as f:
-            app_dict = json.loads(f.read())
-
-        with open('{}/settings.json'.format(mappings_path)) as f:
-            settings__dict = json.loads(f.read())
-
-        with open('{}/user.json'.format(user_path)) as f:
-            user_dict = json.loads(f.read())
-
-        with open('{}/group.json'.format(user_path)) as f:
-            group_dict = json.loads(f.read())
-
-        with open('{}/user-group.json'.format(user_path)) as f:
-            user_group_dict = json.loads(f.read())
-
-        with open('{}/permission.json'.format(user_path)) as f:
-            permissions_dict = json.loads(f.read())
-
-        with open('{}/invite.json'.format(user_path)) as f:
-            invite_dict = json.loads(f.read())
-
-        with open('{}/tag.json'.format(document_path)) as f:
-            tag_dict = json.loads(f.read())
-
-        with open('{}/field-version.json'.format(document_path)) as f:
-            field_version_dict = json.loads(f.read())
-
-        with open('{}/session.json'.format(settings.BASE_DIR + 'apps/xp_sessions/mappings')) as f:
-            session_dict = json.loads(f.read())
-
-        """with open('{}/document-definition.json'.format(document_path)) as f:
-            document_definition_dict = json.loads(f.read())"""
-
-        document_definition_dict = get_document_definition_mapping()
-        import pprint
-        """with open('{}/document-definition-generated.json'.format(document_path), 'w') as f:
-            f.write(json.dumps(document_definition_dict))"""
-        """logger.debug(u'_create_index :: mappings: {}'.format(
-            pprint.PrettyPrinter(indent=4).pformat(document_definition_dict))
-        )"""
-        create_doc_index(u'{}__document-definition'.format(index_name), document_definition_dict)
-
-        create_doc_index(u'{}__urlconf'.format(index_name), urlconf_dict)
-        create_doc_index(u'{}__app'.format(index_name), app_dict)
-        create_doc_index(u'{}__settings'.format(index_name), settings__dict)
-        create_doc_index(u'{}__user'.format(index_name), user_dict)
-        create_doc_index(u'{}__group'.format(index_name), group_dict)
-        create_doc_index(u'{}__user-group'.format(index_name), user_group_dict)
-        create_doc_index(u'{}__permission'.format(index_name), permissions_dict)
-        create_doc_index(u'{}__tag'.format(index_name), tag_dict)
-        create_doc_index(u'{}__field-version'.format(index_name), field_version_dict)
-        create_doc_index(u'{}__invite'.format(index_name), invite_dict)
-        create_doc_index(u'{}__session'.format(index_name), session_dict)
-
-        """es_response_raw = requests.post('{}/{}'.format(settings.ELASTIC_SEARCH_HOST, index_name_physical),
-                                        data=json.dumps({
-                                            'settings': settings_dict,
-                                            'mappings': {
-                                                'app': app_dict,
-                                                'urlconf': urlconf_dict,
-                                                'settings': settings__dict,
-                                                'user': user_dict,
-                                                'group': group_dict,
-                                                'user-group': user_group_dict,
-                                                'permission': permissions_dict,
-                                                'tag': tag_dict,
-                                                'field-version': field_version_dict,
-                                                'invite': invite_dict,
-                                                'session': session_dict,
-                                            },
-                                            'aliases': {
-                                                alias: {}
-                                            }
-                                        })
-                                        )
-
-        if es_response_raw.status_code != 200:
-            raise exceptions.XimpiaAPIException(_(u'Error creating index "{}" {}'.format(
-                index_name,
-                es_response_raw.content
-            )))
-        es_response = es_response_raw.json()
-        if not es_response['acknowledged']:
-            raise exceptions.XimpiaAPIException(_(u'Error creating index "{}"'.format(index_name)))
-        logger.info(u'SetupSite :: created index {} response: {}'.format(
-            index_name,
-            es_response
-        ))"""
+        provisioning.create_indices(SITE_DOCUMENT_TYPES)
 
     @classmethod
-    def _create_site_app(cls, index_ximpia, index_name, site, app, now_es, languages, location,
+    def _create_site_app(cls, provisioning, index_ximpia, index_name, site, app, now_es, languages, location,
                          invite_only, tag_data, domains, account, organization_name, public):
         """
         Create site and app
 
+        :param provisioning:
         :param index_ximpia:
         :param index_name:
         :param site:
@@ -204,20 +92,7 @@ class SetupSite(generics.CreateAPIView):
                 u'site__invites__created_on__v1': now_es,
                 u'site__invites__updated_on__v1': now_es,
             }
-        es_response_raw = requests.post(
-            '{}/{}__site'.format(settings.ELASTIC_SEARCH_HOST, index_ximpia),
-            data=json.dumps(site_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise exceptions.XimpiaAPIException(_(u'Could not write site "{}" :: {}'.format(
-                site,
-                es_response_raw.content
-            )))
-        es_response = es_response_raw.json()
-        # print es_response
-        if 'status' in es_response and es_response['status'] != 200:
-            raise exceptions.XimpiaAPIException(_(u'Could not write site "{}" :: {}'.format(
-                app, es_response_raw.content)))
-        site_id = es_response.get('_id', '')
+        site_id = provisioning.add('site', site_data, index=index_ximpia)
         logger.info(u'SetupSite :: created site {} id: {}'.format(
             site,
             site_id
@@ -244,18 +119,7 @@ class SetupSite(generics.CreateAPIView):
             },
             u'app__created_on__v1': now_es
         }
-        es_response_raw = requests.post(
-            '{}/{}__app'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(app_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise exceptions.XimpiaAPIException(_(u'Could not write app "{}" :: {}'.format(
-                app, es_response_raw.content)))
-        es_response = es_response_raw.json()
-        # print u'app: {}'.format(es_response)
-        if 'status' in es_response and es_response['status'] != 200:
-            raise exceptions.XimpiaAPIException(_(u'Could not write app "{}" :: {}'.format(
-                app, es_response_raw.content)))
-        app_id = es_response.get('_id', '')
+        app_id = provisioning.add('app', app_data)
         app_data_logical = to_logical_doc('app', app_data)
         app_data_logical['id'] = app_id
         app_data_logical['site']['id'] = site_id
@@ -284,15 +148,8 @@ class SetupSite(generics.CreateAPIView):
                 u'settings__setting_name__v1': setting_item[0],
                 u'settings__setting_value__v1': setting_item[1]
             })
-            es_response_raw = requests.post(
-                '{}/{}__settings'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(settings_data))
-            if es_response_raw.status_code not in [200, 201]:
-                raise exceptions.XimpiaAPIException(_(u'Could not write settings for site "{}" :: {}'.format(
-                    site, es_response_raw.content)))
-            es_response = es_response_raw.json()
             logger.info(u'SetupSite :: created settings id: {}'.format(
-                es_response.get('_id', '')
+                provisioning.add('settings', settings_data)
             ))
             settings_data_logical = to_logical_doc('settings', settings_data)
             settings_output.append(settings_data_logical)
@@ -305,27 +162,21 @@ class SetupSite(generics.CreateAPIView):
             u'account__name__v1': account,
             u'account__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
-            '{}/{}__account'.format(settings.ELASTIC_SEARCH_HOST, settings.SITE_BASE_INDEX),
-            data=json.dumps(account_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise exceptions.XimpiaAPIException(_(u'Could not write account "{}" :: {}'.format(
-                site, es_response_raw.content)))
-        es_response = es_response_raw.json()
+        account_id = provisioning.add('account', account_data, index=index_ximpia)
         logger.info(u'SetupSite :: created account {}'.format(
             account,
         ))
         account_data_logical = to_logical_doc('account', account_data)
-        account_data_logical['id'] = es_response.get('_id', '')
+        account_data_logical['id'] = account_id
 
         return site_data_logical, app_data_logical, settings_output, account_data_logical
 
     @classmethod
-    def _create_tag(cls, index_name, now_es, version='v1'):
+    def _create_tag(cls, provisioning, now_es, version='v1'):
         """
-        Create tag v1
+        Create tag v1 and field versions for site document types
 
-        :param index_name:
+        :param provisioning:
         :param now_es:
         :return:
         """
@@ -337,68 +188,21 @@ class SetupSite(generics.CreateAPIView):
             u'tag__public__v1': True,
             u'tag__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
-            '{}/{}__tag'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-            data=json.dumps(tag_data))
-        if es_response_raw.status_code not in [200, 201]:
-            raise exceptions.XimpiaAPIException(_(u'Could not write tag v1 :: {} :: {}'.format(
-                es_response_raw.status_code,
-                es_response_raw.content)))
-        es_response = es_response_raw.json()
+        tag_data['tag__id'] = provisioning.add('tag', tag_data)
         logger.info(u'SetupSite :: created tag "v1" id: {}'.format(
-            es_response.get('_id', '')
+            tag_data['tag__id']
         ))
-        tag_data['tag__id'] = es_response.get('_id', '')
         tag_logical = to_logical_doc('tag', tag_data)
-        mappings_path = settings.BASE_DIR + 'apps/base/mappings'
-        user_path = settings.BASE_DIR + 'apps/xp_user/mappings'
-        document_path = settings.BASE_DIR + 'apps/document/mappings'
-        with open('{}/urlconf.json'.format(mappings_path)) as f:
-            urlconf_dict = json.loads(f.read())
-        with open('{}/app.json'.format(mappings_path)) as f:
-            app_dict = json.loads(f.read())
-        with open('{}/settings.json'.format(mappings_path)) as f:
-            settings__dict = json.loads(f.read())
-        with open('{}/user.json'.format(user_path)) as f:
-            user_dict = json.loads(f.read())
-        with open('{}/group.json'.format(user_path)) as f:
-            group_dict = json.loads(f.read())
-        with open('{}/user-group.json'.format(user_path)) as f:
-            user_group_dict = json.loads(f.read())
-        with open('{}/permission.json'.format(user_path)) as f:
-            permissions_dict = json.loads(f.read())
-        with open('{}/invite.json'.format(user_path)) as f:
-            invite_dict = json.loads(f.read())
-        with open('{}/tag.json'.format(document_path)) as f:
-            tag_dict = json.loads(f.read())
-        with open('{}/field-version.json'.format(document_path)) as f:
-            field_version_dict = json.loads(f.read())
-        with open('{}/session.json'.format(settings.BASE_DIR + 'apps/xp_sessions/mappings')) as f:
-            session_dict = json.loads(f.read())
-        with open('{}/document-definition.json'.format(document_path)) as f:
-            document_definition_dict = json.loads(f.read())
-        save_field_versions_from_mapping(urlconf_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(app_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(settings__dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(user_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(group_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(user_group_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(permissions_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(tag_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(field_version_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(invite_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(session_dict, tag=tag_data, index=index_name)
-        save_field_versions_from_mapping(document_definition_dict, tag=tag_data, index=index_name)
-        refresh_index(index_name)
+        provisioning.add_field_versions(SITE_DOCUMENT_TYPES, tag_data)
         return tag_logical
 
     @classmethod
-    def _create_permissions(cls, site, app, index_name, now_es):
+    def _create_permissions(cls, provisioning, site, app, now_es):
         """
         Create permission can_admin
 
+        :param provisioning:
         :param app:
-        :param index_name:
         :param now_es:
         :return:
         """
@@ -418,31 +222,24 @@ class SetupSite(generics.CreateAPIView):
                 u'permission__data__v1': None,
                 u'permission__created_on__v1': now_es
             }
-            es_response_raw = requests.post(
-                '{}/{}__permission'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(db_permission))
-            if es_response_raw.status_code not in [200, 201]:
-                raise exceptions.XimpiaAPIException(_(u'Could not write permission "can-admin" :: {}'.format(
-                    es_response_raw.content
-                )))
-            es_response = es_response_raw.json()
+            permission_id = provisioning.add('permission', db_permission)
             logger.info(u'SetupSite :: created permission "can_admin" for app: {} id: {}'.format(
                 app,
-                es_response.get('_id', '')
+                permission_id
             ))
             permission_logical = to_logical_doc('permission', db_permission)
-            permission_logical['id'] = es_response.get('_id', '')
+            permission_logical['id'] = permission_id
             output_permissions.append(permission_logical)
         return output_permissions
 
     @classmethod
-    def _create_groups(cls, groups, now_es, index_name, group_permissions):
+    def _create_groups(cls, provisioning, groups, now_es, group_permissions):
         """
         Create site groups taking default site groups
 
+        :param provisioning:
         :param groups:
         :param now_es:
-        :param index_name:
         :return:
         """
         # group
@@ -462,20 +259,13 @@ class SetupSite(generics.CreateAPIView):
                         u'group__permissions__created_on__v1': now_es
                     }
                 ]
-            es_response_raw = requests.post(
-                '{}/{}__group'.format(settings.ELASTIC_SEARCH_HOST, index_name),
-                data=json.dumps(group_data))
-            if es_response_raw.status_code not in [200, 201]:
-                raise exceptions.XimpiaAPIException(_(u'Could not write group "{}" :: {}'.format(
-                    group, es_response_raw.content)))
-            es_response = es_response_raw.json()
+            group_id = provisioning.add('group', group_data)
             logger.info(u'SetupSite :: created group {} id: {}'.format(
                 group,
-                es_response.get('_id', u'')
+                group_id
             ))
-            # group_ids[group] = es_response.get('_id', '')
             group_data_logical = to_logical_doc('group', group_data)
-            group_data_logical['id'] = es_response.get('_id', '')
+            group_data_logical['id'] = group_id
             groups_data_logical[group_data_logical['id']] = group_data_logical
             groups_data.append(group_data_logical)
         return groups_data
@@ -528,26 +318,32 @@ class SetupSite(generics.CreateAPIView):
         index_name = '{site}__base'.format(site=site)
         index_ximpia = settings.SITE_BASE_INDEX
 
-        # create index with settings and mappings:
-        self._create_site_index(index_name)
+        provisioning = Provisioning(index_name)
 
-        tag_data = self._create_tag(index_name, now_es)
+        # create indices with settings and mappings:
+        self._create_site_index(provisioning)
+
+        tag_data = self._create_tag(provisioning, now_es)
 
         # 1. create site, app and settings
-        site_tuple = self._create_site_app(index_ximpia, index_name, site, app, now_es, languages,
+        site_tuple = self._create_site_app(provisioning, index_ximpia, index_name, site, app, now_es, languages,
                                            location, invite_only, tag_data, domains, account, organization_name,
                                            public)
         site_data, app_data, settings_data, account_data = site_tuple
 
         # 2. Permissions
-        permissions_data = self._create_permissions(site, app, index_name, now_es)
+        permissions_data = self._create_permissions(provisioning, site, app, now_es)
 
         # 3. Create site groups
-        groups = self._create_groups(default_groups, now_es, index_name,
+        groups = self._create_groups(provisioning, default_groups, now_es,
                                      {
                                          u'admin': u'can-admin',
                                      })
-        refresh_index(index_name)
+
+        # seed documents in one bulk request and refresh
+        provisioning.write()
+        # base app for site slug could be cached from a previous site
+        base_document_cache.invalidate('app', slugify(site))
 
         # 4. User signup
         # We create user at ximpia, so user can connect to ximpia api app to manage account
@@ -1,190 +1,240 @@
-import requests
 import json
+import copy
 import datetime
 import logging
 import pprint
-from requests.adapters import HTTPAdapter
+import threading
+from multiprocessing.pool import ThreadPool
 
 from django.utils.translation import ugettext as _
 from django.utils.text import slugify
 from django.conf import settings
 
-from base import exceptions, get_es_response, get_path_search
+from base import exceptions, get_es_response, get_path_search, msearch, base_document_cache
+from base.cache import TTLCache
+from base.transport import es_session
 
 __author__ = 'jorgealegre'
 
-MAX_RETRIES = 3
+FIELD_VERSION_CACHE_TTL = getattr(settings, 'FIELD_VERSION_CACHE_TTL', 300)
+FIELD_VERSION_CACHE_SIZE = getattr(settings, 'FIELD_VERSION_CACHE_SIZE', 1000)
+DOCUMENT_ASYNC_POOL_SIZE = getattr(settings, 'DOCUMENT_ASYNC_POOL_SIZE', 10)
+DOCUMENT_ASYNC_TIMEOUT = getattr(settings, 'DOCUMENT_ASYNC_TIMEOUT', 60)
 
-req_session = requests.Session()
-req_session.mount('https://{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=MAX_RETRIES))
 
 logger = logging.getLogger(__name__)
 
 
-def walk(node, **kwargs):
+class TranslationPlan(object):
     """
-    Walk through dictionary
+    Compiled translation between logical and physical documents for a document type
 
-    field1__v1
-    field1__v2
+    Built once from physical field names in field versions, like "user__token__v1" and "user__token__key__v1",
+    into a tree mapping logical names to physical names for each object path:
 
-    In this case, I should get field1 as key and field1__v2 as value
+    {
+        (): {'token': ('user__token__v1', ('user', 'token'))},
+        ('user', 'token'): {'key': ('user__token__key__v1', None)},
+    }
 
-    :param node:
-    :param is_logical:
-    :param is_physical:
-    :param version:
-    :return:
+    Documents are then translated in one pass over their keys, without looking up field versions for every key.
+    Physical keys are parsed once and kept in the plan.
     """
-    from copy import copy
-    data = {}
-    versions_map = {}
-    is_physical = kwargs.get('is_physical', False)
-    is_logical = kwargs.get('is_logical', False)
-    fields_version = kwargs.get('fields_version', [])
-    fields_data = kwargs.get('fields_data', [])
-    doc_type = kwargs.get('doc_type', '')
-    paths = kwargs.get('paths', [])
-    tag = kwargs.get('tag', None)
-    # logger.debug(u'walk :: paths: {}'.format(paths))
-    # logger.debug(u'walk :: node: {}'.format(node))
-    if is_physical is False and is_logical is False:
-        raise exceptions.XimpiaAPIException(u'Need physical or logical filter')
-    if is_physical:
-        for key, item in node.items():
-            # key might have version, or key should strip version
-            if key.find('__') == -1:
+
+    def __init__(self, doc_type, fields=None, pin_versions=False):
+        """
+        :param doc_type:
+        :param fields: Physical field names
+        :param pin_versions: Physical to logical uses versions in fields instead of latest version in document
+        :return:
+        """
+        self.doc_type = doc_type
+        self.tree = {}
+        self.names = {}
+        self.versions = {}
+        self._keys = {}
+        candidates = {}
+        for field in fields or []:
+            parsed = self._parse(field)
+            if parsed is None:
                 continue
-            # field, version_str = key.split('__')
-            field_items = key.split('__')
+            name, version = parsed
+            field_items = field.split('__')
             if field_items[-1] == 'id':
-                field = field_items[-1]
-                versions_map.setdefault(field, {})
-                versions_map[field][1] = item
-                continue
-            version_str = field_items[-1]
-            field = field_items[-2]
-            version_int = int(version_str[1:])
-            versions_map.setdefault(field, {})
-            versions_map[field][version_int] = item
-    # print versions_map
-    if is_physical:
-        for field in versions_map:
-            # print field
-            if not fields_version:
-                target_version = max(versions_map[field].keys())
+                parent, path = tuple(field_items[:-1]), None
             else:
-                target_version = int(filter(lambda x: x.split('__')[-2] == field,
-                                            fields_version)[0].split('__')[-1][1:])
-            # print 'target_version: {}'.format(target_version)
-            item = versions_map[field][target_version]
-            # logger.debug(u'walk :: field: {} target_version: {} item: {}'.format(field, target_version, item))
-            if isinstance(item, dict):
-                data[field] = walk(item, **kwargs)
-            elif item and isinstance(item, (list, tuple)) and isinstance(item[0], dict):
-                data[field] = map(lambda x: walk(x, **kwargs), item)
+                parent, path = tuple(field_items[:-2]), tuple(field_items[:-1])
+            parent = self._normalize(parent)
+            children = self.tree.setdefault(parent, {})
+            if name not in children or version > self._parse(children[name][0])[1]:
+                children[name] = (field, path)
+            if name != 'id':
+                candidates.setdefault(name, {})
+                if version >= candidates[name].get(path, (None, 0))[1]:
+                    candidates[name][path] = (field, version)
+            if pin_versions and version > self.versions.get(name, 0):
+                self.versions[name] = version
+        for name, paths in candidates.iteritems():
+            # same name in different objects is ambiguous when we don't know the path
+            if len(paths) == 1:
+                path, (field, version) = paths.items()[0]
+                self.names[name] = (field, path)
             else:
-                data[field] = item
-    elif is_logical:
-        # logger.debug(u'walk :: fields_data: {}'.format(fields_data))
-        for key, item in node.items():
-            # key like 'status', item like 'ok', ['ok', 'right'], 67 or { field: value }, etc...
-            # logger.debug(u'walk :: type: {} key: {} item: {}'.format(doc_type, key, item))
-            if fields_data:
-                if tag:
-                    # like status__v7
-                    field = map(lambda x: x,
-                                filter(lambda y: y['field-version__field__v1'] == key, fields_data))[0]
-                else:
-                    fields = map(lambda x: x['_source']['field-version__field__v1'], fields_data)
-                    # logger.debug(u'walk :: fields: {}'.format(fields))
-                    # field: {version}
-                    # logger.debug(u'walk :: versions_map: {} fields: {}'.format(versions_map, fields))
-                    # like status__v7
-                    # logger.debug(u'walk :: list1: {}'.format(filter(lambda x: x.split('__')[-2] == key, fields)))
-                    fields_key = filter(lambda x: x.split('__')[-2] == key, fields)
-                    # logger.debug(u'walk :: fields_key: {}'.format(fields_key))
-                    if len(fields_key) > 1:
-                        raise exceptions.XimpiaAPIException(u'More than one field for type: {} key: {} '
-                                                            u'fields: {}'.format(
-                                                                doc_type,
-                                                                key,
-                                                                fields
-                                                            ))
-                    # if key not in paths:
-                    # paths.append(key)
-                    # We need unit test for this, starting with basic documents
-                    # Simple fields: user_name -> user__user_name__v1
-                    # Links: app.slug -> app_v1.app__slug__v1
-                    # Objects: my_obj.key -> doc_type__my_obj__v1.
-                    # Idea, fields build physical data. What we do meanwhile???
-                    """logger.debug(u'walk :: paths: {}'.format(paths))
-                    paths_final = copy(paths)
-                    paths_final.append(key)
-                    for field_final_target in fields_key:
-                        field_final_target_base = u'__'.join(field_final_target.split('__')[:-1])
-                        logger.debug(u'walk :: field_final_target: {} field_final_target_base: {} '
-                                     u'checked_to: {}'.format(
-                                         field_final_target,
-                                         field_final_target_base,
-                                         u'__'.join(paths)
-                                     ))
-                        if u'__'.join(paths) in field_final_target_base:
-                            field = field_final_target
-                            break"""
-                    if fields_key:
-                        field = fields_key[0]
-                    else:
-                        if key == 'id':
-                            field = 'id'
+                self.names[name] = None
+
+    def _normalize(self, path):
+        if path == (self.doc_type,):
+            return ()
+        return path
+
+    def _parse(self, key):
+        """
+        Parse physical key into (name, version). Returns None when key is not versioned
+
+        :param key: Like "user__token__v1" or "group__id"
+        :return:
+        """
+        try:
+            return self._keys[key]
+        except KeyError:
+            pass
+        parsed = None
+        if key.find('__') != -1:
+            field_items = key.split('__')
+            if field_items[-1] == 'id':
+                parsed = ('id', 1)
             else:
-                field = u'{doc_type}__{key}__v1'.format(
-                    doc_type=doc_type,
-                    key=key
-                )
-            # logger.debug(u'walk :: field: {}'.format(field))
+                try:
+                    parsed = (field_items[-2], int(field_items[-1][1:]))
+                except ValueError:
+                    parsed = None
+        self._keys[key] = parsed
+        return parsed
+
+    def _resolve(self, key, path):
+        """
+        Resolve physical field for logical key at object path
+
+        :param key:
+        :param path:
+        :return: (physical field, child path)
+        """
+        children = self.tree.get(path, {})
+        if key in children:
+            return children[key]
+        if key in self.names:
+            if self.names[key] is None:
+                raise exceptions.XimpiaAPIException(u'More than one field for type: {} key: {}'.format(
+                    self.doc_type,
+                    key
+                ))
+            return self.names[key]
+        if key == 'id':
+            return 'id', None
+        path = path or (self.doc_type,)
+        return u'{}__{}__v1'.format(u'__'.join(path), key), path + (key,)
+
+    def to_physical(self, node, path=()):
+        """
+        Translate logical document into physical
+
+        :param node:
+        :param path:
+        :return:
+        """
+        data = {}
+        for key, item in node.iteritems():
+            field, child_path = self._resolve(key, path)
             if isinstance(item, dict):
-                # logger.debug(u'walk :: I detect dict! paths: {}'.format(paths))
-                paths_new = copy(paths)
-                paths_new.append(key)
-                kwargs['paths'] = paths_new
-                # logger.debug(u'walk :: I detect dict! sent paths: {}'.format(paths_new))
-                data[field] = walk(item, **kwargs)
+                data[field] = self.to_physical(item, child_path)
             elif isinstance(item, (list, tuple)) and item and isinstance(item[0], dict):
-                paths_new = copy(paths)
-                paths_new.append(key)
-                kwargs['paths'] = paths_new
-                data[field] = map(lambda x: walk(x, **kwargs), item)
+                data[field] = [self.to_physical(x, child_path) for x in item]
             else:
                 data[field] = item
-    return data
+        return data
+
+    def to_physical_field(self, name):
+        """
+        Translate logical field name into physical field path, used in queries and sorts. Fields starting with
+        underscore, like "_uid", are ElasticSearch fields and kept.
 
+        "token.key" -> "user__token__v1.user__token__key__v1"
 
-def to_logical_doc(doc_type, document, tag=None, user=None, **kwargs):
+        :param name: Logical field name, with dots for objects
+        :return:
+        """
+        if name.startswith('_'):
+            return name
+        fields = []
+        path = ()
+        for key in name.split('.'):
+            field, path = self._resolve(key, path)
+            fields.append(field)
+        return u'.'.join(fields)
+
+    def to_logical(self, node):
+        """
+        Translate physical document into logical. For each field we get pinned version or latest one
+        found in document.
+
+        :param node:
+        :return:
+        """
+        fields = {}
+        for key, item in node.iteritems():
+            parsed = self._parse(key)
+            if parsed is None:
+                continue
+            name, version = parsed
+            current = fields.get(name, None)
+            target = self.versions.get(name, None)
+            if current is None or version == target or (current[0] != target and version > current[0]):
+                fields[name] = (version, item)
+        data = {}
+        for name, (version, item) in fields.iteritems():
+            if isinstance(item, dict):
+                data[name] = self.to_logical(item)
+            elif item and isinstance(item, (list, tuple)) and isinstance(item[0], dict):
+                data[name] = [self.to_logical(x) for x in item]
+            else:
+                data[name] = item
+        return data
+
+
+class FieldVersionRegistry(object):
     """
-    Physical documents will have versioned fields
+    Per-process registry of active field versions
 
-    :param doc_type:
-    :param document:
-    :param tag:
-    :param user: User document requesting tag for visibility check
-    :return:
+    Field versions are keyed by (index, doc_type, tag, branch) and kept for FIELD_VERSION_CACHE_TTL seconds, so
+    translation between logical and physical documents does not need a field-version search on every call.
+    We also keep the translation plan compiled for each key.
+
+    Field versions change when we create document definitions or save field versions from mappings, which call
+    invalidate().
     """
-    fields_version = None
-    if tag:
-        query_dsl = {
+
+    def __init__(self, ttl=FIELD_VERSION_CACHE_TTL, max_size=FIELD_VERSION_CACHE_SIZE):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._plans = TTLCache(max_size=max_size, ttl=ttl)
+        self._default_plans = {}
+
+    @classmethod
+    def get_query(cls, doc_type, tag=None, branch=None):
+        """
+        Get query for active field versions for document type
+
+        :param doc_type:
+        :param tag: Tag slug
+        :param branch: Branch name
+        :return:
+        """
+        query = {
             'query': {
                 'bool': {
                     'must': [
-                        {
-                            'term': {
-                                "tag__v1": tag
-                            }
-                        },
                         {
                             "term": {
-                                "field-version__doc_type__v1": doc_type
+                                "field-version__doc_type__v1.raw__v1": doc_type
                             }
                         },
                         {
@@ -197,47 +247,251 @@ def to_logical_doc(doc_type, document, tag=None, user=None, **kwargs):
             },
             "from": 0, "size": 500,
         }
-        if user:
-            query_dsl['query']['bool']['should'] = [
-                {
-                    'nested': {
-                        'path': 'tag__v1.tag__permissions__v1.tag__permissions__users__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__v1.tag__permissions__v1.tag__permissions__users__v1.id': user['id']
-                                }
-                            }
-                        }
-                    }
-                },
+        if tag:
+            query['query']['bool']['must'].append(
                 {
-                    'nested': {
-                        'path': 'tag__v1.tag__permissions__v1.tag__permissions__groups__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__v1.tag__permissions__v1.tag__permissions__groups__v1.id':
-                                        u' OR '.join(user['groups'])
-                                }
-                            }
-                        }
+                    'term': {
+                        "tag__v1.tag__slug__v1": tag
                     }
-                },
+                }
+            )
+        if branch:
+            query['query']['bool']['must'].append(
                 {
                     'term': {
-                        'tag__v1.tag__public__v1': True
+                        "branch__v1.branch__name__v1": branch
                     }
                 }
-            ]
-        es_response = get_es_response(
-            req_session.get(
-                get_path_search('field-version', **kwargs),
-                data=json.dumps(query_dsl)
             )
-        )
-        fields_version = map(lambda x: x['field__v1'], es_response['hits']['hits'])
-    return walk(document, is_physical=True, fields_version=fields_version)
+        return query
+
+    def get(self, doc_type, tag=None, branch=None, index=None):
+        """
+        Get field versions for document type
+
+        :param doc_type:
+        :param tag: Tag slug
+        :param branch: Branch name
+        :param index: Index, settings.SITE_BASE_INDEX by default
+        :return: List of field-version documents (physical _source)
+        """
+        index = index or settings.SITE_BASE_INDEX
+        key = (index, doc_type, tag, branch)
+        fields = self._cache.get(key)
+        if fields is not None:
+            return fields
+        es_response = get_es_response(
+            es_session.get(get_path_search('field-version', index=index),
+                            data=json.dumps(self.get_query(doc_type, tag=tag, branch=branch))))
+        fields = map(lambda x: x['_source'], es_response['hits']['hits'])
+        # Field versions not found could be still not refreshed into index, we only keep found ones
+        if fields:
+            self._cache.set(key, fields)
+        return fields
+
+    def get_plan(self, doc_type, tag=None, branch=None, index=None):
+        """
+        Get translation plan for document type from field versions
+
+        :param doc_type:
+        :param tag: Tag slug
+        :param branch: Branch name
+        :param index:
+        :return: TranslationPlan
+        """
+        key = (index or settings.SITE_BASE_INDEX, doc_type, tag, branch)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        fields = self.get(doc_type, tag=tag, branch=branch, index=index)
+        plan = TranslationPlan(doc_type,
+                               map(lambda x: x['field-version__field__v1'], fields),
+                               pin_versions=bool(tag))
+        if fields:
+            self._plans.set(key, plan)
+        return plan
+
+    def get_default_plan(self, doc_type):
+        """
+        Get plan with no field versions, translates physical documents to latest versions. No database access.
+
+        :param doc_type:
+        :return: TranslationPlan
+        """
+        if doc_type not in self._default_plans:
+            self._default_plans[doc_type] = TranslationPlan(doc_type)
+        return self._default_plans[doc_type]
+
+    def invalidate(self, doc_type=None, index=None):
+        """
+        Invalidate field versions for document type and index. No document type or index invalidates all
+
+        :param doc_type:
+        :param index:
+        :return:
+        """
+        predicate = lambda key: (index is None or key[0] == index) and (doc_type is None or key[1] == doc_type)
+        deleted = self._cache.delete_many(predicate)
+        self._plans.delete_many(predicate)
+        field_permission_index.invalidate(doc_type=doc_type, index=index)
+        logger.debug(u'FieldVersionRegistry.invalidate :: doc_type: {} index: {} deleted: {}'.format(
+            doc_type, index, deleted
+        ))
+
+
+field_version_registry = FieldVersionRegistry()
+
+
+class FieldPermissionIndex(object):
+    """
+    Per-process index of physical fields visible for (index, doc_type, tag, principals)
+
+    Principals are the user and its groups. Visible fields are computed once from field versions in
+    field_version_registry, fields for public tags or tags having permissions for any principal, and kept as a
+    frozenset, so documents are filtered with set intersection:
+
+    visible = field_permission_index.get('book', tag='v1', user=request.user)
+    document = field_permission_index.filter_fields(visible, document)
+
+    Invalidated with field versions, when tags or permissions change.
+    """
+
+    def __init__(self, ttl=FIELD_VERSION_CACHE_TTL, max_size=FIELD_VERSION_CACHE_SIZE):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @classmethod
+    def get_principals(cls, user):
+        """
+        Get principals for user: user id and group ids
+
+        :param user: Django user with logical user document, None for anonymous
+        :return: frozenset of ('user', id) and ('group', id)
+        """
+        document = getattr(user, 'document', None) or {}
+        if not document.get('id', None):
+            return frozenset()
+        principals = [('user', document['id'])]
+        for group in document.get('groups', None) or []:
+            principals.append(('group', group['id']))
+        return frozenset(principals)
+
+    @classmethod
+    def is_visible(cls, field_version, principals):
+        """
+        Check field version is visible for principals
+
+        :param field_version: Physical field version document
+        :param principals:
+        :return: boolean
+        """
+        tag = field_version.get('tag__v1', None) or {}
+        if tag.get('tag__public__v1', False):
+            return True
+        for permission in tag.get('tag__permissions__v1', None) or []:
+            user_id = (permission.get('tag__permissions__user__v1', None) or {}).get(
+                'tag__permissions__user__id', None)
+            group_id = (permission.get('tag__permissions__group__v1', None) or {}).get(
+                'tag__permissions__group__id', None)
+            if ('user', user_id) in principals or ('group', group_id) in principals:
+                return True
+        return False
+
+    def get(self, doc_type, tag=None, user=None, index=None):
+        """
+        Get physical fields visible for user
+
+        :param doc_type:
+        :param tag: Tag slug. Without tag all active fields are visible
+        :param user: Django user with logical user document
+        :param index:
+        :return: frozenset of physical fields
+        """
+        principals = self.get_principals(user) if tag else frozenset()
+        key = (index or settings.SITE_BASE_INDEX, doc_type, tag, principals)
+        visible = self._cache.get(key)
+        if visible is not None:
+            return visible
+        field_versions = field_version_registry.get(doc_type, tag=tag, index=index)
+        if tag:
+            field_versions = filter(lambda x: self.is_visible(x, principals), field_versions)
+        visible = frozenset(map(lambda x: x['field-version__field__v1'], field_versions))
+        if field_versions:
+            self._cache.set(key, visible)
+        return visible
+
+    @classmethod
+    def get_source(cls, visible):
+        """
+        Get source filtering for visible fields, so only visible fields are sent by ElasticSearch
+
+        :param visible: frozenset of physical fields
+        :return: Sorted list of fields, False when no field is visible
+        """
+        return sorted(visible) or False
+
+    @classmethod
+    def filter_fields(cls, visible, document):
+        """
+        Keep visible fields in physical document
+
+        :param visible: frozenset of physical fields
+        :param document: Physical document
+        :return: Physical document with visible fields
+        """
+        return dict(map(lambda x: (x, document[x]), visible.intersection(document)))
+
+    def invalidate(self, doc_type=None, index=None):
+        """
+        Invalidate visible fields for document type and index. No document type or index invalidates all
+
+        :param doc_type:
+        :param index:
+        :return:
+        """
+        self._cache.delete_many(lambda key: (index is None or key[0] == index)
+                                and (doc_type is None or key[1] == doc_type))
+
+
+field_permission_index = FieldPermissionIndex()
+
+
+def to_logical_doc(doc_type, document, tag=None, user=None, **kwargs):
+    """
+    Physical documents will have versioned fields
+
+    :param doc_type:
+    :param document:
+    :param tag:
+    :param user: User document requesting tag for visibility check
+    :return:
+    """
+    if tag:
+        plan = field_version_registry.get_plan(doc_type, tag=tag, index=kwargs.get('index', None))
+    else:
+        plan = field_version_registry.get_default_plan(doc_type)
+    return plan.to_logical(document)
+
+
+def to_logical_docs(doc_type, hits, tag=None, user=None, **kwargs):
+    """
+    Translate search result hits into logical documents, resolving field versions once for all hits.
+
+    Generator, so callers can stream pages of results.
+
+    :param doc_type:
+    :param hits: ElasticSearch hits, having "_id" and "_source"
+    :param tag:
+    :param user: User document requesting tag for visibility check
+    :return: Logical documents with "id"
+    """
+    if tag:
+        plan = field_version_registry.get_plan(doc_type, tag=tag, index=kwargs.get('index', None))
+    else:
+        plan = field_version_registry.get_default_plan(doc_type)
+    for hit in hits:
+        document = plan.to_logical(hit['_source'])
+        document['id'] = hit['_id']
+        yield document
 
 
 def to_physical_doc(doc_type, document, tag=None, user=None, **kwargs):
@@ -253,73 +507,8 @@ def to_physical_doc(doc_type, document, tag=None, user=None, **kwargs):
     logger.debug(u'to_physical_doc :: doc_type: {} tag: {} user: {} document: {}'.format(
         doc_type, tag, user, document
     ))
-    query = {
-        'query': {
-            'bool': {
-                'must': [
-                    {
-                        "term": {
-                            "field-version__doc_type__v1.raw__v1": doc_type
-                        }
-                    },
-                    {
-                        "term": {
-                            "field-version__is_active__v1": True
-                        }
-                    }
-                ]
-            }
-        },
-        "from": 0, "size": 500,
-    }
-    if tag:
-        query['query']['bool']['must'].append(
-            {
-                'term': {
-                    "tag__v1": tag
-                }
-            }
-        )
-        if user:
-            query['query']['bool']['should'] = [
-                {
-                    'nested': {
-                        'path': 'tag__permissions__v1.tag__permissions__users__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__permissions__v1.tag__permissions__users__v1.id': user['id']
-                                }
-                            }
-                        }
-                    }
-                },
-                {
-                    'nested': {
-                        'path': 'tag__permissions__v1.tag__permissions__groups__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__permissions__v1.tag__permissions__groups__v1.id':
-                                        u' OR '.join(user['groups'])
-                                }
-                            }
-                        }
-                    }
-                },
-                {
-                    'term': {
-                        'tag__v1.tag__public__v1': True
-                    }
-                }
-            ]
-    # logger.debug(u'to_physical_doc :: query: {}'.format(query))
-    es_response = get_es_response(
-        req_session.get(get_path_search('field-version', **kwargs),
-                        data=json.dumps(query)))
-    # logger.debug(u'to_physical_doc :: response: {}'.format(es_response))
-    return walk(document, is_logical=True, fields_data=es_response['hits']['hits'], tag=tag, doc_type=doc_type,
-                paths=[doc_type])
+    plan = field_version_registry.get_plan(doc_type, tag=tag, index=kwargs.get('index', None))
+    return plan.to_physical(document)
 
 
 def to_physical_fields(document_type, fields, tag=None, user=None):
@@ -332,86 +521,115 @@ def to_physical_fields(document_type, fields, tag=None, user=None):
     :param user:
     :return:
     """
-    query = {
-        'query': {
-            'bool': {
-                'must': [
-                    {
-                        "term": {
-                            "field-version__doc_type__v1.raw__v1": document_type
-                        }
-                    },
-                    {
-                        "term": {
-                            "field-version__is_active__v1": True
-                        }
-                    }
-                ]
-            }
-        },
-        "from": 0, "size": 500,
-    }
-    if tag:
-        query['query']['bool']['must'].append(
-            {
-                'term': {
-                    "tag__v1.tag__slug__v1": tag
-                }
-            }
-        )
-        if user:
-            query['query']['bool']['should'] = [
-                {
-                    'nested': {
-                        'path': 'tag__v1.tag__permissions__v1.tag__permissions__users__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__v1.tag__permissions__v1.tag__permissions__users__v1.id': user['id']
-                                }
-                            }
-                        }
-                    }
-                },
-                {
-                    'nested': {
-                        'path': 'tag__v1.tag__permissions__v1.tag__permissions__groups__v1',
-                        'filter': {
-                            {
-                                'term': {
-                                    'tag__v1.tag__permissions__v1.tag__permisions__groups__v1.id':
-                                        u' OR '.join(user['groups'])
-                                }
-                            }
-                        }
-                    }
-                },
-                {
-                    'term': {
-                        'tag__v1.tag__public__v1': True
-                    }
-                }
-            ]
-    # logger.debug(u'to_physical_fields :: query: {}'.format(json.dumps(query)))
-    es_response = get_es_response(
-        req_session.get(get_path_search('field-version'),
-                        data=json.dumps(query)))
-    # logger.debug(u'to_physical_fields :: response: {}'.format(es_response))
     # here we have all physical fields for document
     field_dict = {}
-    # print u'physical db field response: {}'.format(es_response)
-    # logger.debug(u'to_physical_fields :: count: {}'.format(len(es_response['hits']['hits'])))
-    for field_db_es in es_response['hits']['hits']:
-        field_db_data = field_db_es['_source']
-        # logger.debug(u'to_physical_fields :: field_db_data: {}'.format(field_db_data))
+    for field_db_data in field_version_registry.get(document_type, tag=tag):
         try:
-            # logger.debug(u'to_physical_fields :: db field: {}'.format(field_db_data['field-version__field__v1']))
             field_dict[field_db_data['field-version__field_name__v1']] = field_db_data['field-version__field__v1']
         except (IndexError, KeyError):
             pass
     return field_dict
 
 
+class IdentityMap(object):
+    """
+    Request-scoped map of documents fetched from ElasticSearch
+
+    Documents got by id or slug are kept by (index, doc_type, id or slug, source) while request runs, so reading
+    same app, site, group or user documents again does not go back to ElasticSearch. Writes through
+    DocumentManager evict documents written. Middleware begins map for each request and clears it when request
+    ends; outside requests, like in commands, nothing is kept.
+
+    Map is thread local, calls in AsyncDocumentManager pool see map for request submitting them.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def documents(self):
+        return getattr(self._local, 'documents', None)
+
+    def begin(self):
+        self._local.documents = {}
+
+    def clear(self):
+        self._local.documents = None
+
+    @classmethod
+    def get_key(cls, index, document_type, field, value, source=None):
+        """
+        Get key for document
+
+        :param index:
+        :param document_type:
+        :param field: "id" or "slug"
+        :param value:
+        :param source: Source filtering for document
+        :return:
+        """
+        return index, document_type, field, value, tuple(source) if isinstance(source, list) else source
+
+    def get(self, key):
+        """
+        Get document for key
+
+        :param key:
+        :return: Copy of ElasticSearch document, with _id and _source, None when not in map
+        """
+        documents = self.documents
+        if documents is None or key is None or key not in documents:
+            return None
+        return copy.deepcopy(documents[key])
+
+    def set(self, key, document):
+        """
+        Set document for key, when map is active
+
+        :param key:
+        :param document: ElasticSearch document, with _id and _source
+        :return:
+        """
+        documents = self.documents
+        if documents is not None and key is not None:
+            documents[key] = copy.deepcopy(document)
+
+    def evict(self, document_type, id_):
+        """
+        Evict document written, in any index. Documents got by slug for document type are evicted as well
+
+        :param document_type:
+        :param id_:
+        :return:
+        """
+        documents = self.documents
+        if not documents:
+            return
+        for key in documents.keys():
+            if key[1] == document_type and (key[2] != 'id' or key[3] == id_):
+                documents.pop(key, None)
+
+    def run(self, documents, func, *args, **kwargs):
+        """
+        Run function with documents as identity map for current thread
+
+        :param documents:
+        :param func:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        previous = self.documents
+        self._local.documents = documents
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.documents = previous
+
+
+identity_map = IdentityMap()
+
+
 class DocumentManager(object):
 
     @classmethod
@@ -459,11 +677,25 @@ class DocumentManager(object):
                         fields_generated.append(field_item)
         return fields_generated
 
+    @classmethod
+    def get_source_param(cls, source):
+        """
+        Get url parameter for source filtering
+
+        :param source: List of physical fields included, empty for no source
+        :return:
+        """
+        if not source:
+            return '_source=false'
+        return u'_source_include={}'.format(u','.join(source))
+
     @classmethod
     def get(cls, document_type, **kwargs):
         """
         Get document
 
+        _source keyword argument keeps only those physical fields in source, like _source=['book__title__v1']
+
         :param document_type:
         :param kwargs:
         :return:
@@ -473,6 +705,14 @@ class DocumentManager(object):
         if 'get_logical' in kwargs and kwargs['get_logical']:
             get_logical = True
             del kwargs['get_logical']
+        source = kwargs.pop('_source', None)
+        identity_key = None
+        if 'es_path' not in kwargs and ('id' in kwargs or 'slug' in kwargs):
+            identity_key = identity_map.get_key(kwargs.get('index', settings.SITE_BASE_INDEX),
+                                                document_type,
+                                                'id' if 'id' in kwargs else 'slug',
+                                                kwargs['id'] if 'id' in kwargs else kwargs['slug'],
+                                                source=source)
         if 'es_path' in kwargs:
             es_path = kwargs.pop('es_path')
         else:
@@ -487,9 +727,14 @@ class DocumentManager(object):
                     host=settings.ELASTIC_SEARCH_HOST,
                     index=kwargs.get('index', settings.SITE_BASE_INDEX),
                     document_type=document_type)
-        if 'id' in kwargs:
+        es_response = identity_map.get(identity_key)
+        if es_response is not None:
+            logger.debug(u'Document.get :: document found in identity map: {}'.format(identity_key))
+        elif 'id' in kwargs:
             # do logic for get by id
-            es_response_raw = req_session.get(es_path)
+            if source is not None:
+                es_path = u'{}{}{}'.format(es_path, '&' if '?' in es_path else '?', cls.get_source_param(source))
+            es_response_raw = es_session.get(es_path)
             if es_response_raw.status_code != 200:
                 raise exceptions.DocumentNotFound(_(u'Document "{}" with id "{}" does not exist'.format(
                     document_type, kwargs['id']
@@ -518,7 +763,9 @@ class DocumentManager(object):
                     }
                 }
             }
-            es_response_raw = req_session.get(es_path, data=json.dumps(query_dsl))
+            if source is not None:
+                query_dsl['_source'] = source or False
+            es_response_raw = es_session.get(es_path, data=json.dumps(query_dsl))
             if es_response_raw.status_code != 200:
                 raise exceptions.DocumentNotFound(_(u'Document "{}" with slug "{}" does not exist'.format(
                     document_type, kwargs['slug']
@@ -528,8 +775,14 @@ class DocumentManager(object):
                 raise exceptions.DocumentNotFound(_(u'Document "{}" with slug "{}" does not exist'.format(
                     document_type, kwargs['slug']
                 )))
+            if not es_response['hits']['hits']:
+                raise exceptions.DocumentNotFound(_(u'Document "{}" with slug "{}" does not exist'.format(
+                    document_type, kwargs['slug']
+                )))
+            es_response = es_response['hits']['hits'][0]
         else:
             raise exceptions.XimpiaAPIException(u'We only support get document by id')
+        identity_map.set(identity_key, es_response)
         if get_logical:
             logical_doc = to_logical_doc(document_type, es_response['_source'])
             logical_doc['id'] = es_response['_id']
@@ -537,6 +790,74 @@ class DocumentManager(object):
         else:
             return es_response['_source']
 
+    @classmethod
+    def get_document(cls, document_type, doc, get_logical=False):
+        """
+        Get document from multi-get doc or search hit
+
+        :param document_type:
+        :param doc:
+        :param get_logical:
+        :return:
+        """
+        if get_logical:
+            logical_doc = to_logical_doc(document_type, doc.get('_source', {}))
+            logical_doc['id'] = doc['_id']
+            return logical_doc
+        return doc.get('_source', {})
+
+    @classmethod
+    def get_many(cls, document_type, ids=None, slugs=None, **kwargs):
+        """
+        Get documents by ids and slugs, with one request for ids (_mget) and one for slugs (_msearch)
+
+        apps = Document.objects.get_many('app', ids=['id1', 'id2'], get_logical=True)
+
+        :param document_type:
+        :param ids: List of ids
+        :param slugs: List of slugs
+        :param kwargs: index, get_logical and _source like get
+        :return: List of documents for ids followed by documents for slugs, None for documents not found
+        """
+        index = kwargs.get('index', settings.SITE_BASE_INDEX)
+        get_logical = kwargs.get('get_logical', False)
+        source = kwargs.get('_source', None)
+        documents = []
+        if ids:
+            es_path = '{host}/{index}/{document_type}/_mget'.format(
+                host=settings.ELASTIC_SEARCH_HOST,
+                index=index,
+                document_type=document_type)
+            if source is not None:
+                es_path = u'{}?{}'.format(es_path, cls.get_source_param(source))
+            es_response = get_es_response(es_session.get(es_path, data=json.dumps({'ids': ids})))
+            for doc in es_response['docs']:
+                documents.append(cls.get_document(document_type, doc, get_logical=get_logical)
+                                 if doc.get('found', False) else None)
+        if slugs:
+            searches = []
+            for slug in slugs:
+                query_dsl = {
+                    'query': {
+                        'filtered': {
+                            'filter': {
+                                'term': {
+                                    'slug__v1.raw': slug
+                                }
+                            }
+                        }
+                    },
+                    'size': 1,
+                }
+                if source is not None:
+                    query_dsl['_source'] = source or False
+                searches.append((index, document_type, query_dsl))
+            for es_response in msearch(searches):
+                hits = es_response.get('hits', {}).get('hits', [])
+                documents.append(cls.get_document(document_type, hits[0], get_logical=get_logical)
+                                 if hits else None)
+        return documents
+
     @classmethod
     def filter(cls, document_type, **kwargs):
         """
@@ -547,6 +868,8 @@ class DocumentManager(object):
         field1__field2 = 78
         field1__field2__in=[78, 34]
 
+        _source keyword argument keeps only those physical fields in source
+
         :param document_type:
         :param kwargs:
         :return:
@@ -555,6 +878,7 @@ class DocumentManager(object):
         if 'get_logical' in kwargs and kwargs['get_logical']:
             get_logical = True
             del kwargs['get_logical']
+        source = kwargs.pop('_source', None)
         if 'index' in kwargs:
             index = kwargs.pop('index')
         else:
@@ -614,26 +938,20 @@ class DocumentManager(object):
                 }
             }
         }
+        if source is not None:
+            query_dsl['_source'] = source or False
         logger.debug(u'Document.filter :: type: {} query_dsl:{}'.format(
             document_type,
             query_dsl
         ))
 
         # print u'query_dsl: {}'.format(query_dsl)
-        es_response_raw = req_session.get(es_path,
+        es_response_raw = es_session.get(es_path,
                                           data=json.dumps(query_dsl))
         es_response = es_response_raw.json()
         # print es_response_raw.content
         if get_logical:
-            output = []
-            for item in es_response['hits']['hits']:
-                item_data = item['_source']
-                # item_data['id'] = item['_id']
-                item_document = to_logical_doc(document_type, item_data)
-                item_document['id'] = item['_id']
-                output.append(
-                    item_document
-                )
+            output = list(to_logical_docs(document_type, es_response['hits']['hits']))
         else:
             output = es_response['hits']['hits']
         return output
@@ -653,7 +971,9 @@ class DocumentManager(object):
         else:
             index = document_type
             document_type = index.split('__')[-1]
-        es_response_raw = req_session.post(
+        identity_map.evict(document_type, id_)
+        base_document_cache.evict(document_type, id_)
+        es_response_raw = es_session.post(
             '{host}/{index}/{document_type}/{id_}/_update'.format(
                 host=settings.ELASTIC_SEARCH_HOST,
                 index=index,
@@ -687,7 +1007,9 @@ class DocumentManager(object):
         else:
             index = document_type
             document_type = index.split('__')[-1]
-        es_response_raw = req_session.put(
+        identity_map.evict(document_type, id_)
+        base_document_cache.evict(document_type, id_)
+        es_response_raw = es_session.put(
             '{host}/{index}/{document_type}/{id_}'.format(
                 host=settings.ELASTIC_SEARCH_HOST,
                 index=index,
@@ -704,9 +1026,84 @@ class DocumentManager(object):
         return es_response_raw.json()
 
 
+class AsyncDocumentManager(object):
+    """
+    Non blocking variant of DocumentManager
+
+    Same API as DocumentManager, but methods return pending results instead of documents, so independent
+    ElasticSearch calls overlap:
+
+    app_result = Document.async_objects.get('app', id=app_id)
+    user_result = Document.async_objects.get('user', id=user_id)
+    app, user = Document.async_objects.gather(app_result, user_result)
+
+    Calls run in a thread pool shared by process, created on first use so it is not shared with forked
+    workers. Requests go through es_session, so threads share its connection pool.
+    """
+
+    _pool = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        """
+        Get thread pool, created on first use
+
+        :return:
+        """
+        if cls._pool is None:
+            with cls._lock:
+                if cls._pool is None:
+                    cls._pool = ThreadPool(DOCUMENT_ASYNC_POOL_SIZE)
+        return cls._pool
+
+    @classmethod
+    def submit(cls, func, *args, **kwargs):
+        """
+        Run any blocking call in pool, like es_session.post
+
+        Calls see identity map for request submitting them.
+
+        :param func:
+        :param args:
+        :param kwargs:
+        :return: Pending result
+        """
+        return cls.get_pool().apply_async(identity_map.run, (identity_map.documents, func) + args, kwargs)
+
+    @classmethod
+    def gather(cls, *results, **kwargs):
+        """
+        Wait for pending results
+
+        :param results: Pending results
+        :param timeout: Seconds to wait for each result
+        :return: List of values in same order as results. First error found is raised.
+        """
+        timeout = kwargs.get('timeout', DOCUMENT_ASYNC_TIMEOUT)
+        return map(lambda x: x.get(timeout), results)
+
+    @classmethod
+    def get(cls, document_type, **kwargs):
+        return cls.submit(DocumentManager.get, document_type, **kwargs)
+
+    @classmethod
+    def filter(cls, document_type, **kwargs):
+        return cls.submit(DocumentManager.filter, document_type, **kwargs)
+
+    @classmethod
+    def update_partial(cls, document_type, id_, partial_document, **kwargs):
+        return cls.submit(DocumentManager.update_partial, document_type, id_, partial_document, **kwargs)
+
+    @classmethod
+    def update(cls, document_type, id_, document, **kwargs):
+        return cls.submit(DocumentManager.update, document_type, id_, document, **kwargs)
+
+
 class Document(object):
 
     objects = DocumentManager()
+    async_objects = AsyncDocumentManager()
 
 
 def walk_mapping(mapping_piece):
@@ -791,58 +1188,63 @@ def get_fields_from_mapping(mapping):
     return field_versions
 
 
-def save_field_versions_from_mapping(mapping, index='ximpia-api__base', user=None,
-                                     tag=None, branch=None):
+def get_field_version_documents(mapping, user=None, tag=None, branch=None):
     """
-    Save data into field versions for all fields in a mapping
+    Get field version documents for all fields in a mapping
 
     :param mapping:
-    :return:
+    :param user:
+    :param tag:
+    :param branch:
+    :return: List of physical field version documents
     """
-    # logger.debug(u'save_field_versions_from_mapping...')
     from datetime import datetime
     now_es = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    fields = get_fields_from_mapping(mapping)
-    fields_version_str = ''
     doc_type = mapping.keys()[0]
     user_id = getattr(user, 'id', None)
     user_name = getattr(user, 'username', None)
-    # logger.debug(u'save_field_versions_from_mapping :: [{}] fields: {}'.format(doc_type, len(fields)))
-    for field in fields:
+    documents = []
+    for field in get_fields_from_mapping(mapping):
         if field in ['text', 'text__v1']:
             continue
-        bulk_header = '{ "create": { "_index": "' + index + '__field-version' + '", "_type": "field-version"} }\n'
-        bulk_data = json.dumps(
-            {
-                'field-version__doc_type__v1': doc_type,
-                'field-version__field__v1': field['field'],
-                'field-version__field_name__v1': field['field_name'],
-                'field-version__version__v1': field['version'],
-                'field-version__is_active__v1': True,
-                'tag__v1': tag,
-                'branch__v1': branch,
-                'field-version__created_by__v1': {
-                    'field-version__created_by__id': user_id,
-                    'field-version__created_by__user_name__v1': user_name
-                },
-                'field-version__created_on__v1': now_es,
-            }
-        ) + '\n'
-        if not fields_version_str:
-            fields_version_str = bulk_header
-            fields_version_str += bulk_data
-        else:
-            fields_version_str += bulk_header
-            fields_version_str += bulk_data
-    es_response_raw = requests.post(
+        documents.append({
+            'field-version__doc_type__v1': doc_type,
+            'field-version__field__v1': field['field'],
+            'field-version__field_name__v1': field['field_name'],
+            'field-version__version__v1': field['version'],
+            'field-version__is_active__v1': True,
+            'tag__v1': tag,
+            'branch__v1': branch,
+            'field-version__created_by__v1': {
+                'field-version__created_by__id': user_id,
+                'field-version__created_by__user_name__v1': user_name
+            },
+            'field-version__created_on__v1': now_es,
+        })
+    return documents
+
+
+def save_field_versions_from_mapping(mapping, index='ximpia-api__base', user=None,
+                                     tag=None, branch=None):
+    """
+    Save data into field versions for all fields in a mapping
+
+    :param mapping:
+    :return:
+    """
+    doc_type = mapping.keys()[0]
+    fields_version_str = ''
+    bulk_header = '{ "create": { "_index": "' + index + '__field-version' + '", "_type": "field-version"} }\n'
+    for document in get_field_version_documents(mapping, user=user, tag=tag, branch=branch):
+        fields_version_str += bulk_header
+        fields_version_str += json.dumps(document) + '\n'
+    es_response_raw = es_session.post(
         '{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
         data=fields_version_str,
         headers={'Content-Type': 'application/octet-stream'},
     )
-    # logger.debug(u'save_field_versions_from_mapping :: status: {}'.format(es_response_raw.status_code))
     es_response = es_response_raw.json()
-    # logger.debug(u'save_field_versions_from_mapping :: bulk response: {}'.format(es_response))
-    # logger.debug(u'save_field_versions_from_mapping :: response: {}'.format(es_response))
+    field_version_registry.invalidate(doc_type=doc_type, index=index)
     logger.info(u'save_field_versions_from_mapping :: doc_type: {} is OK: {} items: {}'.format(
         doc_type,
         es_response_raw.status_code in [200, 201] and es_response['errors'] is False,
@@ -1045,7 +1447,7 @@ class DocumentDefinition(object):
         # Make ES request
         pprint.PrettyPrinter(indent=2).pprint(bulk_queries)
         bulk_queries_request = map(lambda x: bulk_queries[x], bulk_queries_keys)
-        es_response_raw = requests.get(
+        es_response_raw = es_session.get(
             '{host}/_msearch'.format(
                 host=settings.ELASTIC_SEARCH_HOST
             ),
@@ -0,0 +1,40 @@
+import time
+
+from base.tests import XimpiaTestCase
+from base import exceptions
+
+__author__ = 'jorgealegre'
+
+
+def slow_value(value, wait=0.1):
+    time.sleep(wait)
+    return value
+
+
+def raise_not_found(document_type):
+    raise exceptions.DocumentNotFound(u'Document "{}" does not exist'.format(document_type))
+
+
+class AsyncDocumentManagerTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_gather(self):
+        from document import AsyncDocumentManager
+        start = time.time()
+        values = AsyncDocumentManager.gather(*map(lambda x: AsyncDocumentManager.submit(slow_value, x),
+                                                  range(5)))
+        self.assertTrue(values == range(5))
+        # calls overlap
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_gather_error(self):
+        from document import AsyncDocumentManager
+        self.assertRaises(exceptions.DocumentNotFound,
+                          AsyncDocumentManager.gather,
+                          AsyncDocumentManager.submit(slow_value, 'app'),
+                          AsyncDocumentManager.submit(raise_not_found, 'user'))
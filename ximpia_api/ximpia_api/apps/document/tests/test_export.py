@@ -0,0 +1,78 @@
+import json
+
+from django.conf import settings
+
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+def get_page(number, pages=2):
+    hits = []
+    if number < pages:
+        hits = [{
+            '_id': '{}-{}'.format(number, x),
+            '_source': {
+                'book__title__v1': 'Book {}-{}'.format(number, x)
+            }
+        } for x in range(2)]
+    return {'_scroll_id': str(number + 1), 'hits': {'hits': hits}}
+
+
+class ExportTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers scroll over book collection with 2 pages of 2 hits
+    """
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_search/scroll', lambda request: get_page(int(request.body))),
+            ('GET', r'/_search', get_page(0)),
+            ('DELETE', r'^/_search/scroll', {'succeeded': True}),
+        ]
+
+    def setUp(self):
+        from document import field_version_registry
+        super(ExportTest, self).setUp()
+        field_version_registry._cache.set((settings.SITE_BASE_INDEX, 'book', 'v1', None), [
+            {
+                'field-version__field__v1': 'book__title__v1',
+                'tag__v1': {'tag__public__v1': True}
+            },
+            {
+                'field-version__field__v1': 'book__price__v1',
+                'tag__v1': {'tag__public__v1': True}
+            },
+        ])
+
+    def tearDown(self):
+        from document import field_version_registry
+        field_version_registry.invalidate(doc_type='book')
+        super(ExportTest, self).tearDown()
+
+    def _get_view(self):
+        from document.views import DocumentViewSet
+
+        class BookViewSet(DocumentViewSet):
+            document_type = 'book'
+            app = 'library'
+        return BookViewSet
+
+    def test_export_source(self):
+        view = self._get_view()
+        self.assertTrue(view._get_export_source('v1', None) == ['book__price__v1', 'book__title__v1'])
+        self.assertTrue(view._get_export_source('v1', None, fields=['title', 'missing']) == ['book__title__v1'])
+        # export is empty
+        self.assertTrue(view._get_export_source('v1', None, fields=['missing']) is False)
+
+    def test_export_lines(self):
+        view = self._get_view()
+        with self.settings(ELASTIC_SEARCH_HOST=self.host, SITE='my-site'):
+            lines = list(view._export_lines({'query': {'match_all': {}}, '_source': ['book__title__v1']},
+                                            tag='v1'))
+        self.assertTrue(len(lines) == 4)
+        self.assertTrue(all(map(lambda x: x.endswith('\n'), lines)))
+        self.assertTrue(json.loads(lines[3]) == {'id': '1-1', 'title': 'Book 1-1'})
+        search = self.stub.get_requests('GET', r'/_search\?')[0]
+        self.assertTrue(search.path.startswith('/my-site__library/book/_search'))
+        self.assertTrue(search.json()['_source'] == ['book__title__v1'])
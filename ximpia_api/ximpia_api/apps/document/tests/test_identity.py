@@ -0,0 +1,50 @@
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+class IdentityMapTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers get by id and update for app documents
+    """
+
+    def get_routes(self):
+        return [
+            ('GET', r'', lambda request: {'_id': request.path.split('/')[-1], 'found': True,
+                                          '_source': {'app__name__v1': 'My App'}}),
+            ('POST', r'', {'_id': 'my-app', '_version': 2}),
+        ]
+
+    def tearDown(self):
+        from document import identity_map
+        identity_map.clear()
+        super(IdentityMapTest, self).tearDown()
+
+    def _get_requests(self):
+        return self.stub.get_requests('GET')
+
+    def test_request_scope(self):
+        from document import Document, identity_map
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            # no request, nothing kept
+            Document.objects.get('app', id='my-app')
+            Document.objects.get('app', id='my-app')
+            self.assertTrue(len(self._get_requests()) == 2)
+            identity_map.begin()
+            app = Document.objects.get('app', id='my-app', get_logical=True)
+            app['name'] = 'Changed by caller'
+            self.assertTrue(Document.objects.get('app', id='my-app', get_logical=True)['name'] == 'My App')
+            app, = Document.async_objects.gather(Document.async_objects.get('app', id='my-app'))
+            self.assertTrue(len(self._get_requests()) == 3)
+            identity_map.clear()
+            Document.objects.get('app', id='my-app')
+            self.assertTrue(len(self._get_requests()) == 4)
+
+    def test_evict(self):
+        from document import Document, identity_map
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            identity_map.begin()
+            Document.objects.get('app', id='my-app')
+            Document.objects.update_partial('app', 'my-app', {'app__name__v1': 'Other name'})
+            Document.objects.get('app', id='my-app')
+            self.assertTrue(len(self._get_requests()) == 2)
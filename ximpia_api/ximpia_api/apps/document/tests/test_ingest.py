@@ -0,0 +1,116 @@
+import json
+
+from django.conf import settings
+
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+def get_bulk_items(request):
+    items = []
+    for line in request.body.splitlines()[::2]:
+        meta = json.loads(line)['index']
+        items.append({'index': {'_id': meta.get('_id', 'generated'), 'status': 201}})
+    return {'errors': False, 'items': items}
+
+
+class IngestTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers bulk requests with a result item for each action
+    """
+
+    def get_routes(self):
+        return [
+            ('POST', r'^/_bulk', get_bulk_items),
+        ]
+
+    def setUp(self):
+        from document import field_version_registry
+        super(IngestTest, self).setUp()
+        field_version_registry._cache.set((settings.SITE_BASE_INDEX, 'book', 'v1', None), [
+            {'field-version__field__v1': 'book__title__v2'},
+        ])
+
+    def tearDown(self):
+        from document import field_version_registry
+        field_version_registry.invalidate(doc_type='book')
+        super(IngestTest, self).tearDown()
+
+    def _get_view(self):
+        from document.views import DocumentViewSet
+
+        class BookViewSet(DocumentViewSet):
+            document_type = 'book'
+            app = 'library'
+        return BookViewSet
+
+    def test_ingest_lines(self):
+        BookViewSet = self._get_view()
+        lines = [
+            json.dumps({'id': '1', 'title': 'Dune'}) + '\n',
+            'not json\n',
+            '\n',
+            json.dumps({'title': 'Hyperion'}) + '\n',
+            json.dumps({'id': '3', 'title': 'Foundation'}) + '\n',
+        ]
+        with self.settings(ELASTIC_SEARCH_HOST=self.host, SITE='my-site'):
+            results = map(json.loads, BookViewSet._ingest_lines(lines, tag='v1', flush_size=2, workers=1))
+        self.assertTrue(results[-1]['stats']['actions'] == 3)
+        self.assertTrue(results[-1]['stats']['requests'] == 2)
+        self.assertTrue(results[-1]['stats']['errors'] == 1)
+        self.assertTrue(filter(lambda x: 'line' in x, results) == [
+            {'line': 1, 'status': 400, 'error': 'No JSON object could be decoded'}
+        ])
+        self.assertTrue(sorted(map(lambda x: x['index']['_id'], filter(lambda x: 'index' in x, results))) ==
+                        ['1', '3', 'generated'])
+        lines = ''.join(map(lambda x: x.body, self.stub.get_requests('POST'))).splitlines()
+        self.assertTrue(json.loads(lines[0]) == {'index': {'_index': 'my-site__library', '_type': 'book', '_id': '1'}})
+        # documents translated with field versions for tag
+        self.assertTrue(json.loads(lines[1]) == {'book__title__v2': 'Dune'})
+
+    def test_ingest_closed(self):
+        BookViewSet = self._get_view()
+        lines = [
+            json.dumps({'id': '1', 'title': 'Dune'}) + '\n',
+            'not json\n',
+            json.dumps({'id': '3', 'title': 'Foundation'}) + '\n',
+        ]
+        with self.settings(ELASTIC_SEARCH_HOST=self.host, SITE='my-site'):
+            results = BookViewSet._ingest_lines(lines, tag='v1', flush_size=10, workers=1)
+            self.assertTrue(json.loads(next(results))['line'] == 1)
+            # client disconnects
+            results.close()
+        # documents read are written
+        bulk_requests = self.stub.get_requests('POST')
+        self.assertTrue(len(bulk_requests) == 1)
+        self.assertTrue(len(bulk_requests[0].body.splitlines()) == 2)
+
+    def test_ingest_not_object(self):
+        BookViewSet = self._get_view()
+        lines = [
+            '[1, 2]\n',
+            '"Dune"\n',
+            json.dumps({'id': '1', 'title': 'Dune'}) + '\n',
+        ]
+        with self.settings(ELASTIC_SEARCH_HOST=self.host, SITE='my-site'):
+            results = map(json.loads, BookViewSet._ingest_lines(lines, tag='v1', flush_size=10, workers=1))
+        self.assertTrue(map(lambda x: (x['line'], x['status']), filter(lambda x: 'line' in x, results)) ==
+                        [(0, 400), (1, 400)])
+        self.assertTrue(results[-1]['stats']['actions'] == 1)
+        self.assertTrue(results[-1]['stats']['errors'] == 2)
+
+    def test_int_param(self):
+        from rest_framework.exceptions import ParseError
+        BookViewSet = self._get_view()
+
+        class Request(object):
+            def __init__(self, **query_params):
+                self.query_params = query_params
+
+        self.assertTrue(BookViewSet._get_int_param(Request(), 'workers', 4) == 4)
+        self.assertTrue(BookViewSet._get_int_param(Request(workers='2'), 'workers', 4) == 2)
+        self.assertTrue(BookViewSet._get_int_param(Request(workers='0'), 'workers', 4) == 1)
+        self.assertTrue(BookViewSet._get_int_param(Request(workers='99'), 'workers', 4) == 4)
+        with self.assertRaises(ParseError):
+            BookViewSet._get_int_param(Request(workers='many'), 'workers', 4)
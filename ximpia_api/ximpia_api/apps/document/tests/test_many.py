@@ -0,0 +1,46 @@
+import json
+
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+def get_doc(id_):
+    if id_ not in ['1', '2', '3']:
+        return {'_id': id_, 'found': False}
+    return {'_id': id_, 'found': True, '_source': {'app__name__v1': 'App {}'.format(id_)}}
+
+
+def mget(request):
+    data = request.json()
+    ids = data['ids'] if 'ids' in data else map(lambda x: x['_id'], data['docs'])
+    return {'docs': map(get_doc, ids)}
+
+
+def msearch(request):
+    responses = []
+    for line in request.body.splitlines()[1::2]:
+        slug = json.loads(line)['query']['filtered']['filter']['term']['slug__v1.raw']
+        doc = get_doc(slug.split('-')[-1])
+        responses.append({'hits': {'hits': [doc] if doc['found'] else []}})
+    return {'responses': responses}
+
+
+class GetManyTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers _mget and _msearch for documents with ids "1" to "3" and slug "slug-<id>"
+    """
+
+    def get_routes(self):
+        return [
+            ('GET', r'/_mget', mget),
+            ('GET', r'/_msearch', msearch),
+        ]
+
+    def test_get_many(self):
+        from document import Document
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            documents = Document.objects.get_many('app', ids=['1', '4'], slugs=['slug-2', 'slug-5'],
+                                                  get_logical=True)
+        self.assertTrue(len(self.stub.requests) == 2)
+        self.assertTrue(documents == [{'id': '1', 'name': 'App 1'}, None, {'id': '2', 'name': 'App 2'}, None])
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from base.tests import XimpiaTestCase
+
+__author__ = 'jorgealegre'
+
+
+def get_field_version(field, public=False, user_id=None, group_id=None):
+    permission = {}
+    if user_id:
+        permission['tag__permissions__user__v1'] = {'tag__permissions__user__id': user_id}
+    if group_id:
+        permission['tag__permissions__group__v1'] = {'tag__permissions__group__id': group_id}
+    return {
+        'field-version__field__v1': field,
+        'tag__v1': {
+            'tag__slug__v1': 'v1',
+            'tag__public__v1': public,
+            'tag__permissions__v1': [permission] if permission else [],
+        }
+    }
+
+
+class FieldPermissionIndexTest(XimpiaTestCase):
+
+    field_versions = [
+        get_field_version('book__title__v1', public=True),
+        get_field_version('book__price__v1', group_id='editors'),
+        get_field_version('book__notes__v1', user_id='john'),
+    ]
+
+    def setUp(self):
+        from document import field_version_registry
+        field_version_registry._cache.set((settings.SITE_BASE_INDEX, 'book', 'v1', None), self.field_versions)
+
+    def tearDown(self):
+        from document import field_version_registry
+        field_version_registry.invalidate(doc_type='book')
+
+    def _get_user(self, user_id, groups):
+        user = User()
+        user.document = {
+            'id': user_id,
+            'groups': map(lambda x: {'id': x}, groups)
+        }
+        return user
+
+    def test_visible(self):
+        from document import field_permission_index
+        self.assertTrue(field_permission_index.get('book', tag='v1') == frozenset(['book__title__v1']))
+        self.assertTrue(field_permission_index.get('book', tag='v1', user=self._get_user('mary', ['editors'])) ==
+                        frozenset(['book__title__v1', 'book__price__v1']))
+        self.assertTrue(field_permission_index.get('book', tag='v1', user=self._get_user('john', ['users'])) ==
+                        frozenset(['book__title__v1', 'book__notes__v1']))
+
+    def test_filter_fields(self):
+        from document import field_permission_index
+        visible = field_permission_index.get('book', tag='v1', user=self._get_user('mary', ['editors']))
+        document = field_permission_index.filter_fields(visible, {
+            'book__title__v1': 'Dune',
+            'book__price__v1': 10,
+            'book__notes__v1': 'signed',
+        })
+        self.assertTrue(document == {'book__title__v1': 'Dune', 'book__price__v1': 10})
+
+    def test_invalidate(self):
+        from document import field_version_registry, field_permission_index
+        field_permission_index.get('book', tag='v1')
+        self.assertTrue(len(field_permission_index._cache) == 1)
+        field_version_registry.invalidate(doc_type='book')
+        self.assertTrue(len(field_permission_index._cache) == 0)
+
+    def test_source(self):
+        from document import field_permission_index, DocumentManager
+        visible = field_permission_index.get('book', tag='v1', user=self._get_user('mary', ['editors']))
+        source = field_permission_index.get_source(visible)
+        self.assertTrue(source == ['book__price__v1', 'book__title__v1'])
+        self.assertTrue(DocumentManager.get_source_param(source) ==
+                        '_source_include=book__price__v1,book__title__v1')
+        self.assertTrue(field_permission_index.get_source(frozenset()) is False)
+        self.assertTrue(DocumentManager.get_source_param(False) == '_source=false')
@@ -0,0 +1,94 @@
+import logging
+
+from base.tests import XimpiaTestCase
+from base import exceptions
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+
+class TranslationPlanTest(XimpiaTestCase):
+
+    fields = [
+        'user__name__v1',
+        'user__name__v2',
+        'user__token__v1',
+        'user__token__key__v1',
+        'groups__v1',
+        'group__id',
+        'app__v1',
+        'app__id',
+        'app__slug__v1',
+    ]
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_to_physical(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('user', self.fields)
+        physical = plan.to_physical({
+            'name': 'john',
+            'token': {
+                'key': 'my-key'
+            },
+            'groups': [
+                {'id': 'users'}
+            ],
+            'app': {
+                'id': 'my-app',
+                'slug': 'base'
+            },
+        })
+        logger.debug(u'TranslationPlanTest.test_to_physical :: physical: {}'.format(physical))
+        self.assertTrue(physical['user__name__v2'] == 'john')
+        self.assertTrue(physical['user__token__v1'] == {'user__token__key__v1': 'my-key'})
+        self.assertTrue(physical['groups__v1'] == [{'id': 'users'}])
+        self.assertTrue(physical['app__v1'] == {'app__id': 'my-app', 'app__slug__v1': 'base'})
+
+    def test_to_physical_default(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('user')
+        self.assertTrue(plan.to_physical({'name': 'john'}) == {'user__name__v1': 'john'})
+
+    def test_to_physical_ambiguous(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('app', ['app__name__v1', 'site__name__v1'])
+        self.assertRaises(exceptions.XimpiaAPIException, plan.to_physical, {'site': {'name': 'site'}})
+
+    def test_to_physical_field(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('user', self.fields)
+        self.assertTrue(plan.to_physical_field('name') == 'user__name__v2')
+        self.assertTrue(plan.to_physical_field('token.key') == 'user__token__v1.user__token__key__v1')
+        self.assertTrue(plan.to_physical_field('_uid') == '_uid')
+
+    def test_to_logical(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('user')
+        logical = plan.to_logical({
+            'user__name__v1': 'john',
+            'user__name__v2': 'john v2',
+            'user__token__v1': {
+                'user__token__key__v1': 'my-key'
+            },
+            'groups__v1': [
+                {'group__id': 'users'}
+            ],
+        })
+        self.assertTrue(logical['name'] == 'john v2')
+        self.assertTrue(logical['token'] == {'key': 'my-key'})
+        self.assertTrue(logical['groups'] == [{'id': 'users'}])
+
+    def test_to_logical_pinned(self):
+        from document import TranslationPlan
+        plan = TranslationPlan('user', ['user__name__v1'], pin_versions=True)
+        logical = plan.to_logical({
+            'user__name__v1': 'john',
+            'user__name__v2': 'john v2',
+        })
+        self.assertTrue(logical['name'] == 'john')
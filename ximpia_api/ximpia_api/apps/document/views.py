@@ -1,30 +1,32 @@
-import requests
-from requests.adapters import HTTPAdapter
 import json
 import logging
+import Queue
 from datetime import datetime
 import pprint
 
 from rest_framework import viewsets, generics
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 
 from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.utils.translation import ugettext as _
 from django.utils.text import slugify
 
 from base import exceptions
 
-from document import to_physical_doc, Document, DocumentDefinition
-from base import get_es_response, get_path_search, get_site
+from document import to_physical_doc, to_logical_docs, Document, DocumentDefinition, field_version_registry, \
+    field_permission_index, AsyncDocumentManager
+from base import get_site
+from base.bulk import scroll, BulkWriter, BULK_FLUSH_SIZE, BULK_WORKERS
+from base.transport import es_session
+from query_build import get_page_query, get_page, get_query_request, to_physical_payload, PAGE_SIZE, \
+    MAX_PAGE_SIZE
 
 __author__ = 'jorgealegre'
 
 logger = logging.getLogger(__name__)
 
-req_session = requests.Session()
-req_session.mount('https://{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=3))
-
 
 class DocumentViewSet(viewsets.ModelViewSet):
 
@@ -36,109 +38,34 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """
         Process settings
 
+        Settings for site and app are attached to request as an immutable snapshot, request.site_settings, cached
+        in process until settings documents change.
+
         :param request:
-        :return:
+        :return: SettingsSnapshot
         """
-        from base import get_setting_table_value, get_setting_value
-        from . import Document, to_logical_doc
-        site_slug = request.META['HTTP_HOST'].split(settings.XIMPIA_DOMAIN)[0]
+        from base.routing import RouteTableManager
+        from base.site_settings import site_settings_manager
+        site_slug = RouteTableManager.get_host_site(request.META.get('HTTP_HOST', None))
         # Where do I get app from?
         # When we resolve url, we get app_id
         app_id = getattr(request, 'app_id', -1)
         if app_id == -1:
             raise exceptions.XimpiaAPIException(u'App id not found in context, we can\'t process request')
-        db_settings = Document.objects.filter('_settings',
-                                              site__slug__raw=site_slug,
-                                              app__id=app_id)
-        for db_setting_doc in db_settings['hits']['hits']:
-            setting_doc = to_logical_doc('_settings', db_setting_doc)
-            if setting_doc['fields']:
-                setattr(settings,
-                        setting_doc['_source']['name'],
-                        get_setting_table_value(setting_doc['_source']['fields']))
-            else:
-                setattr(settings,
-                        setting_doc['_source']['name'],
-                        get_setting_value(setting_doc['_source']['value']))
+        request.site_settings = site_settings_manager.get(site_slug, app_id)
+        return request.site_settings
 
     @classmethod
-    def _filter_doc_fields(cls, tag, user, document):
+    def _get_source(cls, tag, user):
         """
-        Filter document fields based on user permissions for tag
+        Get source filtering for fields user can see for tag, so ElasticSearch only sends permitted fields
 
         :param tag:
         :param user:
-        :param document:
-        :return:
+        :return: List of physical fields, False when user can't see any field
         """
-        query = {
-            'query': {
-                'bool': {
-                    'must': [
-                        {
-                            "term": {
-                                "doc_type__v1": cls.document_type
-                            }
-                        },
-                        {
-                            "term": {
-                                "is_active__v1": True
-                            }
-                        }
-                    ]
-                }
-            }
-        }
-        if tag:
-            query['query']['bool']['must'].append(
-                {
-                    'term': {
-                        "tag__v1": tag
-                    }
-                }
-            )
-            if user:
-                query['query']['bool']['should'] = [
-                    {
-                        'nested': {
-                            'path': 'permissions__v1.users__v1',
-                            'filter': {
-                                {
-                                    'term': {
-                                        'permissions__v1.users__v1.id': user['id']
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    {
-                        'nested': {
-                            'path': 'permissions__v1.groups__v1',
-                            'filter': {
-                                {
-                                    'term': {
-                                        'permissions__v1.groups__v1.id': u' OR '.join(user['groups'])
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    {
-                        'term': {
-                            'tag.public': True
-                        }
-                    }
-                ]
-        es_response_raw = get_es_response(
-            req_session.get(get_path_search('field-version'),
-                            data=json.dumps(query)))
-        es_response = es_response_raw.json()
-        db_fields = map(lambda x: x['field__v1'], es_response['hits']['hits'])
-        document_new = {}
-        for key in document:
-            if key in db_fields:
-                document_new[key] = document[key]
-        return document_new
+        return field_permission_index.get_source(
+            field_permission_index.get(cls.document_type, tag=tag, user=user))
 
     def create(self, request, *args, **kwargs):
         """
@@ -156,12 +83,12 @@ class DocumentViewSet(viewsets.ModelViewSet):
         self._process_settings(request)
         tag = kwargs.get('tag', 'v1')
         # check that user and tag allows this operation
-        es_response_raw = req_session.post(
-            '{}/{}/_{document_type}'.format(
+        es_response_raw = es_session.post(
+            '{}/{}/{document_type}'.format(
                 settings.ELASTIC_SEARCH_HOST,
                 '{site}__{app}'.format(site=settings.SITE, app=self.app),
                 document_type=self.document_type),
-            data=to_physical_doc(self.document_type, request.data, tag=tag, user=request.user))
+            data=json.dumps(to_physical_doc(self.document_type, request.data, tag=tag, user=request.user)))
         if es_response_raw.status_code != 200:
             exceptions.XimpiaAPIException(_(u'Could not save "{doc_type}"'.format(
                 doc_type=self.document_type)))
@@ -185,13 +112,13 @@ class DocumentViewSet(viewsets.ModelViewSet):
         id_ = args[0]
         # TODO: check that tag and user allows getting content
         tag = kwargs.get('tag', 'v1')
-        es_response_raw = req_session.put(
-            '{}/{}/_{document_type}/{id}'.format(
+        es_response_raw = es_session.put(
+            '{}/{}/{document_type}/{id}'.format(
                 settings.ELASTIC_SEARCH_HOST,
                 '{site}__{app}'.format(site=settings.SITE, app=self.app),
                 document_type=self.document_type,
                 id=id_),
-            data=to_physical_doc(self.document_type, request.data, tag=tag, user=request.user))
+            data=json.dumps(to_physical_doc(self.document_type, request.data, tag=tag, user=request.user)))
         if es_response_raw.status_code != 200:
             exceptions.XimpiaAPIException(_(u'Could not update document'))
         es_response = es_response_raw.json()
@@ -206,9 +133,16 @@ class DocumentViewSet(viewsets.ModelViewSet):
         Get list of documents and searches
 
         request attributes:
-        * page (optional)
+        * cursor (optional): Cursor for next page, returned with previous page
         * per_page (optional)
-        * order_by (optional)
+        * order_by (optional): Like "name,-post_date", when payload has no sort
+
+        Pages are keyset paginated on sort with unique tiebreaker, so deep pages cost as first page:
+
+        {
+          "items": [...],
+          "next_cursor": "WyJqb2huIiwgImJvb2sjMTIiXQ=="
+        }
 
         payload would have filters, data, etc... just key: value in payload, attributes to be pasted into query
 
@@ -266,31 +200,50 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """
         self._process_settings(request)
         query_name = None
+        tag = kwargs.get('tag', 'v1')
         if len(args) == 1:
             query_name = args[0]
-            # get query DSL from query container
-            query_dsl = {}
-            es_response_raw = req_session.get(
-                '{}/{}/_{document_type}/_search'.format(
-                    settings.ELASTIC_SEARCH_HOST,
-                    '{site}__{app}'.format(site=settings.SITE, app=self.app),
-                    document_type=self.document_type),
-                data=json.dumps(query_dsl))
-        else:
-            es_response_raw = req_session.get(
-                '{}/{}/_{document_type}/_search'.format(
-                    settings.ELASTIC_SEARCH_HOST,
-                    '{site}__{app}'.format(site=settings.SITE, app=self.app),
-                    document_type=self.document_type))
+        try:
+            size = min(max(int(request.query_params.get('per_page', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            raise ParseError(_(u'per_page must be a number'))
+        source = self._get_source(tag, request.user)
+        if source is False:
+            # user can't see any field
+            return Response({
+                'items': [],
+                'next_cursor': None,
+            })
+        payload = dict(request.data) if isinstance(request.data, dict) else {}
+        if 'sort' not in payload and request.query_params.get('order_by', None):
+            payload['sort'] = map(lambda x: {x.lstrip('-'): {'order': 'desc' if x.startswith('-') else 'asc'}},
+                                  request.query_params['order_by'].split(','))
+        # fields are indexed with physical names
+        payload = to_physical_payload(payload,
+                                     field_version_registry.get_plan(self.document_type, tag=tag).to_physical_field)
+        query_dsl, sort_fields = get_page_query(payload,
+                                                cursor=request.query_params.get('cursor', None),
+                                                size=size)
+        query_dsl['_source'] = source
+        es_response_raw = es_session.get(
+            '{}/{}/{document_type}/_search'.format(
+                settings.ELASTIC_SEARCH_HOST,
+                '{site}__{app}'.format(site=settings.SITE, app=self.app),
+                document_type=self.document_type),
+            data=json.dumps(query_dsl))
         if es_response_raw.status_code != 200:
-            exceptions.XimpiaAPIException(_(u'Could not search collection'))
+            raise exceptions.XimpiaAPIException(_(u'Could not search collection'))
         es_response = es_response_raw.json()
         logger.info(u'DocumentViewSet.list :: Performed search "{query_name}" '
                     u'for document {document_type}'.format(
                         query_name=query_name,
                         document_type=self.document_type))
+        hits, next_cursor = get_page(es_response['hits']['hits'], size=size)
         # make output of logical documents from physical ones
-        return Response(es_response['hits']['hits'])
+        return Response({
+            'items': list(to_logical_docs(self.document_type, hits, tag=tag)),
+            'next_cursor': next_cursor,
+        })
 
     def retrieve(self, request, *args, **kwargs):
         """
@@ -304,13 +257,13 @@ class DocumentViewSet(viewsets.ModelViewSet):
         self._process_settings(request)
         id_ = args[0]
         tag = kwargs.get('tag', 'v1')
-        # TODO: check that tag and user allows getting content
-        es_response_raw = req_session.get(
-            '{}/{}/_{document_type}/{id}'.format(
+        es_response_raw = es_session.get(
+            '{}/{}/{document_type}/{id}?{source}'.format(
                 settings.ELASTIC_SEARCH_HOST,
                 '{site}__{app}'.format(site=settings.SITE, app=self.app),
                 document_type=self.document_type,
-                id=id_))
+                id=id_,
+                source=Document.objects.get_source_param(self._get_source(tag, request.user))))
         if es_response_raw.status_code != 200:
             exceptions.XimpiaAPIException(_(u'Could not get document'))
         es_response = es_response_raw.json()
@@ -318,8 +271,171 @@ class DocumentViewSet(viewsets.ModelViewSet):
             id=es_response.get('_id', ''),
             document_type=self.document_type
         ))
-        document = self._filter_doc_fields(tag, request.user, es_response['_source'])
-        return Response(document)
+        return Response(es_response.get('_source', {}))
+
+    @classmethod
+    def _get_export_source(cls, tag, user, fields=None):
+        """
+        Get source filtering for export: fields user can see, only requested ones when we have fields
+
+        :param tag:
+        :param user:
+        :param fields: Logical field names for projection
+        :return: List of physical fields, False when no field is exported
+        """
+        visible = field_permission_index.get(cls.document_type, tag=tag, user=user)
+        if fields:
+            plan = field_version_registry.get_plan(cls.document_type, tag=tag)
+            root = plan.tree.get((), {})
+            visible = visible.intersection(map(lambda x: root[x][0], filter(lambda x: x in root, fields)))
+        return field_permission_index.get_source(visible)
+
+    @classmethod
+    def _export_lines(cls, query_dsl, tag=None):
+        """
+        Scroll over collection and generate NDJSON lines with logical documents
+
+        Only one page of documents is in memory at a time
+
+        :param query_dsl:
+        :param tag:
+        :return: Generator of lines
+        """
+        es_path = '{}/{}/{document_type}/_search'.format(
+            settings.ELASTIC_SEARCH_HOST,
+            '{site}__{app}'.format(site=settings.SITE, app=cls.app),
+            document_type=cls.document_type)
+        for hits in scroll(es_path, query_dsl):
+            for document in to_logical_docs(cls.document_type, hits, tag=tag):
+                yield json.dumps(document) + '\n'
+
+    def export(self, request, *args, **kwargs):
+        """
+        Export collection as NDJSON, one logical document in each line
+
+        Response is streamed while we scroll over collection, so memory is constant for any collection size.
+
+        request attributes:
+        * fields (optional): Logical fields to export, like "name,post_date"
+
+        payload has query and filters like list, see get_query_request
+
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        self._process_settings(request)
+        tag = kwargs.get('tag', 'v1')
+        payload = dict(request.data) if isinstance(request.data, dict) else {}
+        fields = filter(None, request.query_params.get('fields', '').split(','))
+        source = self._get_export_source(tag, request.user, fields=fields)
+        # fields are indexed with physical names
+        query_dsl = get_query_request(to_physical_payload(
+            payload, field_version_registry.get_plan(self.document_type, tag=tag).to_physical_field))
+        query_dsl['_source'] = source
+        logger.info(u'DocumentViewSet.export :: export document "{document_type}" fields: {fields}'.format(
+            document_type=self.document_type,
+            fields=fields
+        ))
+        # nothing to export when user can't see any field requested
+        response = StreamingHttpResponse(self._export_lines(query_dsl, tag=tag) if source is not False else [],
+                                         content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="{}.ndjson"'.format(self.document_type)
+        return response
+
+    @classmethod
+    def _ingest_lines(cls, lines, tag=None, flush_size=BULK_FLUSH_SIZE, workers=BULK_WORKERS):
+        """
+        Index logical documents in NDJSON lines with bulk requests, generating NDJSON lines with result for each
+        document as bulk requests finish. Last line has stats.
+
+        Field versions are resolved once for all documents.
+
+        :param lines: Iterable of NDJSON lines with logical documents, "id" is optional
+        :param tag:
+        :param flush_size: Documents in each bulk request
+        :param workers: Bulk requests sent at the same time
+        :return: Generator of lines
+        """
+        index = '{site}__{app}'.format(site=settings.SITE, app=cls.app)
+        plan = field_version_registry.get_plan(cls.document_type, tag=tag)
+        results = Queue.Queue()
+        writer = BulkWriter(flush_size=flush_size, workers=workers,
+                            on_items=lambda items: map(results.put, items))
+        errors = 0
+        try:
+            for number, line in enumerate(lines):
+                if not line.strip():
+                    continue
+                try:
+                    document = json.loads(line)
+                    if not isinstance(document, dict):
+                        raise ValueError(u'Line is not a JSON object')
+                    id_ = document.pop('id', None)
+                    writer.index(index, cls.document_type, id_, plan.to_physical(document))
+                except (ValueError, AttributeError, exceptions.XimpiaAPIException) as e:
+                    errors += 1
+                    yield json.dumps({'line': number, 'status': 400, 'error': u'{}'.format(e)}) + '\n'
+                while not results.empty():
+                    yield json.dumps(results.get()) + '\n'
+        finally:
+            # also when client disconnects and generator is closed, documents read are written and workers end
+            stats = writer.close()
+        while not results.empty():
+            yield json.dumps(results.get()) + '\n'
+        stats['errors'] += errors
+        yield json.dumps({'stats': stats}) + '\n'
+
+    @classmethod
+    def _get_int_param(cls, request, name, default):
+        """
+        Get positive number in query params, up to default
+
+        :param request:
+        :param name:
+        :param default: Default and max value
+        :return:
+        """
+        try:
+            value = int(request.query_params.get(name, default))
+        except (TypeError, ValueError):
+            raise ParseError(_(u'Query param "{}" must be a number'.format(name)))
+        return min(max(value, 1), default)
+
+    def ingest(self, request, *args, **kwargs):
+        """
+        Create documents from NDJSON, one logical document in each line
+
+        Documents are written with bulk requests while we read request, and result for each document is streamed
+        back as NDJSON as bulk requests finish:
+
+        {"index": {"_id": "AVB1", "status": 201}}
+        {"line": 12, "status": 400, "error": "No JSON object could be decoded"}
+        {"stats": {"actions": 999, "requests": 1, "errors": 1, "elapsed": 0.8}}
+
+        request attributes:
+        * flush_size (optional): Documents in each bulk request
+        * workers (optional): Bulk requests sent at the same time
+
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        self._process_settings(request)
+        tag = kwargs.get('tag', 'v1')
+        stream = request.stream
+        lines = iter(stream.readline, '') if stream is not None else []
+        logger.info(u'DocumentViewSet.ingest :: ingest documents "{document_type}"'.format(
+            document_type=self.document_type
+        ))
+        return StreamingHttpResponse(
+            self._ingest_lines(lines,
+                               tag=tag,
+                               flush_size=self._get_int_param(request, 'flush_size', BULK_FLUSH_SIZE),
+                               workers=self._get_int_param(request, 'workers', BULK_WORKERS)),
+            content_type='application/x-ndjson')
 
     def destroy(self, request, *args, **kwargs):
         """
@@ -339,8 +455,8 @@ class DocumentViewSet(viewsets.ModelViewSet):
         id_ = args[0]
         tag = kwargs.get('tag', 'v1')
         # TODO: check that tag and user allows getting content
-        es_response_raw = req_session.delete(
-            '{}/{}/_{document_type}/{id}'.format(
+        es_response_raw = es_session.delete(
+            '{}/{}/{document_type}/{id}'.format(
                 settings.ELASTIC_SEARCH_HOST,
                 '{site}__{app}'.format(site=settings.SITE, app=self.app),
                 document_type=self.document_type,
@@ -409,7 +525,7 @@ class Completion(generics.RetrieveAPIView):
         index = settings.IMDEX_NAME
         document_types = payload.get('document_types', [])
         query = payload.get('query', '')
-        responses = {}
+        pending = []
         for document_type in document_types:
             query_suggest = {
                 "{}-suggest".format(document_type): {
@@ -423,15 +539,19 @@ class Completion(generics.RetrieveAPIView):
                     }
                 }
             }
-            es_response = req_session.post(
-                'http://{host}:9200/{index}/_suggest'.format(
+            # suggest requests for document types overlap
+            pending.append(AsyncDocumentManager.submit(
+                es_session.post,
+                '{host}/{index}/_suggest'.format(
                     host=settings.ELASTIC_SEARCH_HOST,
                     index=index),
                 data=json.dumps(query_suggest)
-                )
-            if es_response.status_code != 200 or 'status' in es_response and es_response['status'] != 200:
-                raise exceptions.XimpiaAPIException(es_response.json())
-            es_response = es_response.json()
+            ))
+        responses = {}
+        for document_type, es_response_raw in zip(document_types, AsyncDocumentManager.gather(*pending)):
+            es_response = es_response_raw.json()
+            if es_response_raw.status_code != 200 or 'status' in es_response and es_response['status'] != 200:
+                raise exceptions.XimpiaAPIException(es_response)
             responses[document_type] = es_response
         return Response(responses)
 
@@ -555,7 +675,7 @@ class DocumentDefinitionView(viewsets.ModelViewSet):
         )
         # meta_data = document_definition_input['_meta']
         # Check mapping does not exist
-        es_response_raw = requests.get(
+        es_response_raw = es_session.get(
             '{host}/{index}/_mapping/{doc_type}'.format(
                 host=settings.ELASTIC_SEARCH_HOST,
                 index=index,
@@ -612,7 +732,7 @@ class DocumentDefinitionView(viewsets.ModelViewSet):
             )
         )
         # print ''.join(map(lambda x: '{}\n'.format(x[0]) + '{}\n'.format(x[1]), bulk_queries))
-        es_response_raw = requests.get(
+        es_response_raw = es_session.get(
             '{host}/_msearch'.format(
                 host=settings.ELASTIC_SEARCH_HOST
             ),
@@ -641,7 +761,7 @@ class DocumentDefinitionView(viewsets.ModelViewSet):
         logger.debug(u'_create_index :: document definition: {}'.format(
             pprint.PrettyPrinter(indent=4).pformat(physical))
         )
-        es_response_raw = requests.post(
+        es_response_raw = es_session.post(
             '{host}/{index}/{doc_type}'.format(
                 host=settings.ELASTIC_SEARCH_HOST,
                 index=u'{}__document-definition'.format(index),
@@ -660,7 +780,7 @@ class DocumentDefinitionView(viewsets.ModelViewSet):
             raise exceptions.XimpiaAPIException(u'Error creating document definition')
         # Bulk insert for all fields
         # print fields_version_str
-        es_response_raw = requests.post(
+        es_response_raw = es_session.post(
             '{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
             data=fields_version_str,
             headers={'Content-Type': 'application/octet-stream'},
@@ -671,11 +791,12 @@ class DocumentDefinitionView(viewsets.ModelViewSet):
         ))
         if 'errors' in es_response and es_response['errors']:
             raise exceptions.XimpiaAPIException(u'Error creating fields')
+        field_version_registry.invalidate(doc_type=doc_type, index=index)
         # Create mapping
         logger.debug(u'DocumentDefinition.create :: mappings: {}'.format(
             pprint.PrettyPrinter(indent=4).pformat(doc_mapping)
         ))
-        es_response_raw = requests.put(
+        es_response_raw = es_session.put(
             '{host}/{index}/_mapping/{doc_type}'.format(
                 host=settings.ELASTIC_SEARCH_HOST,
                 index=index,
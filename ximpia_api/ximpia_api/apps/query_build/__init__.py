@@ -1,5 +1,17 @@
+import json
+import base64
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+from rest_framework.exceptions import ParseError
+
 __author__ = 'jorgealegre'
 
+PAGE_SIZE = getattr(settings, 'PAGE_SIZE', 20)
+MAX_PAGE_SIZE = getattr(settings, 'MAX_PAGE_SIZE', 100)
+# unique field to break ties in sort, so pages are stable
+SORT_TIEBREAKER = '_uid'
+
 
 def get_query_request(payload):
     """
@@ -72,7 +84,7 @@ def get_query_request(payload):
         query_match_type = 'phrase'
     if 'query' in payload and isinstance(payload['query'], (str, unicode)):
         # query is string
-        query_dsl['query']['filtered'] = {
+        query_dsl['query']['filtered']['query'] = {
             'multi_match': {
                 "query": payload['query'],
                 "type": query_match_type,
@@ -88,7 +100,7 @@ def get_query_request(payload):
         }
     elif 'query' in payload and isinstance(payload['query'], (tuple, list)):
         # query is a list of words: we search for keywords as phrases (AND) and any should match
-        query_dsl['query']['filtered'] = {
+        query_dsl['query']['filtered']['query'] = {
             'bool': {
                 'should': map(lambda x: {
                     'multi_match': {
@@ -108,8 +120,8 @@ def get_query_request(payload):
         }
     # filters
     if 'filters' in payload and 'must' in payload['filters'] and isinstance(payload['filters']['must'], dict):
-        query_dsl['query']['filtered'].setdefault('filters', {})
-        query_dsl['query']['filtered']['filters'].setdefault('bool', {})
+        query_dsl['query']['filtered'].setdefault('filter', {})
+        query_dsl['query']['filtered']['filter'].setdefault('bool', {})
         # We should have ranges as well
         must_list = []
         for field, value in payload['filters']['must'].items():
@@ -130,10 +142,10 @@ def get_query_request(payload):
                         }
                     }
                 )
-        query_dsl['query']['filtered']['filters']['bool']['must'] = must_list
-    elif 'filters' in payload and 'must' in payload['filters'] and isinstance(payload['filters']['should'], dict):
-        query_dsl['query']['filtered'].setdefault('filters', {})
-        query_dsl['query']['filtered']['filters'].setdefault('bool', {})
+        query_dsl['query']['filtered']['filter']['bool']['must'] = must_list
+    if 'filters' in payload and 'should' in payload['filters'] and isinstance(payload['filters']['should'], dict):
+        query_dsl['query']['filtered'].setdefault('filter', {})
+        query_dsl['query']['filtered']['filter'].setdefault('bool', {})
         should_list = []
         for field, value in payload['filters']['should'].items():
             if isinstance(value, dict) and ('gte' in value.keys() or 'gt' in value.keys() or 'lte' in value.keys()
@@ -153,14 +165,14 @@ def get_query_request(payload):
                         }
                     }
                 )
-        query_dsl['query']['filtered']['filters']['bool']['should'] = should_list
+        query_dsl['query']['filtered']['filter']['bool']['should'] = should_list
     # excludes
     if 'excludes' in payload:
-        query_dsl['query']['filtered'].setdefault('filters', {})
-        query_dsl['query']['filtered']['filters'].setdefault('bool', {})
-        query_dsl['query']['filtered']['filters']['bool']['must_not'] = map(lambda x: {
+        query_dsl['query']['filtered'].setdefault('filter', {})
+        query_dsl['query']['filtered']['filter'].setdefault('bool', {})
+        query_dsl['query']['filtered']['filter']['bool']['must_not'] = map(lambda x: {
             "term": {
-                x[1]: x[2]
+                x[0]: x[1]
             }
         }, payload['excludes'].items())
     # sort
@@ -176,4 +188,154 @@ def get_query_request(payload):
                     "size": payload['group_by_counter'].get('size', 20)
                 }
             }
-    return query_dsl
\ No newline at end of file
+    return query_dsl
+
+
+def to_physical_payload(payload, to_physical_field):
+    """
+    Translate logical field names in filters, excludes, sort and group by of payload into physical ones
+
+    :param payload: Dictionary with payload, see get_query_request
+    :param to_physical_field: Callable translating field name, like TranslationPlan.to_physical_field
+    :return: Payload with physical field names
+    """
+    payload = dict(payload)
+    if isinstance(payload.get('filters', None), dict):
+        payload['filters'] = dict(map(
+            lambda x: (x[0], dict(map(lambda y: (to_physical_field(y[0]), y[1]), x[1].items()))
+                       if isinstance(x[1], dict) else x[1]),
+            payload['filters'].items()))
+    if isinstance(payload.get('excludes', None), dict):
+        payload['excludes'] = dict(map(lambda x: (to_physical_field(x[0]), x[1]), payload['excludes'].items()))
+    if payload.get('sort', None):
+        payload['sort'] = map(lambda x: dict(map(lambda y: (to_physical_field(y[0]), y[1]), x.items()))
+                              if isinstance(x, dict) else to_physical_field(x),
+                              payload['sort'])
+    if isinstance(payload.get('group_by_counter', None), dict):
+        payload['group_by_counter'] = dict(payload['group_by_counter'],
+                                           items=map(to_physical_field,
+                                                     payload['group_by_counter'].get('items', [])))
+    return payload
+
+
+def get_sort_fields(sort=None):
+    """
+    Get sort fields with order, having tiebreaker as last field
+
+    ["name", {"post_date": {"order": "desc"}}] -> [('name', 'asc'), ('post_date', 'desc'), ('_uid', 'asc')]
+
+    :param sort: Sort in payload
+    :return: List of (field, order)
+    """
+    sort_fields = []
+    for item in sort or []:
+        if isinstance(item, dict):
+            field, options = item.items()[0]
+            order = options.get('order', 'asc') if isinstance(options, dict) else options
+        else:
+            field, order = item, 'asc'
+        if field != SORT_TIEBREAKER:
+            sort_fields.append((field, order))
+    sort_fields.append((SORT_TIEBREAKER, 'asc'))
+    return sort_fields
+
+
+def encode_cursor(sort_values):
+    """
+    Encode sort values for last document in page into opaque cursor
+
+    :param sort_values: "sort" in last hit
+    :return: Cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values))
+
+
+def decode_cursor(cursor, sort_fields):
+    """
+    Decode cursor into sort values
+
+    :param cursor:
+    :param sort_fields: List of (field, order)
+    :return: Sort values
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ParseError(_(u'Cursor not valid'))
+    if not isinstance(sort_values, list) or len(sort_values) != len(sort_fields):
+        raise ParseError(_(u'Cursor not valid for sort'))
+    return sort_values
+
+
+def get_search_after_filter(sort_fields, sort_values):
+    """
+    Get filter for documents sorted after sort values, keyset pagination
+
+    ElasticSearch 1.x has no search_after, so for sort (a, b) with values (x, y) we filter a > x or (a = x and b > y)
+
+    Documents missing a sort field are sorted last and have null sort value, so a = null is a missing filter, and
+    documents missing a come after any a = x. Nothing comes after a = null but other documents missing a.
+
+    :param sort_fields: List of (field, order)
+    :param sort_values: Sort values for last document in previous page
+    :return: Filter
+    """
+    should = []
+    for i, (field, order) in enumerate(sort_fields):
+        if sort_values[i] is None:
+            continue
+        must = map(lambda x: {'missing': {'field': x[0][0]}} if x[1] is None else {'term': {x[0][0]: x[1]}},
+                   zip(sort_fields[:i], sort_values[:i]))
+        after = {
+            'range': {
+                field: {
+                    'gt' if order == 'asc' else 'lt': sort_values[i]
+                }
+            }
+        }
+        if field != SORT_TIEBREAKER:
+            after = {'bool': {'should': [after, {'missing': {'field': field}}]}}
+        must.append(after)
+        should.append({'bool': {'must': must}})
+    return {'bool': {'should': should}}
+
+
+def get_page_query(payload, cursor=None, size=PAGE_SIZE):
+    """
+    Get query for a page of documents, keyset paginated
+
+    We ask for one more document than page size, so we know there is next page
+
+    :param payload: Dictionary with payload, see get_query_request
+    :param cursor: Cursor for next page, returned with previous page
+    :param size: Documents in page
+    :return: (query_dsl, sort_fields)
+    """
+    size = min(max(int(size), 1), MAX_PAGE_SIZE)
+    query_dsl = get_query_request(payload)
+    sort_fields = get_sort_fields(payload.get('sort', None))
+    query_dsl['sort'] = map(lambda x: {x[0]: {'order': x[1]}} if x[0] == SORT_TIEBREAKER
+                            else {x[0]: {'order': x[1], 'missing': '_last'}}, sort_fields)
+    query_dsl['size'] = size + 1
+    if cursor:
+        search_after = get_search_after_filter(sort_fields, decode_cursor(cursor, sort_fields))
+        filtered = query_dsl['query']['filtered']
+        if 'filter' in filtered:
+            filtered['filter'] = {'bool': {'must': [filtered['filter'], search_after]}}
+        else:
+            filtered['filter'] = search_after
+    return query_dsl, sort_fields
+
+
+def get_page(hits, size=PAGE_SIZE):
+    """
+    Get page of hits and cursor for next page
+
+    :param hits: Hits from query by get_page_query
+    :param size: Documents in page
+    :return: (hits, next cursor), cursor is None for last page
+    """
+    size = min(max(int(size), 1), MAX_PAGE_SIZE)
+    if len(hits) <= size:
+        return hits, None
+    return hits[:size], encode_cursor(hits[size - 1]['sort'])
@@ -0,0 +1,91 @@
+from rest_framework.exceptions import ParseError
+
+from base.tests import XimpiaTestCase
+
+__author__ = 'jorgealegre'
+
+
+class PaginationTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_sort_fields(self):
+        from query_build import get_sort_fields
+        self.assertTrue(get_sort_fields(['name', {'post_date': {'order': 'desc'}}]) ==
+                        [('name', 'asc'), ('post_date', 'desc'), ('_uid', 'asc')])
+        self.assertTrue(get_sort_fields() == [('_uid', 'asc')])
+
+    def test_to_physical_payload(self):
+        from query_build import to_physical_payload
+        payload = to_physical_payload({
+            'query': 'cat',
+            'filters': {'must': {'name': 'john', 'post_date': {'gte': '2015-11-01'}}},
+            'excludes': {'name': 'jane'},
+            'sort': ['name', {'post_date': {'order': 'desc'}}],
+            'group_by_counter': {'items': ['name']},
+        }, lambda x: u'book__{}__v1'.format(x))
+        self.assertTrue(payload['query'] == 'cat')
+        self.assertTrue(payload['filters']['must'] == {'book__name__v1': 'john',
+                                                       'book__post_date__v1': {'gte': '2015-11-01'}})
+        self.assertTrue(payload['excludes'] == {'book__name__v1': 'jane'})
+        self.assertTrue(payload['sort'] == ['book__name__v1', {'book__post_date__v1': {'order': 'desc'}}])
+        self.assertTrue(payload['group_by_counter']['items'] == ['book__name__v1'])
+
+    def test_cursor(self):
+        from query_build import encode_cursor, decode_cursor, get_sort_fields
+        sort_fields = get_sort_fields(['name'])
+        cursor = encode_cursor(['john', 'book#12'])
+        self.assertTrue(decode_cursor(cursor, sort_fields) == ['john', 'book#12'])
+        with self.assertRaises(ParseError):
+            decode_cursor('not-a-cursor', sort_fields)
+        with self.assertRaises(ParseError):
+            decode_cursor(encode_cursor(['book#12']), sort_fields)
+
+    def test_page_query(self):
+        from query_build import get_page_query, encode_cursor
+        query_dsl, sort_fields = get_page_query({'sort': [{'post_date': {'order': 'desc'}}]}, size=10)
+        self.assertTrue(query_dsl['size'] == 11)
+        self.assertTrue(query_dsl['sort'] == [{'post_date': {'order': 'desc', 'missing': '_last'}},
+                                              {'_uid': {'order': 'asc'}}])
+        self.assertTrue('filter' not in query_dsl['query']['filtered'])
+        query_dsl, sort_fields = get_page_query({'sort': [{'post_date': {'order': 'desc'}}]},
+                                                cursor=encode_cursor([1447000000000, 'book#12']),
+                                                size=10)
+        self.assertTrue(query_dsl['query']['filtered']['filter'] == {
+            'bool': {
+                'should': [
+                    {'bool': {'must': [{'bool': {'should': [{'range': {'post_date': {'lt': 1447000000000}}},
+                                                            {'missing': {'field': 'post_date'}}]}}]}},
+                    {'bool': {'must': [{'term': {'post_date': 1447000000000}},
+                                       {'range': {'_uid': {'gt': 'book#12'}}}]}},
+                ]
+            }
+        })
+
+    def test_page_query_missing(self):
+        from query_build import get_page_query, encode_cursor
+        # last document in page has no post_date, only documents missing post_date come after it
+        query_dsl, sort_fields = get_page_query({'sort': [{'post_date': {'order': 'desc'}}]},
+                                                cursor=encode_cursor([None, 'book#12']),
+                                                size=10)
+        self.assertTrue(query_dsl['query']['filtered']['filter'] == {
+            'bool': {
+                'should': [
+                    {'bool': {'must': [{'missing': {'field': 'post_date'}},
+                                       {'range': {'_uid': {'gt': 'book#12'}}}]}},
+                ]
+            }
+        })
+
+    def test_page(self):
+        from query_build import get_page, decode_cursor, get_sort_fields
+        hits = map(lambda x: {'_id': str(x), 'sort': [x, 'book#{}'.format(x)]}, range(3))
+        page, cursor = get_page(hits, size=2)
+        self.assertTrue(len(page) == 2)
+        self.assertTrue(decode_cursor(cursor, get_sort_fields(['name'])) == [1, 'book#1'])
+        page, cursor = get_page(hits, size=3)
+        self.assertTrue(len(page) == 3 and cursor is None)
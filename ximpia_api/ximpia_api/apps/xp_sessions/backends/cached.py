@@ -0,0 +1,100 @@
+import copy
+import logging
+
+from django.utils import timezone
+from django.conf import settings
+
+from base.cache import TTLCache
+from document import to_logical_doc
+from xp_sessions.backends import db
+
+__author__ = 'jorgealegre'
+
+
+SESSION_CACHE_SIZE = getattr(settings, 'SESSION_CACHE_SIZE', 10000)
+# seconds a session is read from process before checking database again, since other workers could update it
+SESSION_CACHE_TTL = getattr(settings, 'SESSION_CACHE_TTL', 60)
+
+
+logger = logging.getLogger(__name__)
+
+session_cache = TTLCache(max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+
+
+class SessionStore(db.SessionStore):
+    """
+    Session store with in-process cache in front of database session store
+
+    Keeps decoded session data with expire date for each session key. Loads hit database only for sessions not in
+    cache, and expiration is checked in process. Writes go to database and update cache.
+
+    SESSION_ENGINE = 'xp_sessions.backends.cached'
+    """
+
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+
+    @classmethod
+    def _now(cls):
+        return timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    def load(self):
+        """
+        Load session data, from cache when possible
+
+        :return:
+        """
+        if not self.session_key:
+            return super(SessionStore, self).load()
+        entry = session_cache.get(self.session_key)
+        if entry is not None:
+            expire_date, session_data = entry
+            if expire_date > self._now():
+                # session data is modified by request
+                return copy.deepcopy(session_data)
+            session_cache.delete(self.session_key)
+            self._session_key = None
+            return {}
+        document = self._get_document(self.session_key)
+        if document is None:
+            self._session_key = None
+            return {}
+        session = to_logical_doc('session', document)
+        if session['expire_date'] <= self._now():
+            self._session_key = None
+            return {}
+        session_data = self.decode(session['data'])
+        session_cache.set(self.session_key, (session['expire_date'], copy.deepcopy(session_data)))
+        return session_data
+
+    def exists(self, session_key):
+        if session_key in session_cache:
+            return True
+        return super(SessionStore, self).exists(session_key)
+
+    def save(self, must_create=False):
+        """
+        Save session into database and cache
+
+        :param must_create:
+        :return:
+        """
+        super(SessionStore, self).save(must_create=must_create)
+        if self.session_key is not None:
+            session_cache.set(self.session_key, (
+                self.get_expiry_date().strftime("%Y-%m-%dT%H:%M:%S"),
+                copy.deepcopy(self._get_session(no_load=must_create))
+            ))
+
+    def delete(self, session_key=None):
+        """
+        Delete session from database and cache
+
+        :param session_key:
+        :return:
+        """
+        if session_key is None:
+            session_key = self.session_key
+        if session_key is not None:
+            session_cache.delete(session_key)
+        super(SessionStore, self).delete(session_key)
@@ -1,38 +1,407 @@
-import requests
-from requests.adapters import HTTPAdapter
+import calendar
 import logging
 import json
+import re
+import threading
+import time
+import atexit
+import Queue
+from datetime import datetime, timedelta
 
-from django.contrib.sessions.backends.base import CreateError, SessionBase
+from django.contrib.sessions.backends.base import CreateError, SessionBase, VALID_KEY_CHARS
 from django.utils import timezone
+from django.utils.crypto import get_random_string
 from django.utils.translation import ugettext as _
 
 from django.conf import settings
 
 from base import exceptions
+from base.bulk import scroll, BulkWriter, BULK_WORKERS
+from base.transport import es_session
 from document import to_logical_doc, to_physical_doc
 
 
 __author__ = 'jorgealegre'
 
 
-MAX_RETRIES = 3
 FLUSH_LIMIT = 1000
+# session updates are queued and written with bulk requests in background
+SESSION_WRITE_BEHIND = getattr(settings, 'SESSION_WRITE_BEHIND', False)
+SESSION_BULK_SIZE = getattr(settings, 'SESSION_BULK_SIZE', 500)
+# max seconds an update waits in queue
+SESSION_BULK_INTERVAL = getattr(settings, 'SESSION_BULK_INTERVAL', 0.5)
+# None, 'day' or 'week': write new sessions into an index for each day or week
+SESSION_PARTITION = getattr(settings, 'SESSION_PARTITION', None)
+PARTITION_FORMATS = {
+    'day': ('%Y%m%d', re.compile(r'^(\d{8})'), timedelta(days=1)),
+    'week': ('%Yw%W', re.compile(r'^(\d{4}w\d{2})'), timedelta(days=7)),
+}
 
-req_session = requests.Session()
-req_session.mount('{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=MAX_RETRIES))
 
 logger = logging.getLogger(__name__)
 
+# partitions known to exist in this process
+_partitions = set()
+# session not waiting in write queue
+MISSING = object()
+
+
+def get_partition(now=None, partition_type=None):
+    """
+    Get partition for time, like "20151018" for days or "2015w41" for weeks
+
+    :param now:
+    :param partition_type: day or week
+    :return:
+    """
+    now = now or datetime.utcnow()
+    return now.strftime(PARTITION_FORMATS[partition_type or SESSION_PARTITION][0])
+
+
+def get_partition_end(partition, partition_type=None):
+    """
+    Get time partition ends
+
+    :param partition:
+    :param partition_type: day or week
+    :return: datetime
+    """
+    date_format, _regex, length = PARTITION_FORMATS[partition_type or SESSION_PARTITION]
+    if date_format == '%Yw%W':
+        # %W needs day of week to be parsed, 1 is monday
+        return datetime.strptime(partition + '1', '%Yw%W%w') + length
+    return datetime.strptime(partition, date_format) + length
+
+
+def get_key_partition(session_key, partition_type=None):
+    """
+    Get partition from session key. Sessions created in partitions have keys starting with partition
+
+    :param session_key:
+    :param partition_type: day or week
+    :return: Partition or None for sessions not in partitions
+    """
+    partition_type = partition_type or SESSION_PARTITION
+    if not partition_type or not session_key:
+        return None
+    match = PARTITION_FORMATS[partition_type][1].match(session_key)
+    return match.group(1) if match else None
+
+
+def get_partitions_alias():
+    """
+    Alias for all session partitions
+
+    :return:
+    """
+    return u'{}__session__partitions'.format(settings.SITE_BASE_INDEX)
+
+
+def get_session_index(session_key=None):
+    """
+    Get index for session
+
+    :param session_key:
+    :return: Partition index for sessions created in partitions, session index otherwise
+    """
+    partition = get_key_partition(session_key)
+    if partition:
+        return u'{}__session.{}'.format(settings.SITE_BASE_INDEX, partition)
+    return u'{}__session'.format(settings.SITE_BASE_INDEX)
+
+
+def get_session_path(session_key):
+    return u'{host}/{index}/{document_type}/{id}'.format(
+        host=settings.ELASTIC_SEARCH_HOST,
+        index=get_session_index(session_key),
+        document_type='session',
+        id=session_key)
+
+
+def create_partition(partition):
+    """
+    Create partition index, with partitions alias, when does not exist
+
+    :param partition:
+    :return:
+    """
+    if partition in _partitions:
+        return
+    index = u'{}__session.{}'.format(settings.SITE_BASE_INDEX, partition)
+    with open(settings.BASE_DIR + 'settings/settings_test.json') as f:
+        settings_dict = json.loads(f.read())
+    with open('{}/session.json'.format(settings.BASE_DIR + 'apps/xp_sessions/mappings')) as f:
+        mappings = json.loads(f.read())
+    es_response_raw = es_session.put(
+        u'{host}/{index}'.format(host=settings.ELASTIC_SEARCH_HOST, index=index),
+        data=json.dumps({
+            'settings': settings_dict,
+            'mappings': mappings,
+            'aliases': {
+                get_partitions_alias(): {}
+            }
+        }))
+    if es_response_raw.status_code not in [200, 201] and 'IndexAlreadyExists' not in es_response_raw.content \
+            and 'index_already_exists' not in es_response_raw.content:
+        raise exceptions.XimpiaAPIException(_(u'Error creating session partition "{}" :: {}'.format(
+            index,
+            es_response_raw.content
+        )))
+    _partitions.add(partition)
+
+
+def get_partition_expire_date(index):
+    """
+    Get last expire date for sessions in partition. Sessions extended by saves stay in partition they were
+    created in, so partition lives as long as its last session
+
+    :param index: Partition index
+    :return: Epoch milliseconds, None when partition has no sessions
+    """
+    es_response_raw = es_session.get(
+        u'{host}/{index}/session/_search'.format(host=settings.ELASTIC_SEARCH_HOST, index=index),
+        data=json.dumps({
+            'size': 0,
+            'aggs': {
+                'expire_date': {
+                    'max': {
+                        'field': 'session__expire_date__v1'
+                    }
+                }
+            }
+        }))
+    if es_response_raw.status_code != 200:
+        raise exceptions.XimpiaAPIException(_(u'Error getting expire date for session partition "{}" :: {}'.format(
+            index,
+            es_response_raw.content
+        )))
+    return es_response_raw.json()['aggregations']['expire_date']['value']
+
+
+def drop_expired_partitions(now=None):
+    """
+    Delete partition indices ended with all sessions expired
+
+    :param now:
+    :return: List of indices deleted
+    """
+    now = now or datetime.utcnow()
+    now_millis = calendar.timegm(now.utctimetuple()) * 1000
+    es_response_raw = es_session.get(u'{host}/_alias/{alias}'.format(
+        host=settings.ELASTIC_SEARCH_HOST,
+        alias=get_partitions_alias()))
+    if es_response_raw.status_code == 404:
+        return []
+    if es_response_raw.status_code != 200:
+        raise exceptions.XimpiaAPIException(_(u'Error getting session partitions :: {}'.format(
+            es_response_raw.content
+        )))
+    deleted = []
+    for index in es_response_raw.json().keys():
+        partition = get_key_partition(index.split('.')[-1])
+        if not partition or get_partition_end(partition) > now:
+            continue
+        expire_date = get_partition_expire_date(index)
+        if expire_date is not None and expire_date >= now_millis:
+            continue
+        es_response_raw = es_session.delete(u'{host}/{index}'.format(host=settings.ELASTIC_SEARCH_HOST,
+                                                                      index=index))
+        if es_response_raw.status_code != 200:
+            logger.error(u'drop_expired_partitions :: could not delete {} :: {}'.format(
+                index, es_response_raw.content))
+            continue
+        _partitions.discard(partition)
+        deleted.append(index)
+    logger.info(u'drop_expired_partitions :: deleted: {}'.format(deleted))
+    return deleted
+
+
+class SessionWriteQueue(object):
+    """
+    Queue of session writes flushed to ElasticSearch with bulk requests by a background thread
+
+    Writes are flushed every SESSION_BULK_SIZE sessions or SESSION_BULK_INTERVAL seconds. Sessions waiting in queue
+    are kept in pending so loads in this process read them. Thread is started on first write, so it is not
+    shared with forked workers.
+    """
+
+    def __init__(self, bulk_size=SESSION_BULK_SIZE, interval=SESSION_BULK_INTERVAL):
+        self.bulk_size = bulk_size
+        self.interval = interval
+        self.pending = {}
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is None:
+                    atexit.register(self.flush)
+                self._thread = threading.Thread(target=self._run, name='SessionWriteQueue')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def put(self, session_key, document):
+        """
+        Queue session write
+
+        :param session_key:
+        :param document: Physical session document, None to delete session
+        :return:
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        with self._lock:
+            self.pending[session_key] = document
+        self._queue.put((session_key, document))
+
+    def get(self, session_key, default=None):
+        """
+        Get session document waiting to be written
+
+        :param session_key:
+        :param default:
+        :return: Physical session document, None if session is being deleted
+        """
+        return self.pending.get(session_key, default)
+
+    def _get_batch(self, block=True):
+        """
+        Get batch of writes from queue. Blocking waits for first write, then at most interval seconds for more
+
+        :param block:
+        :return: List of (session_key, document)
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.bulk_size:
+            try:
+                if not block:
+                    batch.append(self._queue.get_nowait())
+                elif deadline is None:
+                    batch.append(self._queue.get())
+                    deadline = time.time() + self.interval
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    batch.append(self._queue.get(True, timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception(u'SessionWriteQueue :: could not write {} sessions'.format(len(batch)))
+
+    def write(self, batch):
+        """
+        Write batch of sessions with bulk request
+
+        :param batch: List of (session_key, document)
+        :return:
+        """
+        if not batch:
+            return
+        bulk_lines = []
+        for session_key, document in batch:
+            if document is None:
+                bulk_lines.append(json.dumps({
+                    'delete': {
+                        '_index': get_session_index(session_key),
+                        '_type': 'session',
+                        '_id': session_key
+                    }
+                }))
+            else:
+                bulk_lines.append(json.dumps({
+                    'index': {
+                        '_index': get_session_index(session_key),
+                        '_type': 'session',
+                        '_id': session_key
+                    }
+                }))
+                bulk_lines.append(json.dumps(document))
+        es_response_raw = es_session.post('{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
+                                          data=u'\n'.join(bulk_lines) + u'\n')
+        if es_response_raw.status_code != 200 or es_response_raw.json().get('errors', False):
+            logger.error(u'SessionWriteQueue :: errors writing sessions :: {}'.format(es_response_raw.content))
+        with self._lock:
+            for session_key, document in batch:
+                # newer writes for same session could be in queue
+                if session_key in self.pending and self.pending[session_key] is document:
+                    del self.pending[session_key]
+
+    def flush(self):
+        """
+        Write sessions in queue from calling thread
+
+        :return:
+        """
+        batch = self._get_batch(block=False)
+        while batch:
+            self.write(batch)
+            batch = self._get_batch(block=False)
+
+
+session_write_queue = SessionWriteQueue()
+
 
 class SessionStore(SessionBase):
     """
     Implements database session store.
+
+    Sessions are stored with session key as document id, so we read them with realtime get and no index refresh
+    is needed after writes. With SESSION_WRITE_BEHIND updates are written in background with bulk requests.
+
+    With SESSION_PARTITION new sessions are written into an index for each day or week, with partition at start
+    of session key, so loads go to the only partition that can have the session. Sessions stay in partition
+    when saves extend them, and whole partitions are dropped once all their sessions expired, see
+    drop_expired_partitions.
     """
     def __init__(self, session_key=None):
         super(SessionStore, self).__init__(session_key)
 
+    def _get_new_session_key(self):
+        """
+        Get new session key, starting with partition when sessions are partitioned
+
+        :return:
+        """
+        if not SESSION_PARTITION:
+            return super(SessionStore, self)._get_new_session_key()
+        partition = get_partition()
+        create_partition(partition)
+        while True:
+            session_key = partition + get_random_string(32 - len(partition), VALID_KEY_CHARS)
+            if not self.exists(session_key):
+                return session_key
+
+    def _get_document(self, session_key):
+        """
+        Get physical session document
+
+        :param session_key:
+        :return: Document or None when not found
+        """
+        if SESSION_WRITE_BEHIND:
+            # one lookup, writer thread could remove session from pending once written
+            document = session_write_queue.get(session_key, MISSING)
+            if document is not MISSING:
+                return document
+        es_response_raw = es_session.get(get_session_path(session_key))
+        if es_response_raw.status_code != 200:
+            return None
+        es_response = es_response_raw.json()
+        if not es_response.get('found', False):
+            return None
+        return es_response['_source']
+
     def load(self):
         """
         Load session data
@@ -40,49 +409,15 @@ class SessionStore(SessionBase):
         :return:
         """
         # print u'SessionStore.load :: session_key: {}'.format(self.session_key)
-        es_response_raw = req_session.get(
-            '{host}/{index}__{document_type}/{document_type}/_search?query_cache={query_cache}'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                index=settings.SITE_BASE_INDEX,
-                document_type='session',
-                query_cache=json.dumps(True)),
-            data=json.dumps({
-                'query': {
-                    'bool': {
-                        'must': [
-                            {
-                                'term': {
-                                    'session__key__v1': self.session_key
-                                }
-                            },
-                            {
-                                'range': {
-                                    'session__expire_date__v1': {
-                                        "gt": timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
-                                    }
-                                }
-                            }
-                        ]
-                    }
-                }
-            })
-            )
-        # print es_response_raw.content
-        if es_response_raw.status_code != 200:
+        document = self._get_document(self.session_key) if self.session_key else None
+        if document is None:
             self._session_key = None
             return {}
-        es_response = es_response_raw.json()
-        if es_response_raw.status_code != 200 or 'status' in es_response and es_response['status'] != 200:
+        session = to_logical_doc('session', document)
+        if session['expire_date'] <= timezone.now().strftime("%Y-%m-%dT%H:%M:%S"):
             self._session_key = None
             return {}
-        try:
-            session_data = self.decode(to_logical_doc('session',
-                                                      es_response['hits']['hits'][0]['_source'])['data'])
-            # print u'SessionStore.load :: session_data: {}'.format(session_data)
-            # session_data['_id'] = es_response['hits']['hits'][0]['_id']
-        except IndexError:
-            session_data = {}
-        return session_data
+        return self.decode(session['data'])
 
     def exists(self, session_key):
         """
@@ -91,24 +426,11 @@ class SessionStore(SessionBase):
         :param session_key:
         :return:
         """
-        es_response_raw = req_session.get(
-            '{host}/{index}__{document_type}/{document_type}/_count?query_cache={query_cache}'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                index=settings.SITE_BASE_INDEX,
-                document_type='session',
-                query_cache=json.dumps(True)),
-            data=json.dumps({
-                'query': {
-                    'term': {
-                        'session__key__v1': session_key
-                    }
-                }
-            })
-            )
-        es_response = es_response_raw.json()
-        if es_response_raw.status_code != 200 or 'status' in es_response and es_response['status'] != 200:
-            return False
-        return es_response['count'] > 0
+        if SESSION_WRITE_BEHIND:
+            document = session_write_queue.get(session_key, MISSING)
+            if document is not MISSING:
+                return document is not None
+        return es_session.head(get_session_path(session_key)).status_code == 200
 
     def create(self):
         """
@@ -143,25 +465,22 @@ class SessionStore(SessionBase):
             'data': self.encode(raw_session_data),
             'expire_date': self.get_expiry_date().strftime("%Y-%m-%dT%H:%M:%S")
         }
+        document = to_physical_doc('session', session_data)
         if must_create:
-            es_response_raw = requests.post('{}/{}__session/{id}'.format(
-                settings.ELASTIC_SEARCH_HOST,
-                settings.SITE_BASE_INDEX,
-                id=self.session_key
-            ),
-                data=json.dumps(to_physical_doc('session', session_data)))
+            # create is always written right away, we need to know key is unique
+            es_response_raw = es_session.put(u'{}/_create'.format(get_session_path(self.session_key)),
+                                             data=json.dumps(document))
+            if es_response_raw.status_code == 409:
+                raise CreateError
+        elif SESSION_WRITE_BEHIND:
+            session_write_queue.put(self.session_key, document)
+            return
         else:
-            es_response_raw = requests.put('{}/{}__session/{id}'.format(settings.ELASTIC_SEARCH_HOST,
-                                                                        settings.SITE_BASE_INDEX,
-                                                                        id=self.session_key),
-                                           data=json.dumps(to_physical_doc('session', session_data)))
-        if es_response_raw.status_code != 200:
-            exceptions.XimpiaAPIException(_(u'SessionStore :: save() :: Could not write session'))
+            es_response_raw = es_session.put(get_session_path(self.session_key),
+                                             data=json.dumps(document))
+        if es_response_raw.status_code not in [200, 201]:
+            raise exceptions.XimpiaAPIException(_(u'SessionStore :: save() :: Could not write session'))
         es_response = es_response_raw.json()
-        # curl -XPOST 'http://localhost:9200/twitter/_refresh'
-        requests.post(
-            '{}/{}/_refresh'.format(settings.ELASTIC_SEARCH_HOST, settings.SITE_BASE_INDEX)
-        )
         logger.info(u'SessionStore :: save() :: es_response: {}'.format(es_response))
 
     def delete(self, session_key=None):
@@ -175,85 +494,55 @@ class SessionStore(SessionBase):
             if self.session_key is None:
                 return
             session_key = self.session_key
-        es_response_raw = req_session.get(
-            '{host}/{index}__{document_type}/{document_type}/{id}'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                document_type='session',
-                index=settings.SITE_BASE_INDEX,
-                id=session_key)
-            )
-
-        if es_response_raw.status_code != 200:
+        if SESSION_WRITE_BEHIND and session_key in session_write_queue.pending:
+            # delete goes after write in queue
+            session_write_queue.put(session_key, None)
             return
+        es_response_raw = es_session.delete(get_session_path(session_key))
+        if es_response_raw.status_code not in [200, 404]:
+            raise exceptions.XimpiaAPIException(_(u'Could not delete session'))
         es_response = es_response_raw.json()
-        try:
-            # id_ = es_response['hits']['hits'][0]['_id']
-            id_ = es_response['_id']
-            es_response_raw = req_session.delete('{host}/{index}__{document_type}/{document_type}/{id_}'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                document_type='session',
-                index=settings.SITE_BASE_INDEX,
-                id_=id_))
-            if es_response_raw.status_code != 200:
-                exceptions.XimpiaAPIException(_(u'Could not get session'))
-            es_response = es_response_raw.json()
-            logger.info(u'SessionStore :: delete() :: es_response: {}'.format(es_response))
-        except IndexError:
-            pass
-
+        logger.info(u'SessionStore :: delete() :: es_response: {}'.format(es_response))
 
     @classmethod
-    def clear_expired(cls):
+    def clear_expired(cls, flush_size=FLUSH_LIMIT, workers=BULK_WORKERS, progress=None):
         """
         Clear expired sessions
 
-        :return:
+        We scroll over expired sessions and delete them with bulk requests sent by parallel workers
+
+        :param flush_size: Sessions deleted in each bulk request
+        :param workers: Bulk requests sent at the same time
+        :param progress: Callable receiving stats after each bulk request
+        :return: Stats with number of sessions deleted, bulk requests, errors and elapsed seconds, and partitions
+        dropped
         """
-        es_response_raw = req_session.get(
-            '{host}/{index}__{document_type}/{document_type}/_search?scroll=1m&search_type=scan'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                document_type='session',
-                index=settings.SITE_BASE_INDEX),
-            data=json.dumps({
-                'query': {
-                    'range': {
-                        'session__expire_date__v1': {
-                            "lt": timezone.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                    }
-                }
-            })
-            )
-        es_response = es_response_raw.json()
-        es_response_raw = req_session.get(
-            '{host}/_search?scroll=1m&search_type=scan'.format(
-                host=settings.ELASTIC_SEARCH_HOST),
-            data={
-                'scroll_id': es_response['_scroll_id']
-            })
-        es_response = es_response_raw.json()
-        delete_list = []
-        while es_response['hits']['hits']:
-            # build bulk data to delete
-            for result in es_response['hits']['hits']:
-                if len(delete_list) > FLUSH_LIMIT:
-                    req_session.post('{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
-                                     u'\n'.join(delete_list) + u'\n')
-                    delete_list = []
-                else:
-                    delete_list.append({
-                        "delete": {
-                            "_index": result['_index'],
-                            "_type": result['_type'],
-                            "_id": result['_id']
-                        }
-                    })
-            es_response_raw = req_session.get(
-                '{host}/_search?scroll=1m&search_type=scan'.format(
-                    host=settings.ELASTIC_SEARCH_HOST),
-                data={
-                    'scroll_id': es_response['_scroll_id']
-                })
-            es_response = es_response_raw.json()
-        req_session.post('{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
-                         u'\n'.join(delete_list) + u'\n')
+        dropped = drop_expired_partitions() if SESSION_PARTITION else []
+        writer = BulkWriter(flush_size=flush_size, workers=workers, progress=progress)
+        try:
+            for hits in scroll(
+                    u'{host}/{index}/{document_type}/_search'.format(
+                        host=settings.ELASTIC_SEARCH_HOST,
+                        index=get_session_index(),
+                        document_type='session'),
+                    {
+                        'query': {
+                            'constant_score': {
+                                'filter': {
+                                    'range': {
+                                        'session__expire_date__v1': {
+                                            'lt': timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
+                                        }
+                                    }
+                                }
+                            }
+                        },
+                        '_source': False
+                    }):
+                for hit in hits:
+                    writer.delete(hit['_index'], hit['_type'], hit['_id'])
+        finally:
+            stats = writer.close()
+        stats['partitions'] = len(dropped)
+        logger.info(u'SessionStore :: clear_expired() :: stats: {}'.format(stats))
+        return stats
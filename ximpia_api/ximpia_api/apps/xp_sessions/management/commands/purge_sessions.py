@@ -0,0 +1,51 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from base.bulk import BULK_WORKERS
+from xp_sessions.backends.db import SessionStore, FLUSH_LIMIT
+
+__author__ = 'jorgealegre'
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Delete expired sessions and drop expired session partitions'
+    can_import_settings = True
+
+    option_list = BaseCommand.option_list + (
+        make_option('--flush_size',
+                    action='store',
+                    dest='flush_size',
+                    default=FLUSH_LIMIT,
+                    help='Sessions deleted in each bulk request'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=BULK_WORKERS,
+                    help='Bulk requests sent at the same time'),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Scroll over expired sessions and delete them with bulk requests
+
+        :param args:
+        :param options:
+        :return:
+        """
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(stats):
+            if verbosity > 1:
+                self.stdout.write(u'deleted: {actions} requests: {requests} errors: {errors} '
+                                  u'elapsed: {elapsed:.1f}s'.format(**stats))
+
+        stats = SessionStore.clear_expired(flush_size=int(options['flush_size']),
+                                           workers=int(options['workers']),
+                                           progress=progress)
+        if verbosity > 0:
+            self.stdout.write(u'Deleted {actions} expired sessions in {elapsed:.1f}s with {requests} bulk requests, '
+                              u'{errors} errors, dropped {partitions} partitions'.format(**stats))
@@ -1,7 +1,9 @@
 import time
 
+from django.conf import settings
 from django.test import RequestFactory, Client
 from base.tests import XimpiaTestCase
+from base.tests.stub import ElasticSearchStubTestCase
 
 __author__ = 'jorgealegre'
 
@@ -28,3 +30,189 @@ class SessionTestCase(XimpiaTestCase):
         del session['key']
         session.save()
         self.assertTrue(len(session.load()) == 0)
+
+
+class SessionWriteQueueTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def get_queue(self, **kwargs):
+        from xp_sessions.backends.db import SessionWriteQueue
+
+        class RecordSessionWriteQueue(SessionWriteQueue):
+
+            batches = []
+
+            def write(self, batch):
+                self.batches.append(batch)
+                with self._lock:
+                    for session_key, document in batch:
+                        if self.pending.get(session_key, 0) is document:
+                            del self.pending[session_key]
+
+        return RecordSessionWriteQueue(**kwargs)
+
+    def test_write_behind(self):
+        queue = self.get_queue(bulk_size=2, interval=0.05)
+        queue.put('key1', {'session__key__v1': 'key1'})
+        queue.put('key2', {'session__key__v1': 'key2'})
+        queue.put('key1', None)
+        # pending writes are read before they reach database
+        self.assertTrue(queue.get('key1', 0) is None)
+        self.assertTrue(queue.get('key2')['session__key__v1'] == 'key2')
+        time.sleep(0.2)
+        self.assertTrue(map(len, queue.batches) == [2, 1])
+        self.assertTrue(queue.pending == {})
+
+    def test_written_while_read(self):
+        from xp_sessions.backends import db
+
+        class WrittenPending(dict):
+            """
+            Writer thread removes session right after it is first looked up
+            """
+
+            def __contains__(self, key):
+                found = dict.__contains__(self, key)
+                self.pop(key, None)
+                return found
+
+            def get(self, key, default=None):
+                document = dict.get(self, key, default)
+                self.pop(key, None)
+                return document
+
+        write_behind, pending = db.SESSION_WRITE_BEHIND, db.session_write_queue.pending
+        db.SESSION_WRITE_BEHIND = True
+        try:
+            document = {'session__key__v1': 'key1'}
+            db.session_write_queue.pending = WrittenPending(key1=document)
+            self.assertTrue(db.SessionStore()._get_document('key1') is document)
+            db.session_write_queue.pending = WrittenPending(key1=document)
+            self.assertTrue(db.SessionStore().exists('key1'))
+        finally:
+            db.SESSION_WRITE_BEHIND = write_behind
+            db.session_write_queue.pending = pending
+
+    def test_flush(self):
+        queue = self.get_queue(bulk_size=10, interval=60)
+        queue._queue.put(('key1', {'session__key__v1': 'key1'}))
+        queue._queue.put(('key2', {'session__key__v1': 'key2'}))
+        queue.flush()
+        self.assertTrue(len(queue.batches) == 1 and len(queue.batches[0]) == 2)
+
+
+class CachedSessionStoreTest(XimpiaTestCase):
+
+    def setUp(self):
+        from xp_sessions.backends.cached import session_cache
+        session_cache.clear()
+
+    def tearDown(self):
+        pass
+
+    def get_store(self, session_key, documents):
+        from xp_sessions.backends.cached import SessionStore
+
+        class DocumentsSessionStore(SessionStore):
+
+            reads = []
+
+            def _get_document(self, session_key):
+                self.reads.append(session_key)
+                return documents.get(session_key, None)
+
+        return DocumentsSessionStore(session_key)
+
+    def test_load(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        store = self.get_store('my-session', {})
+        documents = {
+            'my-session': {
+                'session__key__v1': 'my-session',
+                'session__data__v1': store.encode({'key': 'value'}),
+                'session__expire_date__v1': (timezone.now() + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+        }
+        store = self.get_store('my-session', documents)
+        self.assertTrue(store.load() == {'key': 'value'})
+        session_data = self.get_store('my-session', documents).load()
+        self.assertTrue(session_data == {'key': 'value'})
+        self.assertTrue(store.reads == ['my-session'])
+        # cached data is not modified by requests
+        session_data['key'] = 'other'
+        self.assertTrue(self.get_store('my-session', documents).load() == {'key': 'value'})
+        self.assertTrue(self.get_store('my-session', documents).exists('my-session'))
+
+    def test_load_expired(self):
+        from xp_sessions.backends.cached import session_cache
+        session_cache.set('my-session', ('2015-01-01T00:00:00', {'key': 'value'}))
+        store = self.get_store('my-session', {})
+        self.assertTrue(store.load() == {})
+        self.assertTrue(store.session_key is None)
+        self.assertTrue('my-session' not in session_cache)
+
+
+class SessionPartitionTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_partition(self):
+        from datetime import datetime
+        from xp_sessions.backends.db import get_partition, get_partition_end
+        now = datetime(2015, 10, 18, 12, 30)
+        self.assertTrue(get_partition(now, 'day') == '20151018')
+        self.assertTrue(get_partition_end('20151018', 'day') == datetime(2015, 10, 19))
+        self.assertTrue(get_partition(now, 'week') == '2015w41')
+        # weeks start on monday
+        self.assertTrue(get_partition_end('2015w41', 'week') == datetime(2015, 10, 19))
+
+    def test_key_partition(self):
+        from xp_sessions.backends.db import get_key_partition
+        self.assertTrue(get_key_partition('20151018' + 'a' * 24, 'day') == '20151018')
+        self.assertTrue(get_key_partition('2015w41' + 'a' * 25, 'week') == '2015w41')
+        self.assertTrue(get_key_partition('a' * 32, 'day') is None)
+        self.assertTrue(get_key_partition('20151018' + 'a' * 24, None) is None)
+
+
+class DropPartitionsTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch has partitions for three days, with sessions in 20151017 extended until 2015-10-21
+    """
+
+    expire_dates = {
+        '20151016': 1445040000000,
+        '20151017': 1445385600000,
+        '20151018': 1445212800000,
+    }
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_alias/', lambda request: dict(map(
+                lambda x: (u'{}__session.{}'.format(settings.SITE_BASE_INDEX, x), {}), self.expire_dates.keys()))),
+            ('GET', r'/session/_search$', lambda request: {'aggregations': {'expire_date': {
+                'value': self.expire_dates[request.path.split('/')[1].split('.')[-1]]}}}),
+            ('DELETE', r'', {'acknowledged': True}),
+        ]
+
+    def test_drop_expired_partitions(self):
+        from datetime import datetime
+        from xp_sessions.backends import db
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            partition_type, db.SESSION_PARTITION = db.SESSION_PARTITION, 'day'
+            try:
+                deleted = db.drop_expired_partitions(now=datetime(2015, 10, 18, 12, 0))
+            finally:
+                db.SESSION_PARTITION = partition_type
+        self.assertTrue(deleted == [u'{}__session.20151016'.format(settings.SITE_BASE_INDEX)])
+        # partition not ended is not checked
+        self.assertTrue(len(self.stub.get_requests('GET', r'/session/_search$')) == 2)
@@ -1,8 +1,7 @@
-import requests
-from requests.adapters import HTTPAdapter
 import logging
 import json
 import string
+import hashlib
 from datetime import datetime
 
 from rest_framework import authentication
@@ -12,28 +11,122 @@ from django.contrib.auth.models import User
 from django.utils.crypto import get_random_string
 
 from django.conf import settings
+from django.core.cache import caches
 
-from base import SocialNetworkResolution, get_es_response, exceptions
+from base import SocialNetworkResolution, get_es_response, exceptions, get_base_app
+from base.cache import TTLCache
+from base.transport import es_session
 from document import to_logical_doc, to_physical_doc
 
 
 __author__ = 'jorgealegre'
 
 
-MAX_RETRIES = 3
 FLUSH_LIMIT = 1000
+USER_TOKEN_CACHE_TTL = getattr(settings, 'USER_TOKEN_CACHE_TTL', 60)
+USER_TOKEN_CACHE_NEGATIVE_TTL = getattr(settings, 'USER_TOKEN_CACHE_NEGATIVE_TTL', 10)
+USER_TOKEN_CACHE_SIZE = getattr(settings, 'USER_TOKEN_CACHE_SIZE', 10000)
+# django cache alias, like a memcached or redis cache, to share cache between workers
+USER_TOKEN_CACHE_ALIAS = getattr(settings, 'USER_TOKEN_CACHE_ALIAS', None)
 
-req_session = requests.Session()
-req_session.mount('{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=MAX_RETRIES))
 
 VALID_KEY_CHARS = string.ascii_lowercase + string.digits
 
 logger = logging.getLogger(__name__)
 
 
+class UserTokenCache(object):
+    """
+    Cache of token -> user document, used to authenticate requests without searching users
+
+    Tokens not found are cached as well, USER_TOKEN_CACHE_NEGATIVE_TTL seconds, so bad tokens do not hit
+    ElasticSearch on every request. Entries are in-process unless USER_TOKEN_CACHE_ALIAS is set, then the django
+    cache with that alias is used so workers share entries and token rotation invalidates all of them.
+    """
+
+    NOT_FOUND = '__not_found__'
+
+    def __init__(self, ttl=USER_TOKEN_CACHE_TTL, negative_ttl=USER_TOKEN_CACHE_NEGATIVE_TTL,
+                 max_size=USER_TOKEN_CACHE_SIZE, alias=USER_TOKEN_CACHE_ALIAS):
+        """
+        :param ttl: Seconds we keep user documents
+        :param negative_ttl: Seconds we keep tokens not found
+        :param max_size: Maximum number of tokens in process
+        :param alias: Django cache alias for cache shared between workers
+        :return:
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.alias = alias
+        self._local = TTLCache(max_size=max_size, ttl=ttl)
+
+    @property
+    def _shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @classmethod
+    def get_key(cls, token):
+        """
+        Get cache key for token. We hash token so keys have fixed length and tokens are not stored
+
+        :param token:
+        :return:
+        """
+        return u'xp_user__token__{}'.format(hashlib.sha1(token.encode('utf-8')).hexdigest())
+
+    def get(self, token):
+        """
+        Get user document for token
+
+        :param token:
+        :return: User document, NOT_FOUND for tokens not found or None when token not in cache
+        """
+        if self._shared is not None:
+            return self._shared.get(self.get_key(token))
+        return self._local.get(self.get_key(token))
+
+    def set(self, token, user_document):
+        """
+        Set user document for token
+
+        :param token:
+        :param user_document: Logical user document, NOT_FOUND for tokens not found
+        :return:
+        """
+        ttl = self.negative_ttl if user_document == self.NOT_FOUND else self.ttl
+        if self._shared is not None:
+            self._shared.set(self.get_key(token), user_document, ttl)
+        else:
+            self._local.set(self.get_key(token), user_document, ttl=ttl)
+
+    def delete(self, token):
+        """
+        Delete token, like when token is rotated
+
+        :param token:
+        :return:
+        """
+        if self._shared is not None:
+            self._shared.delete(self.get_key(token))
+        else:
+            self._local.delete(self.get_key(token))
+
+
+user_token_cache = UserTokenCache()
+
+
 class XimpiaAuthBackend(authentication.BaseAuthentication):
 
+    @classmethod
+    def get_base_app_id(cls):
+        """
+        Get base app id for site, from base app cached in process until app documents change
+
+        :return:
+        """
+        from django.utils.text import slugify
+        return get_base_app(slugify(settings.SITE))['id']
+
     @classmethod
     def authenticate(cls,
                      access_token=None,
@@ -44,6 +137,9 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
         """
         Authenticate for all providers given access token
 
+        With base app and app access token cached, we search user and update its token, which returns
+        updated user document, so two ElasticSearch requests.
+
         :param access_token:
         :param provider:
         :param social_app_id:
@@ -51,30 +147,9 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
         :param app_id:
         :return:
         """
-        from document import Document
-        from django.utils.text import slugify
-
         # 1. get social data for user
-        # print u'authenticate :: app_id: {}'.format(app_id)
         if not app_id:
-            # slugify(settings.SITE)
-
-            # In queries we need whole field paths, since field names could be shared
-            # filter uses field1__field2, but these fields
-            # ::::
-            # app__slug.raw__v1='base'
-
-            app = Document.objects.filter(
-                'app',
-                **{
-                    'app__slug__v1.raw__v1': 'base',
-                    'site__v1.site__slug__v1.raw__v1': slugify(settings.SITE),
-                    'get_logical': True
-                }
-            )[0]
-
-            # logger.debug(u'authenticate :: app: {}'.format(app))
-            app_id = app['id']
+            app_id = cls.get_base_app_id()
         try:
             social_data = SocialNetworkResolution.get_network_user_data(provider,
                                                                         app_id=app_id,
@@ -135,7 +210,7 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
         }
         logger.info(u'query: {}'.format(query))
         es_response = get_es_response(
-            req_session.get(
+            es_session.get(
                 '{host}/{index}/user/_search'.format(
                     host=settings.ELASTIC_SEARCH_HOST,
                     index=settings.SITE_BASE_INDEX),
@@ -146,31 +221,19 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
         if es_response.get('hits', {'total': 0})['total'] == 0:
             return None
         db_data = es_response['hits']['hits'][0]
-        user_data = to_logical_doc('user', db_data['_source'])
-        # print u'authenticate :: user_data: {}'.format(user_data)
-        user = User()
-        user.id = db_data['_id']
-        # user.id = random.randint(1, 1000000)
-        user.email = user_data['email']
-        user.pk = user.id
-        # user.pk = random.randint(1, 1000000)
-        user.username = user.id
-        user.first_name = user_data['first_name']
-        user.last_name = user_data['last_name']
-        user_document = {
-            'id': db_data['_id']
-        }
-        user.document = user_document.update(user_data)
+        old_token = (db_data['_source'].get('user__token__v1', None) or {}).get('user__token__key__v1', None)
         # create ximpia token with timestamp: way to check user was authenticated
-        es_response_raw = req_session.post(
-            '{}/{}/user/{id}/_update'.format(settings.ELASTIC_SEARCH_HOST,
-                                             settings.SITE_BASE_INDEX,
-                                             id=db_data['_id']),
+        token = get_random_string(100, VALID_KEY_CHARS)
+        # updated document is returned by update, no need to get user again
+        es_response_raw = es_session.post(
+            '{}/{}/user/{id}/_update?fields=_source'.format(settings.ELASTIC_SEARCH_HOST,
+                                                            settings.SITE_BASE_INDEX,
+                                                            id=db_data['_id']),
             data=json.dumps(
                 {
                     u'doc': {
                         u'user__token__v1': {
-                            u'user__token__key__v1': get_random_string(100, VALID_KEY_CHARS),
+                            u'user__token__key__v1': token,
                             u'user__token__created_on__v1': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
                         },
                     }
@@ -178,19 +241,22 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
             ))
         if es_response_raw.status_code not in [200, 201]:
             raise exceptions.XimpiaAPIException(_(u'Could not create token "{}" :: {}'.format(
-                user.id,
+                db_data['_id'],
                 es_response_raw.content)))
-        user_document = req_session.get(
-            '{host}/{index}/user/{id}'.format(
-                host=settings.ELASTIC_SEARCH_HOST,
-                index=settings.SITE_BASE_INDEX,
-                id=db_data['_id']
-            )).json()
-        # print user_document
-        user_data = user_document['_source']
-        user_document_logical = to_logical_doc('user', user_data)
-        user_document_logical['id'] = user_document['_id']
+        user_document_logical = to_logical_doc('user', es_response_raw.json()['get']['_source'])
+        user_document_logical['id'] = db_data['_id']
+        user = User()
+        user.id = db_data['_id']
+        user.email = user_document_logical['email']
+        user.pk = user.id
+        user.username = user.id
+        user.first_name = user_document_logical['first_name']
+        user.last_name = user_document_logical['last_name']
         user.document = user_document_logical
+        # old token is not valid anymore
+        if old_token:
+            user_token_cache.delete(old_token)
+        user_token_cache.set(token, user_document_logical)
         return user
 
     @classmethod
@@ -202,7 +268,7 @@ class XimpiaAuthBackend(authentication.BaseAuthentication):
         :return:
         """
         es_response = get_es_response(
-            req_session.get(
+            es_session.get(
                 '{host}/{index}/user/{user_id}'.format(
                     host=settings.ELASTIC_SEARCH_HOST,
                     index=settings.SITE_BASE_INDEX,
@@ -0,0 +1,73 @@
+from base import SocialNetworkResolution
+from base.tests.stub import ElasticSearchStubTestCase
+
+__author__ = 'jorgealegre'
+
+
+USER_SOURCE = {
+    'user__email__v1': 'john@ximpia.io',
+    'user__first_name__v1': 'John',
+    'user__last_name__v1': 'Smith',
+    'user__token__v1': {
+        'user__token__key__v1': 'old-token',
+    },
+}
+
+
+def update_user(request):
+    source = dict(USER_SOURCE, **request.json()['doc'])
+    return {'_id': 'user-id', '_version': 2, 'get': {'found': True, '_source': source}}
+
+
+class AuthenticateTest(ElasticSearchStubTestCase):
+    """
+    ElasticSearch answers base app, user search and user update
+    """
+
+    def get_routes(self):
+        return [
+            ('GET', r'^/_msearch', {'responses': [{'hits': {'hits': [
+                {'_index': 'site__base', '_type': 'app', '_id': 'app-id', '_version': 1,
+                 '_source': {'app__slug__v1': 'base'}}]}}]}),
+            ('GET', r'', {'hits': {'total': 1, 'hits': [{'_id': 'user-id', '_source': USER_SOURCE}]}}),
+            ('POST', r'/_update', update_user),
+        ]
+
+    def setUp(self):
+        super(AuthenticateTest, self).setUp()
+        self.get_network_user_data = SocialNetworkResolution.get_network_user_data
+        SocialNetworkResolution.get_network_user_data = classmethod(
+            lambda cls, provider, **kwargs: {'user_id': '1207059'})
+
+    def tearDown(self):
+        from base import base_document_cache
+        base_document_cache.invalidate()
+        SocialNetworkResolution.get_network_user_data = self.get_network_user_data
+        super(AuthenticateTest, self).tearDown()
+
+    def test_round_trips(self):
+        from xp_user.backends import XimpiaAuthBackend, user_token_cache
+        user_token_cache.set('old-token', {'id': 'user-id'})
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            user = XimpiaAuthBackend.authenticate(access_token='user-token', provider='facebook', app_id='my-app')
+        self.assertTrue(len(self.stub.requests) == 2)
+        self.assertTrue(self.stub.requests[1].path.endswith('/_update?fields=_source'))
+        self.assertTrue(user.id == 'user-id' and user.email == 'john@ximpia.io')
+        token = user.document['token']['key']
+        self.assertTrue(token != 'old-token')
+        self.assertTrue(user_token_cache.get('old-token') is None)
+        self.assertTrue(user_token_cache.get(token)['id'] == 'user-id')
+
+    def test_base_app_id(self):
+        from django.conf import settings
+        from django.utils.text import slugify
+        from base import base_document_cache
+        from xp_user.backends import XimpiaAuthBackend
+        with self.settings(ELASTIC_SEARCH_HOST=self.host):
+            self.assertTrue(XimpiaAuthBackend.get_base_app_id() == 'app-id')
+            XimpiaAuthBackend.get_base_app_id()
+            self.assertTrue(len(self.stub.requests) == 1)
+            # app written by SetupSite or DocumentManager.update
+            base_document_cache.invalidate('app', slugify(settings.SITE))
+            XimpiaAuthBackend.get_base_app_id()
+            self.assertTrue(len(self.stub.get_requests('GET', r'^/_msearch')) == 2)
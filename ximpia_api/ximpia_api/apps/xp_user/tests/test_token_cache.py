@@ -0,0 +1,59 @@
+import time
+
+from django.test import override_settings
+
+from base.tests import XimpiaTestCase
+
+__author__ = 'jorgealegre'
+
+
+class UserTokenCacheTest(XimpiaTestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_set(self):
+        from xp_user.backends import UserTokenCache
+        cache = UserTokenCache(ttl=60, negative_ttl=60, max_size=10, alias=None)
+        self.assertTrue(cache.get('my-token') is None)
+        cache.set('my-token', {'id': 'user-id', 'email': 'john@ximpia.io'})
+        self.assertTrue(cache.get('my-token')['id'] == 'user-id')
+        cache.delete('my-token')
+        self.assertTrue(cache.get('my-token') is None)
+
+    def test_not_found(self):
+        from xp_user.backends import UserTokenCache
+        cache = UserTokenCache(ttl=60, negative_ttl=0.01, max_size=10, alias=None)
+        cache.set('bad-token', cache.NOT_FOUND)
+        self.assertTrue(cache.get('bad-token') == cache.NOT_FOUND)
+        time.sleep(0.02)
+        self.assertTrue(cache.get('bad-token') is None)
+
+    @override_settings(CACHES={
+        'tokens': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_shared(self):
+        from xp_user.backends import UserTokenCache
+        cache = UserTokenCache(ttl=60, negative_ttl=60, max_size=10, alias='tokens')
+        other_worker_cache = UserTokenCache(ttl=60, negative_ttl=60, max_size=10, alias='tokens')
+        cache.set('my-token', {'id': 'user-id'})
+        self.assertTrue(other_worker_cache.get('my-token') == {'id': 'user-id'})
+        other_worker_cache.delete('my-token')
+        self.assertTrue(cache.get('my-token') is None)
+
+    def test_user_document_copy(self):
+        from base.middleware import XimpiaRequestMiddleware
+        from xp_user.backends import user_token_cache
+        user_token_cache.set('my-token', {'id': 'user-id', 'email': 'john@ximpia.io', 'first_name': 'John',
+                                          'last_name': 'Doe', 'groups': [{'name': 'users'}]})
+        try:
+            user = XimpiaRequestMiddleware.get_user(None, 'my-token')
+            user.document['groups'].append({'name': 'admin'})
+            self.assertTrue(user_token_cache.get('my-token')['groups'] == [{'name': 'users'}])
+        finally:
+            user_token_cache.delete('my-token')
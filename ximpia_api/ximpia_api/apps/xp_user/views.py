@@ -1,8 +1,6 @@
 # Python
 import string
-import requests
 import json
-from requests.adapters import HTTPAdapter
 import logging
 from datetime import datetime, timedelta
 import time
@@ -26,16 +24,13 @@ from base import exceptions, get_path_by_id, SocialNetworkResolution, get_path_s
     get_site, constants, get_resource
 from document import to_logical_doc, to_physical_doc, Document
 from xp_user import login, logout
-from base import get_base_app, get_version
+from base import get_base_app, get_base_apps, get_version
+from base.transport import es_session
 
 __author__ = 'jorgealegre'
 
 VALID_KEY_CHARS = string.ascii_lowercase + string.digits
-MAX_RETRIES = 3
 
-req_session = requests.Session()
-req_session.mount('https://{}'.format(settings.ELASTIC_SEARCH_HOST),
-                  HTTPAdapter(max_retries=MAX_RETRIES))
 
 logger = logging.getLogger(__name__)
 
@@ -239,9 +234,8 @@ class UserSignup(generics.CreateAPIView):
         data = json.loads(request.body)
         site_slug = get_site(request)
         # print u'UserSignup :: site: {}'.format(site_slug)
-        app = get_base_app(site_slug)
+        app, app_ximpia_base = get_base_apps(site_slug, slugify(settings.SITE))
         logger.debug(u'UserSignup :: app: {}'.format(app))
-        app_ximpia_base = get_base_app(slugify(settings.SITE))
         # print u'UserSignup :: app: {}'.format(app)
         app_id = app['id']
         # print u'UserSignup :: app_id: {}'.format(app_id)
@@ -339,7 +333,7 @@ class UserSignup(generics.CreateAPIView):
             },
             u'user__created_on__v1': now_es,
         }
-        es_response_raw = requests.post(
+        es_response_raw = es_session.post(
             '{}/{}/user'.format(settings.ELASTIC_SEARCH_HOST, index_name_ximpia),
             data=json.dumps(user_data))
         if es_response_raw.status_code not in [200, 201]:
@@ -355,7 +349,7 @@ class UserSignup(generics.CreateAPIView):
         user_data_logical['id'] = es_response.get('_id', '')
         # users groups
         for group_data in data['groups']:
-            es_response_raw = requests.post(
+            es_response_raw = es_session.post(
                 '{}/{}/user-group'.format(settings.ELASTIC_SEARCH_HOST, index_name),
                 data=json.dumps({
                     u'user__v1': {
@@ -436,7 +430,7 @@ class User(DocumentViewSet):
         # update user
         logger.debug(u'User.update :: index: {}'.format(index))
         logger.debug(u'User.update :: user_data: {}'.format(user_data))
-        es_response_raw = requests.put(
+        es_response_raw = es_session.put(
             '{}/{}/user/{id}'.format(settings.ELASTIC_SEARCH_HOST, 'ximpia-api__base', id=user_id),
             data=json.dumps(to_physical_doc('user', user_data)))
         if es_response_raw.status_code not in [200, 201]:
@@ -506,7 +500,7 @@ class User(DocumentViewSet):
         logger.debug(u'User.update :: bulk_data_str: ')
         print bulk_data_str
         # Make request for bulk index and delete operations
-        es_response_raw = requests.post(
+        es_response_raw = es_session.post(
             '{host}/_bulk'.format(host=settings.ELASTIC_SEARCH_HOST),
             data=bulk_data_str,
             headers={'Content-Type': 'application/octet-stream'},